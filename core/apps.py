@@ -19,3 +19,8 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Connect the signal receivers that keep the client id, token and lookup caches, the search and options indexes, the
+        # entity tags and the stock movement journal fresh
+        from . import authentication, conditional, filters, lookup, reports, search, tenancy
@@ -0,0 +1,129 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# authentication.py
+
+import copy
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import CacheVersion
+
+TOKEN_CACHE_NAME = 'authtoken'
+
+class TokenCache:
+    """
+    Per process LRU cache of authenticated tokens. Entries expire after AUTH_TOKEN_CACHE_TTL seconds and at most
+    AUTH_TOKEN_CACHE_SIZE tokens are kept.
+
+    Creating, rotating or deleting a token and changing or deleting a user (the authtoken and authtool commands, the admin
+    site, ...) bump the 'authtoken' CacheVersion. Every process compares its version with the database at most every
+    AUTH_TOKEN_CACHE_VERSION_INTERVAL seconds and drops all its tokens when the version has changed, so a revoked token
+    stops working in every worker within that time and straight away in the process that revoked it.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = None
+
+    def _check_version(self, now:float):
+        interval = getattr(settings, 'AUTH_TOKEN_CACHE_VERSION_INTERVAL', 5)
+        if self._checked_at is not None and now - self._checked_at < interval:
+            return
+
+        version = CacheVersion.get_version(TOKEN_CACHE_NAME)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked_at = now
+
+    def get(self, key:str):
+        """
+        Get the (user, token) of a cached token key, or None if the key is not cached.
+        """
+        now = time.monotonic()
+        self._check_version(now)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def set(self, key:str, user, token):
+        ttl = getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60)
+        if not ttl:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, user, token)
+            self._entries.move_to_end(key)
+            while len(self._entries) > getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+token_cache = TokenCache()
+
+class CachingTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that keeps authenticated tokens in the per process token_cache instead of reading the token and
+    its user from the database on every request.
+    """
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            user, token = cached
+            # Requests get their own copy of the user so nothing one request sets on it leaks into another
+            return (copy.copy(user), token)
+
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(key, user, token)
+        return (copy.copy(user), token)
+
+def invalidate_tokens():
+    """
+    Drop the cached tokens of every process.
+    """
+    token_cache.clear()
+    CacheVersion.bump(TOKEN_CACHE_NAME)
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def on_token_changed(sender, **kwargs):
+    # Saving a user on login only updates last_login, which does not change who the token authenticates
+    update_fields = kwargs.get('update_fields')
+    if sender is not Token and update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    invalidate_tokens()
@@ -0,0 +1,165 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# conditional.py
+
+import hashlib
+
+from calendar import timegm
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Max
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.http import http_date
+
+from .models import ProductDef
+
+def make_etag(*parts, weak:bool=False) -> str:
+    """
+    Make an entity tag from the string value of parts.
+
+    Args:
+        parts (list): the values the tagged representation depends on.
+        weak  (bool): True for a weak entity tag that only promises an equivalent representation.
+
+    Returns:
+        str: the quoted entity tag.
+    """
+    digest = hashlib.sha1('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+def to_timestamp(value):
+    return timegm(value.utctimetuple()) if value is not None else None
+
+def _is_versioned(model) -> bool:
+    return any(field.name == 'updated_at' for field in model._meta.concrete_fields)
+
+def _get_version(instance):
+    return instance.updated_at or instance.created_at
+
+def get_related_names(model) -> list:
+    """
+    Get the names of the foreign key and many to many fields of a model whose rows have a version (updated_at). The objects
+    are rendered with the key of these related rows, so their versions are part of the validators of the objects.
+
+    Args:
+        model (Model): the model class.
+
+    Returns:
+        list: the field names.
+    """
+    fields = [field for field in model._meta.concrete_fields if field.is_relation] + list(model._meta.many_to_many)
+    return [field.name for field in fields if _is_versioned(field.related_model)]
+
+def _to_part(value) -> str:
+    if value is None:
+        return ''
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+def _latest(versions:list):
+    versions = [version for version in versions if version is not None]
+    return max(versions) if versions else None
+
+def get_instance_validators(instance) -> tuple:
+    """
+    Get the validators of one object from its updated_at, or created_at if it was never updated, and the versions of the
+    related rows it is rendered with. Related rows are read through the object so select_related() and prefetch_related()
+    rows are used.
+
+    Args:
+        instance (Model): the object.
+
+    Returns:
+        tuple: (etag, last modified timestamp).
+    """
+    version = _get_version(instance)
+    if version is None:
+        return None, None
+
+    parts = list()
+    versions = [version]
+    for name in get_related_names(instance.__class__):
+        if instance._meta.get_field(name).many_to_many:
+            related = [_get_version(obj) for obj in getattr(instance, name).all()]
+            parts.append(len(related))
+            related = _latest(related)
+        else:
+            obj = getattr(instance, name)
+            related = _get_version(obj) if obj is not None else None
+        parts.append(_to_part(related))
+        versions.append(related)
+
+    return make_etag(instance.__class__.__name__, instance.pk, version.isoformat(), *parts), to_timestamp(_latest(versions))
+
+def get_queryset_validators(queryset, *parts) -> tuple:
+    """
+    Get the validators of a list of objects from the number of objects, their latest updated_at (or created_at) and the
+    latest versions of the related rows they are rendered with. Adding, changing or deleting an object or changing a
+    related row changes at least one of them.
+
+    Args:
+        queryset (QuerySet): the filtered objects of the list.
+        parts    (list):     anything else the representation depends on, such as the page and the user.
+
+    Returns:
+        tuple: (weak etag, last modified timestamp or None if the list is empty).
+    """
+    names = get_related_names(queryset.model)
+    aggregates = {'count': Count('pk', distinct=True), 'version': Max(Coalesce('updated_at', 'created_at'))}
+    for name in names:
+        aggregates[f'{name}_version'] = Max(Coalesce(f'{name}__updated_at', f'{name}__created_at'))
+        if queryset.model._meta.get_field(name).many_to_many:
+            aggregates[f'{name}_count'] = Count(name)
+    validators = queryset.order_by().aggregate(**aggregates)
+
+    etag = make_etag(queryset.model.__name__, *[_to_part(validators[key]) for key in aggregates], *parts, weak=True)
+    if validators['version'] is None:
+        return etag, None
+    return etag, to_timestamp(_latest([validators['version'], *[validators[f'{name}_version'] for name in names]]))
+
+def set_validators(response, etag:str, last_modified:int):
+    if etag is not None:
+        response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    return response
+
+# Changes that do not change the version of any row the objects are rendered with bump the updated_at of the objects
+
+@receiver(m2m_changed, sender=ProductDef.warehauses.through)
+def on_productdef_warehauses_changed(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear') or (pk_set is not None and not pk_set):
+        return
+    if not reverse:
+        dfns = ProductDef.objects.filter(pk=instance.pk)
+    elif action == 'pre_clear':
+        dfns = ProductDef.objects.filter(warehauses=instance)
+    else:
+        dfns = ProductDef.objects.filter(pk__in=pk_set)
+    dfns.update(updated_at=timezone.now())
+
+@receiver(pre_save, sender=get_user_model())
+def on_user_saving(sender, instance, update_fields=None, **kwargs):
+    # Objects render the username of their user
+    if instance.pk is None or (update_fields is not None and 'username' not in update_fields):
+        return
+    username = sender.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+    if username is None or username == instance.username:
+        return
+    for relation in sender._meta.related_objects:
+        if relation.one_to_many and _is_versioned(relation.related_model):
+            relation.related_model.objects.filter(**{relation.field.name: instance.pk}).update(updated_at=timezone.now())
@@ -0,0 +1,109 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# fairqueue.py
+
+import heapq
+import threading
+
+from django.db.models import Count, Q
+
+from .status import STATUS_OPEN, STATUS_PROCESSING
+
+class WeightedFairQueue:
+    """
+    Weighted fair queueing of batched events across clients. Every client has a virtual finish time that advances by
+    1 / Client.weight for every event dispatched for it, and the client with the smallest virtual finish time is served
+    next. Virtual finish times persist between passes so a client that has just been served a large share waits its turn,
+    while a client that has been idle joins at the current virtual time instead of claiming all the capacity it missed.
+    Clients with a weight of 0 or less are paused: none of their events are dispatched.
+    """
+    def __init__(self):
+        self._finish = dict()
+        self._lock = threading.Lock()
+
+    def allocate(self, clients:list, capacity:int) -> dict:
+        """
+        Share capacity between clients.
+
+        Args:
+            clients  (list): list of dictionaries with keys 'owner' (client id), 'weight' (float, None for 1.0), 'queued'
+                             (number of OPEN batched events), 'running' (number of events processing) and 'max_events'
+                             (maximum number of events processing at the same time or None for no limit).
+            capacity (int):  maximum number of events to dispatch.
+
+        Returns:
+            dict: client id to number of events to dispatch.
+        """
+        def get_weight(client) -> float:
+            return float(1.0) if client['weight'] is None else client['weight']
+
+        def is_eligible(client):
+            return get_weight(client) > 0 and client['queued'] > 0 and (client['max_events'] is None or client['running'] < client['max_events'])
+
+        with self._lock:
+            active = [dict(client) for client in clients if is_eligible(client)]
+            if not active:
+                return dict()
+
+            known = [self._finish[client['owner']] for client in active if client['owner'] in self._finish]
+            virtual_time = min(known) if known else float(0.0)
+
+            heap = [(max(self._finish.get(client['owner'], virtual_time), virtual_time), client['owner'], client) for client in active]
+            heapq.heapify(heap)
+
+            allocation = dict()
+            while capacity > 0 and heap:
+                finish, owner, client = heapq.heappop(heap)
+
+                allocation[owner] = allocation.get(owner, 0) + 1
+                client['queued'] = client['queued'] - 1
+                client['running'] = client['running'] + 1
+                capacity = capacity - 1
+
+                finish = finish + float(1.0) / get_weight(client)
+                self._finish[owner] = finish
+
+                if is_eligible(client):
+                    heapq.heappush(heap, (finish, owner, client))
+
+            return allocation
+
+def get_queue_depths(clients) -> list:
+    """
+    Get the batched event queue depth of clients.
+
+    Args:
+        clients (QuerySet): the Client objects to report on.
+
+    Returns:
+        list: list of dictionaries with keys 'owner', 'weight', 'max_events', 'queued' (OPEN batched events with no pending
+              children) and 'running' (batched events processing) for each client.
+    """
+    clients = clients.annotate(
+        queued=Count('events', filter=Q(events__is_batched=True, events__status=STATUS_OPEN, events__pending_children=0)),
+        running=Count('events', filter=Q(events__is_batched=True, events__status=STATUS_PROCESSING)),
+    )
+
+    return [
+        {
+            'owner':      client.id,
+            'weight':     client.weight,
+            'max_events': client.max_events,
+            'queued':     client.queued,
+            'running':    client.running,
+        } for client in clients.order_by('id')
+    ]
+
+event_fair_queue = WeightedFairQueue()
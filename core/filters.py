@@ -14,20 +14,29 @@
 
 # filters.py
 
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from django_filters import rest_framework as filters
+from django_filters.constants import EMPTY_VALUES
 
 from core.models import *
 
+# How the options__<key> filter of an indexed options key matches values. Both are index scans of OptionsIndex.
+OPTIONS_MATCH_EXACT  = 'exact'  # the value equals the filter value (case sensitive)
+OPTIONS_MATCH_PREFIX = 'prefix' # the value starts with the filter value (case sensitive)
+
 # Each model has a options field that is defined as a JSONField.
-# Use these KEY_OPTIONS_* arrays to declare what fields you want in
-# options to be searchable from the respective FilterSet.
-# Format: ['key1', 'key2',...]
-KEYS_OPTIONS_WAREHAUSEDEF  = ['values',]
-KEYS_OPTIONS_WAREHAUSE     = ['values',]
-KEYS_OPTIONS_PRODUCTDEF    = ['values',]
-KEYS_OPTIONS_PRODUCT       = ['values',]
-KEYS_OPTIONS_EVENTDEF      = ['values',]
-KEYS_OPTIONS_EVENT         = ['values',]
+# Use these KEY_OPTIONS_* dictionaries to declare what fields you want in
+# options to be searchable from the respective FilterSet, and how they match.
+# The values of these keys are indexed in OptionsIndex when objects are saved
+# (python manage.py rebuild_search_index indexes existing objects).
+# Format: {'key1': OPTIONS_MATCH_EXACT, 'key2': OPTIONS_MATCH_PREFIX,...}
+KEYS_OPTIONS_WAREHAUSEDEF  = {'values': OPTIONS_MATCH_EXACT,}
+KEYS_OPTIONS_WAREHAUSE     = {'values': OPTIONS_MATCH_EXACT,}
+KEYS_OPTIONS_PRODUCTDEF    = {'values': OPTIONS_MATCH_EXACT,}
+KEYS_OPTIONS_PRODUCT       = {'values': OPTIONS_MATCH_EXACT,}
+KEYS_OPTIONS_EVENTDEF      = {'values': OPTIONS_MATCH_EXACT,}
+KEYS_OPTIONS_EVENT         = {'values': OPTIONS_MATCH_EXACT,}
 
 FILTER_FIELDS_STANDARD     = {
     'id':          ['exact', 'lt', 'lte', 'gt', 'gte',],
@@ -52,18 +61,72 @@ FILTER_FIELDS_INSTANCE_STANDARD = {
     'parent': ['exact', 'isnull',],
 }
 
-def init_filters_help(fs, array):
-    for key in array:
-        fs.filters[f'options__{key}'] = filters.CharFilter(field_name=f'options__{key}', lookup_expr='icontains')
-        fs.filters[f'options__{key}__exclude'] = filters.CharFilter(field_name=f'options__{key}', lookup_expr='icontains', exclude=True)
-        fs.filters[f'options__{key}__isnull'] = filters.BooleanFilter(field_name=f'options__{key}', lookup_expr='isnull')
-        fs.filters[f'options__{key}__isnotnull'] = filters.BooleanFilter(field_name=f'options__{key}', lookup_expr='isnull', exclude=True)
-        fs.filters[f'options__{key}__lt'] = filters.NumberFilter(field_name=f'options__{key}', lookup_expr='lt')
-        fs.filters[f'options__{key}__lte'] = filters.NumberFilter(field_name=f'options__{key}', lookup_expr='lte')
-        fs.filters[f'options__{key}__gt'] = filters.NumberFilter(field_name=f'options__{key}', lookup_expr='gt')
-        fs.filters[f'options__{key}__gte'] = filters.NumberFilter(field_name=f'options__{key}', lookup_expr='gte')
+class OptionsKeyFilterMixin:
+    """
+    Filter objects by the OptionsIndex rows of one options key. lookup_expr is 'exact' or 'prefix' to match the value,
+    'lt', 'lte', 'gt' or 'gte' to compare the number, or 'isnull' to match objects without (True) or with (False) a value.
+    """
+    def __init__(self, *args, key:str=None, **kwargs):
+        self.key = key
+        super().__init__(*args, **kwargs)
+
+    def _get_rows(self, queryset, value):
+        rows = OptionsIndex.objects.filter(model=queryset.model._meta.label_lower, key=self.key)
+        if self.lookup_expr == OPTIONS_MATCH_EXACT:
+            return rows.filter(value=value)
+        if self.lookup_expr == OPTIONS_MATCH_PREFIX:
+            # A range scan of the index, rechecked with startswith for collations that do not sort by code point
+            return rows.filter(value__gte=value, value__lt=f'{value}\U0010ffff', value__startswith=value)
+        if self.lookup_expr == 'isnull':
+            return rows
+        return rows.filter(**{f'number__{self.lookup_expr}': value})
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+
+        q = Q(id__in=self._get_rows(qs, value).values('object_id'))
+        if self.lookup_expr == 'isnull':
+            # options__<key>__isnull=true and options__<key>__isnotnull=false both ask for objects without a value
+            return qs.exclude(q) if bool(value) != self.exclude else qs.filter(q)
+        return qs.exclude(q) if self.exclude else qs.filter(q)
+
+class OptionsKeyCharFilter(OptionsKeyFilterMixin, filters.CharFilter):
+    pass
+
+class OptionsKeyNumberFilter(OptionsKeyFilterMixin, filters.NumberFilter):
+    pass
+
+class OptionsKeyBooleanFilter(OptionsKeyFilterMixin, filters.BooleanFilter):
+    pass
+
+def get_options_filters(keys:dict) -> dict:
+    """
+    Get the filters of indexed options keys.
+
+    Args:
+        keys (dict): {key: OPTIONS_MATCH_EXACT or OPTIONS_MATCH_PREFIX}.
+
+    Returns:
+        dict: {filter name: filter}.
+    """
+    options_filters = dict()
+    for key, match in keys.items():
+        field_name = f'options__{key}'
+        options_filters[field_name] = OptionsKeyCharFilter(key=key, field_name=field_name, lookup_expr=match)
+        options_filters[f'{field_name}__exclude'] = OptionsKeyCharFilter(key=key, field_name=field_name, lookup_expr=match, exclude=True)
+        options_filters[f'{field_name}__isnull'] = OptionsKeyBooleanFilter(key=key, field_name=field_name, lookup_expr='isnull')
+        options_filters[f'{field_name}__isnotnull'] = OptionsKeyBooleanFilter(key=key, field_name=field_name, lookup_expr='isnull', exclude=True)
+        for lookup_expr in ('lt', 'lte', 'gt', 'gte',):
+            options_filters[f'{field_name}__{lookup_expr}'] = OptionsKeyNumberFilter(key=key, field_name=field_name, lookup_expr=lookup_expr)
+    return options_filters
 
 class WarehauserFilterSet(filters.FilterSet):
+    """
+    FilterSet of a warehauser model. Meta.options_keys declares the indexed options keys of the model
+    ({key: OPTIONS_MATCH_EXACT or OPTIONS_MATCH_PREFIX}): the keys are registered with OptionsIndex and their filters are
+    built once with the other filters of the class.
+    """
     class Meta:
         filter_overrides = {
             models.JSONField: {
@@ -74,6 +137,32 @@ class WarehauserFilterSet(filters.FilterSet):
             },
         }
 
+    @classmethod
+    def get_filters(cls):
+        # Called once by the FilterSet metaclass when the class is created
+        base_filters = super().get_filters()
+
+        keys = getattr(cls.Meta, 'options_keys', None)
+        if cls._meta.model is not None and keys:
+            OptionsIndex.register(cls._meta.model, keys)
+            base_filters.update(get_options_filters(keys))
+
+        return base_filters
+
+def on_object_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'options' not in update_fields:
+        return
+    OptionsIndex.index_objects([instance])
+
+def on_object_deleted(sender, instance, **kwargs):
+    if not is_bulk_deleted(instance):
+        OptionsIndex.unindex_objects(sender, [instance.id])
+
+# Receivers without a sender would stop every model from being deleted without loading its objects
+for _model in SEARCHABLE_MODELS:
+    post_save.connect(on_object_saved, sender=_model)
+    post_delete.connect(on_object_deleted, sender=_model)
+
 
 # WAREHAUSE filters
 
@@ -94,18 +183,16 @@ FILTER_FIELDS_WAREHAUSE_COMMON = {
 class WarehauseDefFilter(WarehauserFilterSet):
     class Meta(WarehauserFilterSet.Meta):
         model = WarehauseDef
+        options_keys = KEYS_OPTIONS_WAREHAUSEDEF
         fields = {
             **FILTER_FIELDS_DEF_STANDARD,
             **FILTER_FIELDS_WAREHAUSE_COMMON,
         }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        init_filters_help(self, KEYS_OPTIONS_WAREHAUSEDEF)
-
 class WarehauseFilter(WarehauserFilterSet):
     class Meta(WarehauserFilterSet.Meta):
         model = Warehause
+        options_keys = KEYS_OPTIONS_WAREHAUSE
         fields = {
             **FILTER_FIELDS_INSTANCE_STANDARD,
             **FILTER_FIELDS_WAREHAUSE_COMMON,
@@ -115,10 +202,6 @@ class WarehauseFilter(WarehauserFilterSet):
             'stock_max': ['exact', 'lt', 'lte', 'gt', 'gte', 'isnull',],
         }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        init_filters_help(self, KEYS_OPTIONS_WAREHAUSE)
-
 
 # PRODUCT filters
 
@@ -136,19 +219,17 @@ FILTER_FIELDS_PRODUCT_COMMON = {
 class ProductDefFilter(WarehauserFilterSet):
     class Meta(WarehauserFilterSet.Meta):
         model = ProductDef
+        options_keys = KEYS_OPTIONS_PRODUCTDEF
         fields = {
             **FILTER_FIELDS_DEF_STANDARD,
             **FILTER_FIELDS_PRODUCT_COMMON,
             'atomic': ['exact', 'lt', 'lte', 'gt', 'gte',],
         }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        init_filters_help(self, KEYS_OPTIONS_PRODUCTDEF)
-
 class ProductFilter(WarehauserFilterSet):
     class Meta(WarehauserFilterSet.Meta):
         model = Product
+        options_keys = KEYS_OPTIONS_PRODUCT
         fields = {
             **FILTER_FIELDS_INSTANCE_STANDARD,
             **FILTER_FIELDS_PRODUCT_COMMON,
@@ -158,33 +239,29 @@ class ProductFilter(WarehauserFilterSet):
             'is_damaged': ['exact',],
         }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        init_filters_help(self, KEYS_OPTIONS_PRODUCT)
-
 
 # EVENT filters
 
 FILTER_FIELDS_EVENT_COMMON = {
     'is_batched': ['exact',],
-    'proc_name': ['exact', 'isnull',]
+    'proc_name': ['exact', 'isnull',],
+    'timeout': ['exact', 'isnull', 'lt', 'lte', 'gt', 'gte',],
+    'dedup_key': ['exact', 'isnull',],
 }
 
 class EventDefFilter(WarehauserFilterSet):
     class Meta(WarehauserFilterSet.Meta):
         model = EventDef
+        options_keys = KEYS_OPTIONS_EVENTDEF
         fields = {
             **FILTER_FIELDS_DEF_STANDARD,
             **FILTER_FIELDS_EVENT_COMMON,
         }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        init_filters_help(self, KEYS_OPTIONS_EVENTDEF)
-
 class EventFilter(WarehauserFilterSet):
     class Meta(WarehauserFilterSet.Meta):
         model = Event
+        options_keys = KEYS_OPTIONS_EVENT
         fields = {
             **FILTER_FIELDS_INSTANCE_STANDARD,
             **FILTER_FIELDS_EVENT_COMMON,
@@ -193,7 +270,3 @@ class EventFilter(WarehauserFilterSet):
             'proc_start': ['exact', 'isnull', 'lt', 'lte', 'gt', 'gte',],
             'proc_end': ['exact', 'isnull', 'lt', 'lte', 'gt', 'gte',],
         }
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        init_filters_help(self, KEYS_OPTIONS_EVENT)
@@ -0,0 +1,152 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# jobs.py
+
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.translation import gettext as _
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+class JobStats:
+    """
+    Run statistics of a scheduled job.
+
+    Attributes:
+        durations     (Histogram): histogram of run durations in seconds.
+        errors        (int):       number of runs that raised an exception.
+        overruns      (int):       number of times the job was due while its previous run was still active.
+        coalesced     (int):       number of overruns that were coalesced into a single follow up run.
+        last_duration (float):     duration in seconds of the last finished run.
+        max_duration  (float):     longest run duration in seconds.
+    """
+    def __init__(self):
+        self.durations = Histogram()
+        self.errors = 0
+        self.overruns = 0
+        self.coalesced = 0
+        self.last_duration = None
+        self.max_duration = None
+
+    def observe(self, duration:float, err:Exception=None):
+        self.durations.observe(duration)
+        self.last_duration = duration
+        self.max_duration = duration if self.max_duration is None else max(self.max_duration, duration)
+        if err is not None:
+            self.errors = self.errors + 1
+
+class JobExecutor:
+    """
+    Run scheduled jobs on a fixed size pool of SCHEDULER_WORKERS (default 4) threads. A job is never run concurrently with
+    itself: a job that is due while its previous run is still active (or still waiting for a free worker) counts as an
+    overrun and is skipped. With SCHEDULER_COALESCE (default True) all the overruns of a run are coalesced into one follow up
+    run that starts as soon as the active run finishes.
+    """
+    def __init__(self, workers:int=None, coalesce:bool=None):
+        self.workers = workers or getattr(settings, 'SCHEDULER_WORKERS', 4)
+        self.coalesce = getattr(settings, 'SCHEDULER_COALESCE', True) if coalesce is None else coalesce
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._active = set()
+        self._pending = set()
+        self.stats = dict()
+
+    def submit(self, name:str, func) -> bool:
+        """
+        Run a job unless its previous run is still active.
+
+        Args:
+            name (str):      unique name of the job.
+            func (callable): function without arguments that runs the job.
+
+        Returns:
+            bool: True if the job was submitted, False if it was skipped (or coalesced).
+        """
+        with self._lock:
+            stats = self.stats.setdefault(name, JobStats())
+            if name in self._active:
+                stats.overruns = stats.overruns + 1
+                if self.coalesce and name not in self._pending:
+                    self._pending.add(name)
+                    stats.coalesced = stats.coalesced + 1
+                logger.warning(msg=_(f'Job {name} is due but its previous run is still active ({stats.overruns} overrun(s)).'))
+                return False
+
+            self._active.add(name)
+
+        self._executor.submit(self._run, name, func)
+        return True
+
+    def _run(self, name:str, func):
+        err = None
+        start = time.monotonic()
+        close_old_connections()
+        try:
+            func()
+        except Exception as e:
+            err = e
+            logger.exception(msg=_(f'Job {name} failed: {e}'))
+        finally:
+            close_old_connections()
+            duration = time.monotonic() - start
+
+            with self._lock:
+                self.stats[name].observe(duration=duration, err=err)
+                self._active.discard(name)
+                rerun = name in self._pending
+                self._pending.discard(name)
+
+            logger.debug(msg=_(f'Job {name} finished in {duration:.3f}s.'))
+
+        if rerun:
+            self.submit(name, func)
+
+    def report(self) -> list:
+        """
+        Get the run statistics of all jobs.
+
+        Returns:
+            list: list of dictionaries with keys 'name', 'runs', 'errors', 'overruns', 'coalesced', 'last', 'max', 'p50',
+                  'p95' and 'active' sorted by name. Durations are in seconds.
+        """
+        with self._lock:
+            return [
+                {
+                    'name':      name,
+                    'runs':      stats.durations.count,
+                    'errors':    stats.errors,
+                    'overruns':  stats.overruns,
+                    'coalesced': stats.coalesced,
+                    'last':      stats.last_duration,
+                    'max':       stats.max_duration,
+                    'p50':       stats.durations.quantile(0.50),
+                    'p95':       stats.durations.quantile(0.95),
+                    'active':    name in self._active,
+                } for name, stats in sorted(self.stats.items())
+            ]
+
+    def shutdown(self, wait:bool=True):
+        with self._lock:
+            self._pending.clear()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,155 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# leases.py
+
+import logging
+import os
+import socket
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Mod
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from .models import SchedulerLease
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE = 'leader'
+NODE_LEASE_PREFIX = 'node:'
+
+def acquire_lease(name:str, holder:str, ttl:float):
+    """
+    Acquire or renew a lease. A lease can only be acquired if it is not held or has expired.
+
+    Args:
+        name   (str):   name of the lease.
+        holder (str):   name of the node acquiring the lease.
+        ttl    (float): seconds until the lease expires unless renewed.
+
+    Returns:
+        datetime: the time the lease expires or None if the lease is held by another node.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl)
+
+    if SchedulerLease.objects.filter(Q(name=name) & (Q(holder=holder) | Q(expires_at__lt=now))).update(holder=holder, expires_at=expires_at):
+        return expires_at
+
+    try:
+        with transaction.atomic():
+            SchedulerLease.objects.create(name=name, holder=holder, expires_at=expires_at)
+        return expires_at
+    except IntegrityError:
+        return None
+
+def release_lease(name:str, holder:str):
+    SchedulerLease.objects.filter(name=name, holder=holder).delete()
+
+def filter_shard(queryset, shard:tuple, field:str='owner_id'):
+    """
+    Restrict a queryset to the objects of a shard. Objects are assigned to shards by their owner id modulo the number of
+    shards so all the objects of a client are handled by the same node.
+
+    Args:
+        queryset (QuerySet): the objects to filter.
+        shard    (tuple):    (index, count) of the shard or None for all objects.
+        field    (str):      name of the integer owner id field.
+    """
+    if shard is None or shard[1] <= 1:
+        return queryset
+
+    index, count = shard
+    return queryset.annotate(shard=Mod(field, count)).filter(shard=index)
+
+class SchedulerMembership:
+    """
+    Leader election and membership of the scheduler nodes sharing a database.
+
+    Every node holds a 'node:<name>' lease and at most one node holds the 'leader' lease. Leases expire after
+    SCHEDULER_LEASE_TTL (default 30) seconds unless renewed by heartbeat(), so a node that stops is replaced within one TTL.
+    Jobs that must run once per cluster only run on the leader. With SCHEDULER_SHARDING (default False) the event queue and
+    the garbage collector run on every node, each node handling the clients of its shard: (position of the node among the
+    live nodes sorted by name, number of live nodes).
+
+    Lease expiry relies on the clocks of the nodes being reasonably in sync (well within the TTL).
+
+    Attributes:
+        healthy (bool): False if the last heartbeat failed, in which case it is retried every tick of the scheduler.
+    """
+    def __init__(self, node:str=None, ttl:float=None, sharding:bool=None):
+        self.node = node or f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = ttl or getattr(settings, 'SCHEDULER_LEASE_TTL', 30)
+        self.sharding = getattr(settings, 'SCHEDULER_SHARDING', False) if sharding is None else sharding
+
+        self.shard = None
+        self.healthy = False
+        self._leader_until = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader_until is not None and timezone.now() < self._leader_until
+
+    def heartbeat(self) -> bool:
+        """
+        Renew the leases of this node, try to become leader and recompute the shard of this node. A database error does not
+        propagate: this node stops acting as leader and as a shard holder, and the heartbeat is retried on the next tick
+        (see healthy).
+
+        Returns:
+            bool: True if the leases were renewed.
+        """
+        was_leader = self.is_leader
+
+        try:
+            acquire_lease(name=f'{NODE_LEASE_PREFIX}{self.node}', holder=self.node, ttl=self.ttl)
+            self._leader_until = acquire_lease(name=LEADER_LEASE, holder=self.node, ttl=self.ttl)
+
+            nodes = sorted(SchedulerLease.objects.filter(name__startswith=NODE_LEASE_PREFIX, expires_at__gte=timezone.now()).values_list('holder', flat=True))
+            shard = (nodes.index(self.node), len(nodes),) if self.node in nodes else None
+        except DatabaseError as e:
+            logger.error(msg=_(f'Scheduler node {self.node} could not renew its leases, retrying: {e}'))
+            close_old_connections()
+            self._leader_until = None
+            shard = None
+            self.healthy = False
+        else:
+            self.healthy = True
+
+        if self.is_leader != was_leader:
+            logger.info(msg=_(f'Scheduler node {self.node} {"is now" if self.is_leader else "is no longer"} the leader.'))
+        if shard != self.shard:
+            logger.info(msg=_(f'Scheduler node {self.node} handles shard {shard}.'))
+
+        self.shard = shard
+        return self.healthy
+
+    def leave(self):
+        """
+        Release the leases of this node so the other nodes take over its work straight away. If the database cannot be
+        reached the leases are left to expire.
+        """
+        try:
+            release_lease(name=LEADER_LEASE, holder=self.node)
+            release_lease(name=f'{NODE_LEASE_PREFIX}{self.node}', holder=self.node)
+        except DatabaseError as e:
+            logger.error(msg=_(f'Scheduler node {self.node} could not release its leases: {e}'))
+            close_old_connections()
+        self._leader_until = None
+        self.shard = None
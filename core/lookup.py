@@ -0,0 +1,178 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# lookup.py
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import CharField, Value
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import OptionsIndex, Product, Warehause
+
+# Models scanners resolve values (barcodes and addresses) of, in the order their matches are returned
+LOOKUP_MODELS = (Product, Warehause,)
+
+# Options key whose values are looked up with the value field
+LOOKUP_OPTIONS_KEY = 'values'
+
+MATCHED_VALUE = 'value'
+MATCHED_OPTIONS = 'options'
+
+LOOKUP_FIELDS = ('id', 'key', 'value', 'dfn_id', 'status',)
+
+def find_objects(value:str, client_ids=None, limit:int=None) -> list:
+    """
+    Find the objects of every lookup model whose value, or one of whose options['values'], equals a value. All the models
+    are searched with one query through the (owner, value) index of each model, or its (value) index when every client's
+    objects are searched, and the OptionsIndex of options['values']. The indexes are B-tree indexes: they answer these
+    equality lookups like hash indexes would and, unlike them, exist on every supported database and serve the prefix
+    options filters too.
+
+    Args:
+        value      (str):       the value to look up.
+        client_ids (frozenset): ids of the clients whose objects are searched, or None to search every client's objects.
+        limit      (int):       most objects returned. Default is settings.API_LOOKUP_MAX_RESULTS (100).
+
+    Returns:
+        list: {'type', 'id', 'key', 'value', 'dfn', 'status', 'matched'} dictionaries, objects matched by value first.
+    """
+    limit = limit or getattr(settings, 'API_LOOKUP_MAX_RESULTS', 100)
+
+    parts = list()
+    for model in LOOKUP_MODELS:
+        objects = model.objects.all() if client_ids is None else model.objects.filter(owner_id__in=client_ids)
+        objects = objects.order_by().annotate(type=Value(model._meta.model_name, output_field=CharField()))
+
+        parts.append(objects.filter(value=value).annotate(matched=Value(MATCHED_VALUE, output_field=CharField())).values(*LOOKUP_FIELDS, 'type', 'matched'))
+
+        label = model._meta.label_lower
+        if LOOKUP_OPTIONS_KEY in OptionsIndex.registry.get(label, dict()):
+            ids = OptionsIndex.objects.filter(model=label, key=LOOKUP_OPTIONS_KEY, value=value).values('object_id')
+            parts.append(objects.filter(id__in=ids).annotate(matched=Value(MATCHED_OPTIONS, output_field=CharField())).values(*LOOKUP_FIELDS, 'type', 'matched'))
+
+    rows = parts[0].union(*parts[1:], all=True)[:limit] if len(parts) > 1 else parts[0][:limit]
+
+    # An object matched by both its value and its options['values'] is returned once, as matched by value
+    order = {model._meta.model_name: i for i, model in enumerate(LOOKUP_MODELS)}
+    rows = sorted(rows, key=lambda row: (order[row['type']], row['matched'] != MATCHED_VALUE))
+    results = OrderedDict()
+    for row in rows:
+        results.setdefault((row['type'], row['id']), {
+            'type':    row['type'],
+            'id':      row['id'],
+            'key':     row['key'],
+            'value':   row['value'],
+            'dfn':     row['dfn_id'],
+            'status':  row['status'],
+            'matched': row['matched'],
+        })
+    return list(results.values())
+
+class LookupCache:
+    """
+    Per process LRU cache of the objects found for the most recently looked up values. Entries expire after
+    LOOKUP_CACHE_TTL seconds and at most LOOKUP_CACHE_SIZE values are kept. Saving or deleting a product or warehause in
+    this process drops the cached values it matched or now matches straight away; changes made by other processes and bulk
+    updates are seen once the entries expire.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._by_object = dict()
+        self._by_value = dict()
+        self._lock = threading.Lock()
+
+    def _drop(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is None:
+            return
+        for result in entry[1]:
+            keys = self._by_object.get(result['id'])
+            if keys is not None:
+                keys.discard(cache_key)
+                if not keys:
+                    del self._by_object[result['id']]
+        keys = self._by_value.get(cache_key[1])
+        if keys is not None:
+            keys.discard(cache_key)
+            if not keys:
+                del self._by_value[cache_key[1]]
+
+    def get(self, value:str, client_ids=None) -> list:
+        """
+        Get the objects found for a value, from the cache or else with find_objects().
+        """
+        cache_key = (client_ids, value)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(cache_key)
+                return entry[1]
+
+        results = find_objects(value, client_ids=client_ids)
+
+        ttl = getattr(settings, 'LOOKUP_CACHE_TTL', 10)
+        if ttl:
+            with self._lock:
+                self._drop(cache_key)
+                self._entries[cache_key] = (now + ttl, results)
+                self._by_value.setdefault(value, set()).add(cache_key)
+                for result in results:
+                    self._by_object.setdefault(result['id'], set()).add(cache_key)
+                while len(self._entries) > getattr(settings, 'LOOKUP_CACHE_SIZE', 10000):
+                    self._drop(next(iter(self._entries)))
+
+        return results
+
+    def invalidate(self, object_id=None, values=()):
+        """
+        Drop the cached values that matched an object or that are one of values.
+        """
+        with self._lock:
+            keys = set(self._by_object.get(object_id, ()))
+            for value in values:
+                keys.update(self._by_value.get(value, ()))
+            for cache_key in keys:
+                self._drop(cache_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_object.clear()
+            self._by_value.clear()
+
+lookup_cache = LookupCache()
+
+def get_lookup_values(instance) -> list:
+    values = [instance.value]
+    options_values = instance.options.get(LOOKUP_OPTIONS_KEY) if isinstance(instance.options, dict) else None
+    if isinstance(options_values, (list, tuple)):
+        values.extend(str(value) for value in options_values if not isinstance(value, (dict, list)))
+    elif options_values is not None and not isinstance(options_values, dict):
+        values.append(str(options_values))
+    return values
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Warehause)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Warehause)
+def on_lookup_object_changed(sender, instance, **kwargs):
+    lookup_cache.invalidate(object_id=instance.id, values=get_lookup_values(instance))
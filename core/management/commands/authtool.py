@@ -53,6 +53,8 @@ class Command(BaseCommand):
         update_parser.add_argument('-e', '--email', type=str, help=_('Update user\'s email address.'))
         update_parser.add_argument('-t', '--token', type=self.str_to_bool, nargs='?', const=True, default=None, help=_('If False delete the User\s Auth Token, if True then create the Auth Token (if it does not exist) and display it.'))
         update_parser.add_argument('-n', '--name', type=str, nargs='?', help=_('Update client\'s group name.'))
+        update_parser.add_argument('-w', '--weight', type=float, help=_('Update client\'s share of the batched event processing capacity relative to other clients.'))
+        update_parser.add_argument('-m', '--max_events', type=int, help=_('Update the maximum number of client\'s batched events processing at the same time. Use 0 for no limit.'))
         update_parser.set_defaults(func=self._handle_client_update)
 
     def _add_user_subparser(self, parser):
@@ -187,6 +189,18 @@ class Command(BaseCommand):
                 if name is not None:
                     client.group.name = name
                 client.group.save()
+
+                weight = options.get('weight')
+                if weight is not None:
+                    if weight <= 0.0:
+                        raise ValueError(_('Weight must be a positive value.'))
+                    client.weight = weight
+
+                max_events = options.get('max_events')
+                if max_events is not None:
+                    client.max_events = max_events if max_events > 0 else None
+                client.save()
+
                 self._display_client(client)
         except Client.DoesNotExist:
             self._output_err(_(f'Client \'{clientname}\' does not exist.'))
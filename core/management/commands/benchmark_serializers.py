@@ -0,0 +1,79 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# benchmark_serializers.py
+
+import time
+
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.crypto import get_random_string
+from django.utils.translation import gettext as _
+
+from rest_framework.renderers import JSONRenderer
+
+from ...models import Client, Product, ProductDef, WarehauseDef
+from ...plans import FieldPlan
+from ...renderers import WarehauserJSONRenderer, orjson
+from ...serializers import ProductSerializer
+
+class Command(BaseCommand):
+    help = _('Compare the throughput of the product serializer with the product field plan and JSON renderers. Test products are created in a transaction that is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--count', type=int, default=10000, help=_('Number of products to serialize (default 10000).'))
+        parser.add_argument('-r', '--repeat', type=int, default=3, help=_('Number of runs of each benchmark, the best run is reported (default 3).'))
+
+    def _best(self, func, repeat:int) -> float:
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def handle(self, *args, **options):
+        count = options.get('count')
+        repeat = options.get('repeat')
+
+        with transaction.atomic():
+            owner = Client.objects.create(group=Group.objects.create(name=f'benchmark-{get_random_string(8)}'))
+            bin = WarehauseDef.objects.create(key='Bin', is_storage=True, owner=owner).create_instance(data={'value': 'A01-01-01', 'owner': owner})
+            dfn = ProductDef.objects.create(key='Chocolate Bar', code_count=1, weight=0.2, owner=owner)
+            Product.objects.bulk_create([
+                Product(dfn=dfn, warehause=bin, owner=owner, key=dfn.key, value=f'Chocolate Bar {i}', code_count=1, weight=0.2, quantity=1.0, options={'batch': f'B{i % 100}'},)
+                for i in range(count)
+            ], batch_size=1000)
+
+            queryset = Product.objects.filter(owner=owner).select_related('parent', 'dfn', 'warehause').order_by('created_at', 'id')
+            plan = FieldPlan.get(ProductSerializer)
+
+            benchmarks = [
+                ('serializer',                 lambda: ProductSerializer(queryset.all(), many=True).data),
+                ('field plan',                 lambda: plan.render(plan.values(queryset.all()))),
+                ('serializer + json',          lambda: JSONRenderer().render(ProductSerializer(queryset.all(), many=True).data)),
+                ('field plan + json',          lambda: JSONRenderer().render(plan.render(plan.values(queryset.all())))),
+            ]
+            if orjson is not None:
+                benchmarks.append(('field plan + orjson', lambda: WarehauserJSONRenderer().render(plan.render(plan.values(queryset.all())))))
+            else:
+                self.stdout.write(_('orjson is not installed, skipping the orjson renderer.'))
+
+            for name, func in benchmarks:
+                elapsed = self._best(func, repeat=repeat)
+                self.stdout.write(f'{name:<24} {elapsed:8.3f}s {count / elapsed:12.0f} products/s')
+
+            transaction.set_rollback(True)
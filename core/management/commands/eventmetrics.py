@@ -0,0 +1,101 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# eventmetrics.py
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...fairqueue import get_queue_depths
+from ...models import Client, EventMetric
+
+ORDER_CHOICES = ['run', 'wait', 'count',]
+
+class Command(BaseCommand):
+    help = _('Report event processing latency and throughput per client and proc_name.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--clientname', type=str, help=_('Only report events owned by this client.'))
+        parser.add_argument('-o', '--order', type=str, choices=ORDER_CHOICES, default='run', help=_('Order by total run time, total queue wait or number of events (default run).'))
+        parser.add_argument('-r', '--reset', action='store_true', help=_('Delete the reported metrics after reporting them.'))
+        parser.add_argument('-q', '--queues', action='store_true', help=_('Report the batched event queue depth per client instead.'))
+
+    def handle(self, *args, **options):
+        clientname = options.get('clientname')
+        order = options.get('order')
+
+        if options.get('queues'):
+            self._handle_queues(clientname=clientname)
+            return
+
+        metrics = EventMetric.objects.select_related('owner__group')
+        if clientname:
+            metrics = metrics.filter(owner__group__name=clientname)
+
+        rows = []
+        for metric in metrics:
+            wait = metric.get_wait()
+            run = metric.get_run()
+            rows.append({
+                'client':    metric.owner.group.name,
+                'proc_name': str(metric.proc_name),
+                'count':     sum(metric.outcomes.values()),
+                'wait':      wait,
+                'run':       run,
+                'outcomes':  ', '.join(f'{k}={v}' for k, v in sorted(metric.outcomes.items())),
+            })
+
+        if not rows:
+            self.stdout.write(_('No event metrics found.'))
+            return
+
+        if order == 'count':
+            rows.sort(key=lambda row: row['count'], reverse=True)
+        else:
+            rows.sort(key=lambda row: row[order].sum, reverse=True)
+
+        header = f'{_("Client"):20} {_("Proc Name"):40} {_("Count"):>8} {_("Wait p50"):>9} {_("Wait p95"):>9} {_("Wait Sum"):>10} {_("Run p50"):>9} {_("Run p95"):>9} {_("Run Sum"):>10}  {_("Outcomes")}'
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for row in rows:
+            self.stdout.write(
+                f'{row["client"][:20]:20} {row["proc_name"][:40]:40} {row["count"]:>8} '
+                f'{self._seconds(row["wait"].quantile(0.50)):>9} {self._seconds(row["wait"].quantile(0.95)):>9} {self._seconds(row["wait"].sum):>10} '
+                f'{self._seconds(row["run"].quantile(0.50)):>9} {self._seconds(row["run"].quantile(0.95)):>9} {self._seconds(row["run"].sum):>10}  '
+                f'{row["outcomes"]}'
+            )
+
+        if options.get('reset'):
+            metrics.delete()
+            self.stdout.write(self.style.SUCCESS(_('Event metrics reset.')))
+
+    def _handle_queues(self, clientname:str):
+        clients = Client.objects.select_related('group')
+        if clientname:
+            clients = clients.filter(group__name=clientname)
+
+        names = {client.id: client.group.name for client in clients}
+
+        header = f'{_("Client"):20} {_("Weight"):>8} {_("Max Events"):>10} {_("Queued"):>10} {_("Running"):>10}'
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for depth in get_queue_depths(clients):
+            max_events = '-' if depth['max_events'] is None else depth['max_events']
+            self.stdout.write(f'{names[depth["owner"]][:20]:20} {depth["weight"]:>8} {max_events:>10} {depth["queued"]:>10} {depth["running"]:>10}')
+
+    @staticmethod
+    def _seconds(value):
+        if value is None:
+            return '-'
+        return f'{value:.3f}s'
@@ -0,0 +1,51 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# rebuild_search_index.py
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.translation import gettext as _
+
+from ...models import SEARCHABLE_MODELS, OptionsIndex, SearchIndex
+from ...search import create_search_index
+
+class Command(BaseCommand):
+    help = _('Index the id, key, value, external_id and options[\'values\'] of every object for API searches and the registered options keys for the options filters, and recreate the full text index of the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=2000, help=_('Number of objects indexed per query (default 2000).'))
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+
+        with transaction.atomic():
+            SearchIndex.objects.all().delete()
+            OptionsIndex.objects.all().delete()
+            for model in SEARCHABLE_MODELS:
+                count = 0
+                batch = list()
+                for instance in model.objects.only('id', *[field for field in SearchIndex.indexed_fields if hasattr(model, field)]).iterator(chunk_size=batch_size):
+                    batch.append(instance)
+                    if len(batch) >= batch_size:
+                        SearchIndex.index_objects(batch)
+                        OptionsIndex.index_objects(batch)
+                        count += len(batch)
+                        batch = list()
+                SearchIndex.index_objects(batch)
+                OptionsIndex.index_objects(batch)
+                count += len(batch)
+                self.stdout.write(_(f'Indexed {count} {model._meta.verbose_name_plural}.'))
+
+        create_search_index()
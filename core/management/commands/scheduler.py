@@ -0,0 +1,115 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# scheduler.py
+
+import logging
+import schedule
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...jobs import JobExecutor
+from ...leases import SchedulerMembership
+from ...wakeup import EventWakeupListener
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = _('Run the warehauser background jobs (event queue, emails, garbage collection, archiving, metrics and reports).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, help=_('Number of worker threads running jobs (default settings.SCHEDULER_WORKERS or 4).'))
+        parser.add_argument('-n', '--no-coalesce', action='store_true', help=_('Skip a job that is due while its previous run is still active instead of running it once more when that run finishes.'))
+        parser.add_argument('-N', '--node', type=str, help=_('Unique name of this scheduler node (default <hostname>:<pid>).'))
+        parser.add_argument('-s', '--sharding', action='store_true', help=_('Share the event queue and garbage collector between all scheduler nodes by client (default settings.SCHEDULER_SHARDING).'))
+        parser.add_argument('-r', '--report', type=int, default=10, help=_('Minutes between job statistics reports (default 10, 0 for none).'))
+
+    def handle(self, *args, **options):
+        from warehauser import tasks
+
+        executor = JobExecutor(workers=options.get('workers'), coalesce=False if options.get('no_coalesce') else None)
+        membership = SchedulerMembership(node=options.get('node'), sharding=True if options.get('sharding') else None)
+
+        def node_job(name, task_class):
+            # Runs on every node
+            return lambda: executor.submit(name, task_class())
+
+        def leader_job(name, task_class):
+            # Runs on the leader node only
+            def submit():
+                if membership.is_leader:
+                    executor.submit(name, task_class())
+            return submit
+
+        def sharded_job(name, task_class):
+            # Runs on every node for the clients of its shard when sharding, else on the leader node only
+            def submit():
+                shard = membership.shard
+                if membership.sharding and shard is not None:
+                    executor.submit(name, task_class(shard=shard))
+                elif not membership.sharding and membership.is_leader:
+                    executor.submit(name, task_class())
+            return submit
+
+        membership.heartbeat()
+
+        scheduler = schedule.Scheduler()
+        scheduler.every(max(int(membership.ttl // 3), 1)).seconds.do(membership.heartbeat)
+        scheduler.every().day.at('00:00').do(leader_job('archiver', tasks.ArchiverTask))
+        scheduler.every().day.at('17:00').do(leader_job('reports', tasks.GenerateReportsTask))
+        scheduler.every(1).minutes.do(sharded_job('garbagecollector', tasks.GarbageCollectorTask))
+        scheduler.every(1).minutes.do(node_job('eventmetrics', tasks.EventMetricsTask))
+        scheduler.every(1).minutes.do(sharded_job('eventreaper', tasks.EventReaperTask))
+        scheduler.every(10).seconds.do(sharded_job('eventqueue', tasks.EventQueueTask))  # fallback if no wakeup arrives
+        scheduler.every(10).seconds.do(leader_job('email', tasks.EmailTask))
+
+        # Run the event queue as soon as a batched event is ready instead of waiting for the next poll
+        listener = EventWakeupListener(callback=sharded_job('eventqueue', tasks.EventQueueTask))
+        listener.start()
+
+        if options.get('report'):
+            scheduler.every(options.get('report')).minutes.do(lambda: self._report(executor))
+
+        self.stdout.write(_(f'Scheduler node {membership.node} started with {executor.workers} worker(s).'))
+
+        try:
+            while True:
+                if not membership.healthy:
+                    # The last heartbeat hit a database error, retry it every tick until the leases are renewed
+                    membership.heartbeat()
+                scheduler.run_pending()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            scheduler.clear()
+        finally:
+            listener.stop()
+            executor.shutdown(wait=True)
+            membership.leave()
+            self._report(executor)
+
+    def _report(self, executor:JobExecutor):
+        for job in executor.report():
+            logger.info(msg=_(
+                f'Job {job["name"]}: runs={job["runs"]} errors={job["errors"]} overruns={job["overruns"]} coalesced={job["coalesced"]} '
+                f'last={self._seconds(job["last"])} p50={self._seconds(job["p50"])} p95={self._seconds(job["p95"])} max={self._seconds(job["max"])}'
+                f'{" (active)" if job["active"] else ""}'
+            ), extra={'job': job})
+
+    @staticmethod
+    def _seconds(value):
+        if value is None:
+            return '-'
+        return f'{value:.3f}s'
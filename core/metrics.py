@@ -0,0 +1,194 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# metrics.py
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .status import EVENT_STATUS_CODES
+
+# Upper bounds (in seconds) of the histogram buckets. The last bucket catches everything above the largest bound.
+HISTOGRAM_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0,]
+
+OUTCOME_ERROR = 'error'
+
+EVENT_STATUS_NAMES = {code: name.lower().replace(' ', '_') for code, name in EVENT_STATUS_CODES}
+
+class Histogram:
+    """
+    Fixed bucket histogram of durations in seconds.
+
+    Attributes:
+        counts (list):  number of observations per bucket of HISTOGRAM_BUCKETS plus one overflow bucket.
+        sum    (float): sum of all observed values.
+        count  (int):   number of observations.
+    """
+    def __init__(self, data:dict=None):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = float(0.0)
+        self.count = 0
+
+        if data:
+            self.merge(data)
+
+    def observe(self, value:float):
+        index = len(HISTOGRAM_BUCKETS)
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                index = i
+                break
+
+        self.counts[index] = self.counts[index] + 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def merge(self, other):
+        """
+        Add the observations of another Histogram (or its as_dict() representation) to this Histogram.
+        """
+        if isinstance(other, Histogram):
+            other = other.as_dict()
+
+        for i, count in enumerate(other.get('counts', [])[:len(self.counts)]):
+            self.counts[i] = self.counts[i] + count
+        self.sum = self.sum + other.get('sum', 0.0)
+        self.count = self.count + other.get('count', 0)
+
+    def quantile(self, q:float):
+        """
+        Estimate a quantile of the observed values.
+
+        Args:
+            q (float): the quantile to estimate between 0.0 and 1.0.
+
+        Returns:
+            float: the upper bound of the bucket containing the quantile or None if there are no observations. The overflow
+                   bucket reports the largest bound.
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= rank and count:
+                return HISTOGRAM_BUCKETS[min(i, len(HISTOGRAM_BUCKETS) - 1)]
+
+        return HISTOGRAM_BUCKETS[-1]
+
+    def as_dict(self) -> dict:
+        return {
+            'counts': list(self.counts),
+            'sum':    self.sum,
+            'count':  self.count,
+        }
+
+class EventMetrics:
+    """
+    Thread safe in process accumulator of event processing metrics keyed by (owner id, proc_name). Workers observe() every
+    processed event and periodically flush() the accumulated values into the EventMetric table where they are shared with
+    the API and the eventmetrics management command. Processes that have no scheduler flushing for them (the web workers
+    processing events inline) call flush_due() after observing events instead.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._last_flush = time.monotonic()
+
+    def _get_entry(self, key:tuple) -> dict:
+        # Call with the lock held
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = {'wait': Histogram(), 'run': Histogram(), 'outcomes': dict()}
+            self._pending[key] = entry
+        return entry
+
+    def observe(self, event, err:Exception=None):
+        """
+        Record the queue wait, run time and outcome of a processed event.
+
+        Args:
+            event (Event):     the processed event.
+            err   (Exception): the exception raised while processing the event, if any.
+        """
+        outcome = OUTCOME_ERROR if err is not None else EVENT_STATUS_NAMES.get(event.status, str(event.status))
+
+        with self._lock:
+            entry = self._get_entry((event.owner_id, event.proc_name))
+
+            if event.proc_start is not None:
+                entry['wait'].observe(max((event.proc_start - event.created_at).total_seconds(), 0.0))
+                if event.proc_end is not None:
+                    entry['run'].observe(max((event.proc_end - event.proc_start).total_seconds(), 0.0))
+
+            entry['outcomes'][outcome] = entry['outcomes'].get(outcome, 0) + 1
+
+    def _restore(self, pending:dict):
+        # Put observations that were not written back into the pending observations
+        with self._lock:
+            for key, entry in pending.items():
+                restored = self._get_entry(key)
+                restored['wait'].merge(entry['wait'])
+                restored['run'].merge(entry['run'])
+                for outcome, count in entry['outcomes'].items():
+                    restored['outcomes'][outcome] = restored['outcomes'].get(outcome, 0) + count
+
+    def flush(self):
+        """
+        Merge all pending observations into the EventMetric table. Observations are only cleared once the transaction
+        writing them has committed, the observations of a failed write are kept for the next flush.
+        """
+        from .models import EventMetric
+
+        with self._lock:
+            pending = self._pending
+            self._pending = dict()
+            self._last_flush = time.monotonic()
+
+        while pending:
+            key, entry = next(iter(pending.items()))
+            owner_id, proc_name = key
+            try:
+                with transaction.atomic():
+                    metric, created = EventMetric.objects.select_for_update().get_or_create(owner_id=owner_id, proc_name=proc_name)
+                    metric.merge(wait=entry['wait'], run=entry['run'], outcomes=entry['outcomes'])
+                    metric.save()
+            except BaseException:
+                self._restore(pending)
+                raise
+            del pending[key]
+
+    def flush_due(self):
+        """
+        flush() if EVENT_METRICS_FLUSH_INTERVAL (default 60) seconds have passed since the last flush. Failures are logged
+        and the observations kept for the next flush.
+        """
+        interval = getattr(settings, 'EVENT_METRICS_FLUSH_INTERVAL', 60)
+        with self._lock:
+            if not self._pending or time.monotonic() - self._last_flush < interval:
+                return
+            self._last_flush = time.monotonic()
+
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error(f'[{self.__class__.__name__}]: Failed flushing event metrics: {e}')
+
+event_metrics = EventMetrics()
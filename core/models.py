@@ -14,34 +14,71 @@
 
 # models.py
 
+import contextvars
+import copy
 import importlib
+import inspect
 import logging
+import re
 import uuid
 import json, pprint
 
 from collections.abc import Mapping
 from typing import Optional, Union
 
+from asgiref.sync import async_to_sync, sync_to_async
 from db_mutex.db_mutex import db_mutex
 
-from django.db import models
-from django.db.models import ForeignKey, QuerySet
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, ForeignKey, Q, QuerySet
 from django.db.models.fields.related import ManyToOneRel
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.core.mail import EmailMessage
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from .callbacks import ModelCallback, WarehauseCallback, ProductCallback, EventCallback
+from .metrics import Histogram
 from .status import *
-from .utils import WarehauserError, WarehauserErrorCodes
+from .utils import WarehauserError, WarehauserErrorCodes, dict_copy_and_update, dict_recursive_update
+from .wakeup import notify_event_queue
 
 try:
     CHARFIELD_MAX_LENGTH = settings.CHARFIELD_MAX_LENGTH
 except Exception as e:
     CHARFIELD_MAX_LENGTH = 1024
 
+# Ids of the objects being deleted by WarehauserAbstractModel.delete_objects(). It removes their search and options index
+# rows itself and Product.bulk_delete() journals their stock, so the post_delete receivers skip them
+_bulk_deleted_ids = contextvars.ContextVar('bulk_deleted_ids', default=frozenset())
+
+def is_bulk_deleted(instance) -> bool:
+    """
+    Check whether an object is being deleted by WarehauserAbstractModel.delete_objects().
+    """
+    return instance.id in _bulk_deleted_ids.get()
+
+# Placeholders of a dedup_key template: {{ and }} are literal braces, {name} is substituted
+DEDUP_KEY_PLACEHOLDER = re.compile(r'\{\{|\}\}|\{([^{}]*)\}')
+DEDUP_KEY_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z0-9_-]+)?')
+
+# Rules for merging the options of a coalesced event into the OPEN event with the same dedup_key
+DEDUP_RULE_UPDATE  = 'update'  # shallow update of the existing options with the new options
+DEDUP_RULE_DEEP    = 'deep'    # recursive update of the existing options with the new options
+DEDUP_RULE_APPEND  = 'append'  # like update, but list values are concatenated
+DEDUP_RULE_REPLACE = 'replace' # the new options replace the existing options
+DEDUP_RULE_KEEP    = 'keep'    # the new options are discarded
+
+DEDUP_RULES = (
+    (DEDUP_RULE_UPDATE,  'Update'),
+    (DEDUP_RULE_DEEP,    'Deep Update'),
+    (DEDUP_RULE_APPEND,  'Append'),
+    (DEDUP_RULE_REPLACE, 'Replace'),
+    (DEDUP_RULE_KEEP,    'Keep'),
+)
+
 logger = logging.getLogger(__name__)
 
 class WarehauserAbstractModel(models.Model):
@@ -118,6 +155,11 @@ class WarehauserAbstractModel(models.Model):
         """
         Overridde super().save(). If this model object has been saved the updated_at field is updated to the current date and time.
         """
+        if not self._state.adding:
+            self.updated_at = timezone.now()
+            if kwargs.get('update_fields') is not None and 'updated_at' not in kwargs['update_fields']:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + ['updated_at']
+
         if self.callback is not None:
             if hasattr(self.callback, 'pre_save') and callable(self.callback.pre_save):
                 self.callback.pre_save(model=self)
@@ -133,6 +175,56 @@ class WarehauserAbstractModel(models.Model):
                 if hasattr(self.callback, 'post_save') and callable(self.callback.post_save):
                     self.callback.post_save(model=self, err=err)
 
+    @classmethod
+    def bulk_save(cls, instances:list, fields:list, batch_size:int=None):
+        """
+        Save changes to existing objects of this model with QuerySet.bulk_update(). Models whose save() does more than write
+        the row override this to do the same for all the objects.
+
+        Args:
+            instances  (list): the changed objects.
+            fields     (list): names of the fields to write.
+            batch_size (int):  number of objects updated per query or None for all at once.
+        """
+        cls.objects.bulk_update(instances, fields, batch_size=batch_size)
+
+        # bulk_update() sends no post_save signal so the search and options indexes are written here
+        if set(fields) & set(SearchIndex.indexed_fields):
+            SearchIndex.index_objects(instances, batch_size=batch_size)
+        if 'options' in fields:
+            OptionsIndex.index_objects(instances, batch_size=batch_size)
+
+    @classmethod
+    def bulk_delete(cls, instances:list):
+        """
+        Delete objects of this model with one QuerySet.delete(). Models whose delete() does more than delete the row override
+        this to do the same for all the objects.
+        """
+        logger.info(_(f'Deleting {len(instances)} {cls.__name__} object(s).'))
+        cls.delete_objects([instance.id for instance in instances])
+
+    @classmethod
+    def delete_objects(cls, ids:list):
+        """
+        Delete objects of this model with one QuerySet.delete() and remove their search and options index rows with one
+        query per index instead of one query per object from the post_delete receivers. Objects deleted by cascade are
+        still removed from the indexes by the receivers.
+
+        Args:
+            ids (list): ids of the objects.
+
+        Returns:
+            tuple: the result of QuerySet.delete().
+        """
+        token = _bulk_deleted_ids.set(_bulk_deleted_ids.get() | frozenset(ids))
+        try:
+            with transaction.atomic():
+                SearchIndex.unindex_objects(cls, ids)
+                OptionsIndex.unindex_objects(cls, ids)
+                return cls.objects.filter(id__in=ids).delete()
+        finally:
+            _bulk_deleted_ids.reset(token)
+
     def delete(self, *args, **kwargs):
         """
         Override super().delete() to log pending message(s) before the object is deleted.
@@ -460,6 +552,9 @@ class WarehauseDef(WarehauserAbstractDefinitionModel, WarehauseFields):
         abstract = False
         verbose_name = 'warehausedef'
         verbose_name_plural = 'warehausedefs'
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='warehausedef_created_id'),
+        ]
 
 class Warehause(WarehauserAbstractInstanceModel, WarehauseFields):
     """
@@ -684,6 +779,11 @@ class Warehause(WarehauserAbstractInstanceModel, WarehauseFields):
         abstract = False
         verbose_name = 'warehause'
         verbose_name_plural = 'warehauses'
+        indexes = [
+            models.Index(fields=['owner', 'value'], name='warehause_owner_value'),
+            models.Index(fields=['value'], name='warehause_value'),
+            models.Index(fields=['created_at', 'id'], name='warehause_created_id'),
+        ]
 
 
 # PRODUCT Models
@@ -749,6 +849,9 @@ class ProductDef(WarehauserAbstractDefinitionModel, ProductFields):
         abstract = False
         verbose_name = 'productdef'
         verbose_name_plural = 'productdefs'
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='productdef_created_id'),
+        ]
 
 class Product(WarehauserAbstractInstanceModel, ProductFields):
     """
@@ -777,6 +880,84 @@ class Product(WarehauserAbstractInstanceModel, ProductFields):
     expires     = models.DateField(null=True, blank=True, default=None,)
     is_damaged  = models.BooleanField(null=False, blank=False, default=False,)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stock = instance._get_stock()
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Override super().save() to journal the change of stock in the StockMovement table.
+        """
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._journal_stock(stock=self._get_stock())
+
+    def delete(self, *args, **kwargs):
+        """
+        Override super().delete() to journal the removal of stock in the StockMovement table.
+        """
+        with transaction.atomic():
+            product_id = self.id
+            super().delete(*args, **kwargs)
+            self._journal_stock(stock=None, product_id=product_id)
+
+    @classmethod
+    def bulk_save(cls, instances:list, fields:list, batch_size:int=None):
+        """
+        Override WarehauserAbstractModel.bulk_save() to journal the change of stock of all the products in one insert.
+        """
+        with transaction.atomic():
+            super().bulk_save(instances, fields, batch_size=batch_size)
+            StockMovement.objects.bulk_create([
+                movement for instance in instances for movement in instance._get_stock_movements(stock=instance._get_stock())
+            ], batch_size=batch_size)
+
+    @classmethod
+    def bulk_delete(cls, instances:list):
+        """
+        Override WarehauserAbstractModel.bulk_delete() to journal the removal of stock of all the products in one insert.
+        """
+        with transaction.atomic():
+            movements = [movement for instance in instances for movement in instance._get_stock_movements(stock=None)]
+            super().bulk_delete(instances)
+            StockMovement.objects.bulk_create(movements)
+
+    def _get_stock(self):
+        """
+        Get the (warehause id, quantity) this product adds to stock levels, or None if it does not count as stock.
+        """
+        if self.status == STATUS_DESTROY or self.warehause_id is None:
+            return None
+        return (self.warehause_id, float(self.quantity),)
+
+    def _get_stock_movements(self, stock, product_id=None) -> list:
+        """
+        Get the StockMovement objects that take stock levels from this product's previous stock to stock.
+        """
+        previous = getattr(self, '_stock', None)
+        self._stock = stock
+        if previous == stock:
+            return []
+
+        movement = {'owner_id': self.owner_id, 'product_id': product_id or self.id, 'dfn_id': self.dfn_id}
+        movements = []
+        if previous is not None and stock is not None and previous[0] == stock[0]:
+            movements.append(StockMovement(warehause_id=stock[0], quantity=stock[1] - previous[1], **movement))
+        else:
+            if previous is not None:
+                movements.append(StockMovement(warehause_id=previous[0], quantity=-previous[1], **movement))
+            if stock is not None:
+                movements.append(StockMovement(warehause_id=stock[0], quantity=stock[1], **movement))
+
+        return movements
+
+    def _journal_stock(self, stock, product_id=None):
+        movements = self._get_stock_movements(stock=stock, product_id=product_id)
+        if movements:
+            StockMovement.objects.bulk_create(movements)
+
     def total_weight(self) -> float:
         """
         Get the total weight of this Product object.
@@ -934,6 +1115,11 @@ class Product(WarehauserAbstractInstanceModel, ProductFields):
         abstract = False
         verbose_name = 'product'
         verbose_name_plural = 'products'
+        indexes = [
+            models.Index(fields=['owner', 'value'], name='product_owner_value'),
+            models.Index(fields=['value'], name='product_value'),
+            models.Index(fields=['created_at', 'id'], name='product_created_id'),
+        ]
 
 
 # EVENT Models
@@ -945,9 +1131,22 @@ class EventFields(models.Model):
     Attributes:
         is_batched (bool):  True if this event is processed by the batch processor, else processed on creation. Default is False.
         proc_name  (str):   process name (name of module.function) that this event will process or None if this event has no process.
+        timeout    (float): wall clock time in seconds the batch processor allows the process to run before it is killed and the event is set to
+                            STATUS_FAILED. None means settings.EVENT_DEFAULT_TIMEOUT is used (no limit if that is None too).
+        dedup_key  (str):   optional deduplication key. A new batched event with the same dedup_key as an OPEN event of the same owner is
+                            coalesced into that event instead of being created. On an EventDef this is a template whose {name}
+                            placeholders are replaced by the new event's fields and {options.name} placeholders by its options, e.g.
+                            'recount:{options.bin}'. Only plain values are substituted. None means events are never coalesced.
+        dedup_rule (str):   how the options of a coalesced event are merged into the OPEN event. One of DEDUP_RULES. Default is 'update'.
+        join_name  (str):   process name run once all the child events spawned by this event's process have closed. If None the event is
+                            closed once all its child events have closed.
     """
     is_batched  = models.BooleanField(null=False, blank=False, default=False,)
     proc_name   = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True,)
+    timeout     = models.FloatField(null=True, blank=True, default=None,)
+    dedup_key   = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True, default=None,)
+    dedup_rule  = models.CharField(max_length=16, choices=DEDUP_RULES, null=False, blank=False, default=DEDUP_RULE_UPDATE,)
+    join_name   = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True, default=None,)
 
     class Meta:
         abstract = True
@@ -970,17 +1169,88 @@ class EventDef(WarehauserAbstractDefinitionModel, EventFields):
     """
     owner       = models.ForeignKey('Client', on_delete=models.CASCADE, related_name='eventdefs', null=False, blank=False,)
 
+    def _get_dedup_key_context(self, data:dict) -> dict:
+        # Flat dictionary of the plain values a dedup_key template may refer to
+        context = dict()
+        for name, value in data.items():
+            if name != 'dedup_key' and isinstance(value, (str, int, float, uuid.UUID)):
+                context[name] = value
+        for name, value in dict_copy_and_update(self.options, data.get('options')).items():
+            if isinstance(value, (str, int, float, uuid.UUID)):
+                context[f'options.{name}'] = value
+        return context
+
+    def _get_dedup_key(self, data:dict):
+        """
+        Render the dedup_key template of this definition for a new batched event. The template cannot be replaced by the
+        new event's data.
+
+        Returns:
+            str: the rendered dedup_key or None if the new event is not batched or this definition has no dedup_key.
+        """
+        if not data.get('is_batched', self.is_batched):
+            return None
+
+        template = self.dedup_key
+        if template is None:
+            return None
+
+        context = self._get_dedup_key_context(data=data)
+
+        def substitute(match):
+            if match.group(0) in ('{{', '}}',):
+                return match.group(0)[0]
+            name = match.group(1)
+            if not DEDUP_KEY_NAME.fullmatch(name) or name not in context:
+                raise WarehauserError(msg=_(f'Unable to render dedup_key \'{template}\': unknown placeholder \'{{{name}}}\'.'), code=WarehauserErrorCodes.BAD_PARAMETER, extra={'self': self, 'placeholder': name})
+            return str(context[name])
+
+        return DEDUP_KEY_PLACEHOLDER.sub(substitute, str(template))
+
     def create_instance(self, data:dict = None, callback:ModelCallback = None, save:bool = True):
+        """
+        Create an instance of this definition. If the new event is batched and has a dedup_key matching an OPEN event of
+        the same owner then the new event is coalesced into the OPEN event, which is returned instead.
+        """
         if not isinstance(callback, EventCallback):
             callback = EventCallback()
-        event:Event = super()._create_instance(clazz=Event, data=data, callback=callback, save=save)
 
-        return event
+        data = dict(data) if data else dict()
+        dedup_key = self._get_dedup_key(data=data)
+        data['dedup_key'] = dedup_key
+
+        if dedup_key is None:
+            return super()._create_instance(clazz=Event, data=data, callback=callback, save=save)
+
+        owner = data.get('owner', self.owner)
+        owner_id = owner.id if isinstance(owner, Client) else owner
+
+        # The unique_open_dedup_key_in_event constraint makes this atomic. If another process inserts the same dedup_key
+        # first then coalesce into its event instead.
+        for attempt in range(3):
+            with transaction.atomic():
+                event:Event = Event.objects.select_for_update().filter(owner_id=owner_id, dedup_key=dedup_key, status=STATUS_OPEN).first()
+                if event is not None:
+                    event.callback = callback
+                    event.coalesce(data=data)
+                    event.save()
+                    return event
+
+            try:
+                with transaction.atomic():
+                    return super()._create_instance(clazz=Event, data=data, callback=callback, save=save)
+            except IntegrityError as e:
+                continue
+
+        raise WarehauserError(msg=_(f'Unable to coalesce event with dedup_key \'{dedup_key}\'.'), code=WarehauserErrorCodes.BAD_PARAMETER, extra={'self': self, 'dedup_key': dedup_key})
 
     class Meta(WarehauserAbstractDefinitionModel.Meta):
         abstract = False
         verbose_name = 'eventdef'
         verbose_name_plural = 'eventdefs'
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='eventdef_created_id'),
+        ]
 
 class Event(WarehauserAbstractInstanceModel, EventFields):
     """
@@ -995,6 +1265,14 @@ class Event(WarehauserAbstractInstanceModel, EventFields):
         user       (User):      user this event is assigned to.
         proc_start (DateTime):  timestamp this event started processing.
         proc_end   (DateTime):  timestamp this event ended processing.
+        pending_children (int): number of child events that have not yet closed. A batched event is only processed once this is 0.
+
+    Child events form workflows. Child events are processed in parallel and their parent is only processed once they have all
+    closed (STATUS_CLOSED or STATUS_DESTROY):
+
+        * A batched parent created with its children in the same transaction runs its proc_name once all children have closed.
+        * A parent whose process spawns children (and leaves its status as STATUS_PROCESSING) is put ON_HOLD until all children
+          have closed. It then runs its join_name, or is closed if it has none.
     """
     owner       = models.ForeignKey('Client', on_delete=models.CASCADE, related_name='events', null=False, blank=False,)
     parent      = models.ForeignKey('self', on_delete=models.CASCADE, related_name='children', null=True, blank=True,)
@@ -1007,33 +1285,258 @@ class Event(WarehauserAbstractInstanceModel, EventFields):
     proc_start  = models.DateTimeField(auto_now_add=False, null=True, blank=True, editable=False,)
     proc_end    = models.DateTimeField(auto_now_add=False, null=True, blank=True, editable=False,)
 
-    def process(self):
+    pending_children = models.IntegerField(null=False, blank=False, default=0, editable=False,)
+
+    def save(self, *args, **kwargs):
+        """
+        Override super().save() to maintain the pending_children counter of the parent event. pending_children of this event
+        is only ever changed by atomic updates and is never written by save().
+        """
+        with transaction.atomic():
+            if self._state.adding:
+                super().save(*args, **kwargs)
+                if self.parent_id is not None and self.status not in EVENT_CLOSED_STATUSES:
+                    Event.objects.filter(id=self.parent_id).update(pending_children=F('pending_children') + 1, updated_at=timezone.now())
+                if self.is_batched and self.status == STATUS_OPEN:
+                    transaction.on_commit(notify_event_queue)
+                return
+
+            if kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+                kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'pending_children']
+
+            # Claim the transition to a closed status so the parent is only released once
+            closed = False
+            if self.parent_id is not None and self.status in EVENT_CLOSED_STATUSES:
+                closed = Event.objects.filter(id=self.id).exclude(status__in=EVENT_CLOSED_STATUSES).update(status=self.status) > 0
+
+            super().save(*args, **kwargs)
+
+            if closed:
+                Event._child_closed(parent_id=self.parent_id)
+
+    def delete(self, *args, **kwargs):
+        """
+        Override super().delete() to release the parent event when deleting a child event that has not closed.
+        """
+        with transaction.atomic():
+            release = self.parent_id is not None and Event.objects.filter(id=self.id).exclude(status__in=EVENT_CLOSED_STATUSES).exists()
+            super().delete(*args, **kwargs)
+            if release:
+                Event._child_closed(parent_id=self.parent_id)
+
+    @classmethod
+    def bulk_save(cls, instances:list, fields:list, batch_size:int=None):
+        """
+        Override WarehauserAbstractModel.bulk_save(). Child events that close go through save() so their parent is released,
+        and the batch processor is woken up if any of the events is ready for it.
+        """
+        fields = [field for field in fields if field != 'pending_children']
+        closing = [instance for instance in instances if instance.parent_id is not None and instance.status in EVENT_CLOSED_STATUSES]
+        others = [instance for instance in instances if not (instance.parent_id is not None and instance.status in EVENT_CLOSED_STATUSES)]
+
+        with transaction.atomic():
+            if others:
+                super().bulk_save(others, fields, batch_size=batch_size)
+            for instance in closing:
+                instance.save()
+
+            if any(instance.is_batched and instance.status == STATUS_OPEN and instance.pending_children == 0 for instance in others):
+                transaction.on_commit(notify_event_queue)
+
+    @classmethod
+    def bulk_delete(cls, instances:list):
+        """
+        Override WarehauserAbstractModel.bulk_delete(). Child events that have not closed go through delete() so their parent
+        is released.
+        """
+        with transaction.atomic():
+            pending = [instance for instance in instances if instance.parent_id is not None and instance.status not in EVENT_CLOSED_STATUSES]
+            others = [instance for instance in instances if not (instance.parent_id is not None and instance.status not in EVENT_CLOSED_STATUSES)]
+
+            for instance in pending:
+                instance.delete()
+            if others:
+                super().bulk_delete(others)
+
+    @staticmethod
+    def _child_closed(parent_id):
+        """
+        Decrement the pending_children counter of a parent event and release it if it has no pending children left.
+        """
+        if Event.objects.filter(id=parent_id, pending_children=1, is_batched=True, status=STATUS_OPEN).exists():
+            # The parent is ready for the batch processor once this update commits
+            transaction.on_commit(notify_event_queue)
+        Event.objects.filter(id=parent_id, pending_children__gt=0).update(pending_children=F('pending_children') - 1, updated_at=timezone.now())
+        Event._release(event_id=parent_id)
+
+    @staticmethod
+    def _release(event_id):
+        """
+        Release an ON_HOLD event waiting on its child events once it has no pending children. The event is handed to the batch
+        processor to run its join_name (or its proc_name if it has not been processed yet), otherwise it is closed and its own
+        parent is released in turn.
+        """
+        while event_id is not None:
+            waiting = Event.objects.filter(id=event_id, status=STATUS_ON_HOLD, pending_children=0)
+            if waiting.filter(Q(join_name__isnull=False) | Q(proc_end__isnull=True)).update(status=STATUS_OPEN, is_batched=True, updated_at=timezone.now()):
+                transaction.on_commit(notify_event_queue)
+                return
+            if not waiting.update(status=STATUS_CLOSED, updated_at=timezone.now()):
+                return
+
+            event_id = Event.objects.filter(id=event_id).values_list('parent_id', flat=True).first()
+            if event_id is not None:
+                Event.objects.filter(id=event_id, pending_children__gt=0).update(pending_children=F('pending_children') - 1, updated_at=timezone.now())
+
+    def _wait_for_children(self):
+        """
+        Put this event ON_HOLD if its process spawned child events and left the status as STATUS_PROCESSING. The event is
+        released straight away if those children have already closed.
+        """
+        if self.status != STATUS_PROCESSING or not self.children.filter(created_at__gte=self.proc_start).exists():
+            return
+
+        Event.objects.filter(id=self.id, status=STATUS_PROCESSING).update(status=STATUS_ON_HOLD, updated_at=timezone.now())
+        Event._release(event_id=self.id)
+        self.refresh_from_db(fields=['status', 'pending_children', 'updated_at'])
+
+    def get_proc_name(self):
+        """
+        Get the name of the process to run next: join_name if this event has already been processed and has one, otherwise
+        proc_name.
+        """
+        if self.proc_end is not None and self.join_name is not None:
+            return self.join_name
+        return self.proc_name
+
+    def _get_proc_path(self):
+        """
+        Resolve proc_name into the module name and function name of this event's process function.
+
+        Returns:
+            tuple: (module_name, function_name) strings.
+        """
         # Set EVENT_LOGIC_APP to 'logic' if it's None or doesn't exist
         event_logic_app = getattr(settings, 'EVENT_LOGIC_APP', 'logic')
 
-        proc_name = str(self.proc_name)
+        proc_name = str(self.get_proc_name())
+
+        # Determine base_module based on whether proc_name contains a '.'
+        if '.' not in proc_name:
+            module_name = f'{event_logic_app}.{self.owner.group.name}.tasks'
+        else:
+            # Split the proc_name to check further conditions
+            module_name = f'{event_logic_app}.{self.owner.group.name}.{proc_name}'.rpartition('.')[0]
+            proc_name = proc_name.rpartition('.')[2]
+
+        return module_name, proc_name
+
+    def get_proc_func(self):
+        """
+        Load the process function named by proc_name.
+
+        Returns:
+            callable: the process function or None if this event has no process.
+
+        Raises:
+            ModuleNotFoundError: if the module of the process function cannot be loaded.
+        """
+        if self.get_proc_name() is None:
+            return None
+
+        module_name, proc_name = self._get_proc_path()
+
+        # Load the module and function dynamically
+        module = importlib.import_module(module_name)
+        return getattr(module, proc_name)
+
+    def coalesce(self, data:dict):
+        """
+        Merge the options of a duplicate event into this event according to dedup_rule. Note this does not save this event.
+
+        Args:
+            data (dict): the data of the duplicate event.
+        """
+        options = data.get('options')
+        rule = self.dedup_rule or DEDUP_RULE_UPDATE
+
+        if options is None or rule == DEDUP_RULE_KEEP:
+            pass
+        elif rule == DEDUP_RULE_REPLACE:
+            self.options = options
+        elif rule == DEDUP_RULE_DEEP:
+            merged = copy.deepcopy(self.options) if self.options is not None else dict()
+            dict_recursive_update(merged, options)
+            self.options = merged
+        elif rule == DEDUP_RULE_APPEND:
+            merged = dict(self.options) if self.options is not None else dict()
+            for key, value in options.items():
+                if isinstance(value, list) and isinstance(merged.get(key), list):
+                    merged[key] = merged[key] + value
+                else:
+                    merged[key] = value
+            self.options = merged
+        else:
+            self.options = dict_copy_and_update(self.options, options)
+
+        self.log(level=logging.INFO, msg=_(f'Coalesced duplicate event into {repr(self)}.'), extra={'self': self, 'dedup_key': self.dedup_key, 'rule': rule})
+
+    def get_timeout(self):
+        """
+        Get the wall clock time limit in seconds for processing this event.
+
+        Returns:
+            float: self.timeout, or settings.EVENT_DEFAULT_TIMEOUT if self.timeout is None. None means no limit.
+        """
+        if self.timeout is not None:
+            return self.timeout
+        return getattr(settings, 'EVENT_DEFAULT_TIMEOUT', None)
+
+    def fail(self, msg:str, code:int):
+        """
+        Set this event to STATUS_FAILED recording the reason in options['error'] and save it.
 
+        Args:
+            msg  (str): description of the failure.
+            code (int): one of core.utils.WarehauserErrorCodes.
+        """
+        self.status = STATUS_FAILED
+        if self.proc_end is None:
+            self.proc_end = timezone.now()
+        self.set_option(key='error', value={'code': int(code), 'msg': str(msg), 'dt': f'{timezone.now()}'})
+        self.log(level=logging.ERROR, msg=msg, extra={'self': self, 'code': code})
+        self.save()
+
+    def is_async(self) -> bool:
+        """
+        Check if the process function of this event is a coroutine function (declared with async def).
+
+        Returns:
+            bool: True if the process function is a coroutine function, False otherwise or if it cannot be loaded.
+        """
+        try:
+            return inspect.iscoroutinefunction(self.get_proc_func())
+        except Exception as e:
+            return False
+
+    def process(self):
+        """
+        Process this event by calling its process function. If the process function is a coroutine function it is run to
+        completion on an event loop before this function returns.
+        """
         if self.callback is not None:
             if hasattr(self.callback, 'pre_process') and callable(self.callback.pre_process):
                 self.callback.pre_process(event=self)
 
+        module_name = None
         err: Exception = None
         try:
-            if self.proc_name is None:
+            if self.get_proc_name() is None:
                 return None
 
-            print(proc_name)
-            # Determine base_module based on whether proc_name contains a '.'
-            if '.' not in proc_name:
-                module_name = f'{event_logic_app}.{self.owner.group.name}.tasks'
-            else:
-                # Split the proc_name to check further conditions
-                module_name = f'{event_logic_app}.{self.owner.group.name}.{proc_name}'.rpartition('.')[0]
-                proc_name = proc_name.rpartition('.')[2]
-
-            # Load the module and function dynamically
-            module = importlib.import_module(module_name)
-            proc_func = getattr(module, proc_name)
+            is_join = self.get_proc_name() != self.proc_name
+            module_name, _proc_name = self._get_proc_path()
+            proc_func = self.get_proc_func()
 
             # Update status and timestamps
             self.proc_start = timezone.now()
@@ -1041,10 +1544,16 @@ class Event(WarehauserAbstractInstanceModel, EventFields):
             self.save()
 
             try:
-                proc_func(self)  # Call the process function
+                if inspect.iscoroutinefunction(proc_func):
+                    async_to_sync(proc_func)(self)
+                else:
+                    proc_func(self)  # Call the process function
             finally:
                 self.proc_end = timezone.now()
                 self.save()
+
+            if not is_join:
+                self._wait_for_children()
         except ModuleNotFoundError as m:
             err = m
             self.log(level=logging.ERROR, msg=_(f'Unable to load module.'), extra={'mod': module_name, 'self': self})
@@ -1058,10 +1567,71 @@ class Event(WarehauserAbstractInstanceModel, EventFields):
 
         return self
 
+    async def aprocess(self):
+        """
+        Asynchronous version of process() for process functions declared with async def. Database access is made through
+        sync_to_async so the event loop is never blocked by the ORM.
+        """
+        if self.callback is not None:
+            if hasattr(self.callback, 'pre_process') and callable(self.callback.pre_process):
+                await sync_to_async(self.callback.pre_process)(event=self)
+
+        module_name = None
+        err: Exception = None
+        try:
+            if self.get_proc_name() is None:
+                return None
+
+            is_join = self.get_proc_name() != self.proc_name
+            module_name, _proc_name = await sync_to_async(self._get_proc_path)()
+            proc_func = await sync_to_async(self.get_proc_func)()
+
+            # Update status and timestamps
+            self.proc_start = timezone.now()
+            self.status = STATUS_PROCESSING
+            await self.asave()
+
+            try:
+                if inspect.iscoroutinefunction(proc_func):
+                    await proc_func(self)
+                else:
+                    await sync_to_async(proc_func)(self)
+            finally:
+                self.proc_end = timezone.now()
+                await self.asave()
+
+            if not is_join:
+                await sync_to_async(self._wait_for_children)()
+        except ModuleNotFoundError as m:
+            err = m
+            await sync_to_async(self.log)(level=logging.ERROR, msg=_(f'Unable to load module.'), extra={'mod': module_name, 'self': self})
+        except Exception as e:
+            err = e
+            raise e
+        finally:
+            if self.callback is not None:
+                if hasattr(self.callback, 'post_process') and callable(self.callback.post_process):
+                    await sync_to_async(self.callback.post_process)(event=self, err=err)
+
+        return self
+
     class Meta(WarehauserAbstractInstanceModel.Meta):
         abstract = False
         verbose_name = 'event'
         verbose_name_plural = 'events'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'dedup_key'],
+                condition=models.Q(status=STATUS_OPEN, dedup_key__isnull=False),
+                name='unique_open_dedup_key_in_event'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='event_created_id'),
+            models.Index(fields=['proc_end'], name='event_proc_end'),
+            # Queue depths counted by core.fairqueue.get_queue_depths() on every event queue pass
+            models.Index(fields=['owner', 'is_batched', 'status', 'pending_children'], name='event_owner_batched_status'),
+        ]
 
 # Through models for custom ManyToManyFields
 
@@ -1070,8 +1640,15 @@ class Event(WarehauserAbstractInstanceModel, EventFields):
 class Client(models.Model):
     """
     Internal use only. Used to interface client identities with data ownership.
+
+    Attributes:
+        group      (Group): the group of users that are members of this client.
+        weight     (float): share of the batched event processing capacity this client receives relative to other clients. Default is 1.0. A weight of 0 or less pauses the client's batched events.
+        max_events (int):   maximum number of this client's batched events processing at the same time. None means no limit.
     """
-    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='client', null=False, blank=False,)
+    group      = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='client', null=False, blank=False,)
+    weight     = models.FloatField(null=False, blank=False, default=1.0,)
+    max_events = models.IntegerField(null=True, blank=True, default=None,)
 
     class Meta(WarehauserAbstractInstanceModel.Meta):
         abstract = False
@@ -1101,6 +1678,480 @@ class UserAux(models.Model):
             )
         ]
 
+class EmailOutbox(models.Model):
+    """
+    Internal use only. Transactional outbox of notification emails. Emails are queued in the same transaction as the change
+    that triggers them and sent in batches by the email thread (see core.outbox.send_outbox).
+
+    Attributes:
+        subject    (str):      email subject.
+        body       (str):      plain text email body.
+        from_email (str):      sender address or None for settings.EMAIL_FROM_ADDRESS.
+        to         (json):     list of recipient addresses.
+        status     (int):      STATUS_OPEN until sent, then STATUS_CLOSED, or STATUS_FAILED once all delivery attempts failed.
+        attempts   (int):      number of failed delivery attempts.
+        error      (str):      error of the last failed delivery attempt.
+        created_at (datetime): date and time the email was queued.
+        sent_at    (datetime): date and time the email was sent.
+    """
+    subject    = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False,)
+    body       = models.TextField(null=False, blank=True,)
+    from_email = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True, default=None,)
+    to         = models.JSONField(null=False, blank=False, default=list,)
+    status     = models.IntegerField(choices=EMAIL_STATUS_CODES, default=STATUS_OPEN, null=False, blank=False,)
+    attempts   = models.IntegerField(null=False, blank=False, default=0,)
+    error      = models.TextField(null=True, blank=True, default=None,)
+    created_at = models.DateTimeField(auto_now_add=True, null=False, blank=False, editable=False,)
+    sent_at    = models.DateTimeField(null=True, blank=True, default=None,)
+
+    @classmethod
+    def enqueue(cls, subject:str, body:str, to:list, from_email:str=None) -> 'EmailOutbox':
+        """
+        Queue an email. Call this inside the transaction of the change that triggers the email so the email is only
+        sent if that change is committed.
+        """
+        return cls.objects.create(subject=subject, body=body, to=list(to), from_email=from_email)
+
+    def as_message(self, connection=None) -> EmailMessage:
+        return EmailMessage(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email or getattr(settings, 'EMAIL_FROM_ADDRESS', None),
+            to=self.to,
+            connection=connection,
+        )
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(id={self.id}, subject=\'{self.subject}\', status={self.status})'
+
+    class Meta:
+        verbose_name = 'emailoutbox'
+        verbose_name_plural = 'emailoutbox'
+        indexes = [
+            models.Index(fields=['status', 'id'], name='email_outbox_status_id'),
+        ]
+
+class SchedulerLease(models.Model):
+    """
+    Internal use only. Time limited lease held by a scheduler node, used for scheduler leader election and membership. See
+    core.leases.
+
+    Attributes:
+        name       (str):      unique name of the lease, e.g. 'leader' or 'node:<node name>'.
+        holder     (str):      name of the scheduler node holding the lease.
+        expires_at (datetime): date and time the lease expires unless renewed by its holder.
+    """
+    name       = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False, unique=True,)
+    holder     = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False,)
+    expires_at = models.DateTimeField(null=False, blank=False,)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(name=\'{self.name}\', holder=\'{self.holder}\', expires_at={self.expires_at})'
+
+    class Meta:
+        verbose_name = 'schedulerlease'
+        verbose_name_plural = 'schedulerleases'
+
+class CacheVersion(models.Model):
+    """
+    Internal use only. Version stamp of a per process cache. Processes that change the cached data bump the version and
+    every process drops its cache when it sees a new version, so caches stay correct across workers.
+
+    Attributes:
+        name    (str): unique name of the cache, e.g. 'authtoken'.
+        version (int): incremented every time the cached data changes.
+    """
+    name    = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False, unique=True,)
+    version = models.BigIntegerField(null=False, blank=False, default=0,)
+
+    @classmethod
+    def get_version(cls, name:str) -> int:
+        return cls.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, name:str):
+        """
+        Increment the version of a cache.
+        """
+        if not cls.objects.filter(name=name).update(version=F('version') + 1):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, version=1)
+            except IntegrityError:
+                cls.objects.filter(name=name).update(version=F('version') + 1)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(name=\'{self.name}\', version={self.version})'
+
+    class Meta:
+        verbose_name = 'cacheversion'
+        verbose_name_plural = 'cacheversions'
+
+# Models whose objects are indexed in SearchIndex and OptionsIndex
+SEARCHABLE_MODELS = (WarehauseDef, Warehause, ProductDef, Product, EventDef, Event,)
+
+class SearchIndex(models.Model):
+    """
+    Internal use only. Searchable text of a warehauser model object: its id, key, value, external_id and options['values'].
+    Rows are written when objects are saved and removed when they are deleted, and the API ?search= parameter queries them
+    through the full text index of the database (see core.search) instead of scanning the objects' JSON options.
+
+    Attributes:
+        model     (str):  label of the model of the object, e.g. 'core.product'.
+        object_id (uuid): id of the object.
+        document  (str):  searchable text of the object, one value per line.
+    """
+    model     = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False,)
+    object_id = models.UUIDField(null=False, blank=False,)
+    document  = models.TextField(null=False, blank=True, default='',)
+
+    # Fields of WarehauserAbstractModel objects whose values are indexed
+    indexed_fields = ('key', 'value', 'external_id', 'options',)
+
+    @classmethod
+    def get_document(cls, instance) -> str:
+        """
+        Get the searchable text of an object.
+        """
+        values = [instance.id, instance.key, getattr(instance, 'value', None), instance.external_id]
+
+        options_values = instance.options.get('values') if isinstance(instance.options, dict) else None
+        if isinstance(options_values, (list, tuple)):
+            values.extend(value for value in options_values if not isinstance(value, (dict, list)))
+        elif options_values is not None and not isinstance(options_values, dict):
+            values.append(options_values)
+
+        return '\n'.join(str(value) for value in values if value is not None and value != '')
+
+    @classmethod
+    def index_objects(cls, instances:list, batch_size:int=None):
+        """
+        Write the searchable text of objects with one insert (or update) per batch.
+
+        Args:
+            instances  (list): objects of one WarehauserAbstractModel model.
+            batch_size (int):  number of objects written per query or None for all at once.
+        """
+        if not instances:
+            return
+        cls.objects.bulk_create([
+            cls(model=instance._meta.label_lower, object_id=instance.id, document=cls.get_document(instance))
+            for instance in instances
+        ], batch_size=batch_size, update_conflicts=True, unique_fields=['model', 'object_id'], update_fields=['document'])
+
+    @classmethod
+    def unindex_objects(cls, model, ids:list):
+        """
+        Remove the searchable text of objects.
+
+        Args:
+            model (Model): the model of the objects.
+            ids   (list):  ids of the objects.
+        """
+        cls.objects.filter(model=model._meta.label_lower, object_id__in=ids).delete()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(model=\'{self.model}\', object_id={self.object_id})'
+
+    class Meta:
+        verbose_name = 'searchindex'
+        verbose_name_plural = 'searchindexes'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['model', 'object_id'],
+                name='unique_object_in_searchindex'
+            )
+        ]
+
+class OptionsIndex(models.Model):
+    """
+    Internal use only. Indexed values of the registered keys of a warehauser model object's options, one row per value (a
+    list value has one row per element). FilterSets register the keys they filter on (see core.filters) and the options
+    filters of those keys query these rows with index scans instead of reading every object's JSON options.
+
+    Attributes:
+        model     (str):   label of the model of the object, e.g. 'core.product'.
+        object_id (uuid):  id of the object.
+        key       (str):   the options key.
+        value     (str):   the value as text.
+        number    (float): the value if it is a number, otherwise None.
+    """
+    model     = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False,)
+    object_id = models.UUIDField(null=False, blank=False,)
+    key       = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False,)
+    value     = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=True,)
+    number    = models.FloatField(null=True, blank=True,)
+
+    # Registered options keys by model label, filled in when the FilterSets are created: {'core.product': {'values': 'exact'}}
+    registry = dict()
+
+    @classmethod
+    def register(cls, model, keys:dict):
+        cls.registry.setdefault(model._meta.label_lower, dict()).update(keys)
+
+    @classmethod
+    def get_rows(cls, instance, keys) -> list:
+        """
+        Get the OptionsIndex rows of the registered keys of an object.
+        """
+        rows = list()
+        options = instance.options if isinstance(instance.options, dict) else dict()
+        for key in keys:
+            values = options.get(key)
+            for value in values if isinstance(values, (list, tuple)) else [values]:
+                if value is None or isinstance(value, (dict, list)):
+                    continue
+                if isinstance(value, bool):
+                    rows.append(cls(model=instance._meta.label_lower, object_id=instance.id, key=key, value='true' if value else 'false'))
+                elif isinstance(value, (int, float)):
+                    rows.append(cls(model=instance._meta.label_lower, object_id=instance.id, key=key, value=str(value), number=float(value)))
+                else:
+                    rows.append(cls(model=instance._meta.label_lower, object_id=instance.id, key=key, value=str(value)[:CHARFIELD_MAX_LENGTH]))
+        return rows
+
+    @classmethod
+    def index_objects(cls, instances:list, batch_size:int=None):
+        """
+        Replace the indexed options values of objects of one model. Does nothing if the model has no registered keys.
+
+        Args:
+            instances  (list): objects of one WarehauserAbstractModel model.
+            batch_size (int):  number of rows inserted per query or None for all at once.
+        """
+        if not instances:
+            return
+        keys = cls.registry.get(instances[0]._meta.label_lower)
+        if not keys:
+            return
+
+        with transaction.atomic():
+            cls.unindex_objects(instances[0].__class__, [instance.id for instance in instances])
+            cls.objects.bulk_create([row for instance in instances for row in cls.get_rows(instance, keys)], batch_size=batch_size)
+
+    @classmethod
+    def unindex_objects(cls, model, ids:list):
+        """
+        Remove the indexed options values of objects.
+
+        Args:
+            model (Model): the model of the objects.
+            ids   (list):  ids of the objects.
+        """
+        if model._meta.label_lower in cls.registry:
+            cls.objects.filter(model=model._meta.label_lower, object_id__in=ids).delete()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(model=\'{self.model}\', object_id={self.object_id}, key=\'{self.key}\', value=\'{self.value}\')'
+
+    class Meta:
+        verbose_name = 'optionsindex'
+        verbose_name_plural = 'optionsindexes'
+        indexes = [
+            models.Index(fields=['model', 'key', 'value'], name='optionsindex_value'),
+            models.Index(fields=['model', 'key', 'number'], name='optionsindex_number'),
+            models.Index(fields=['model', 'object_id'], name='optionsindex_object'),
+        ]
+
+class StockMovement(models.Model):
+    """
+    Internal use only. Journal of every change to the quantity of product stored in a warehause, written by Product.save(),
+    Product.delete() and, for products deleted by the cascade of another object, by core.reports. A product moved between
+    warehauses is journaled as a negative quantity in the old warehause and a positive quantity in the new one. The daily
+    reports are built incrementally from this journal (see core.reports). Note bulk QuerySet.update() and QuerySet.delete()
+    calls on products are not journaled.
+
+    Attributes:
+        owner        (Client):   the client that owns the product.
+        product_id   (uuid):     id of the product.
+        dfn_id       (uuid):     id of the ProductDef of the product.
+        warehause_id (uuid):     id of the warehause the quantity moved in or out of.
+        quantity     (float):    quantity moved in (positive) or out (negative).
+        created_at   (datetime): date and time of the movement.
+        applied_at   (datetime): date and time the movement was applied to the stock levels or None if it is pending.
+    """
+    owner        = models.ForeignKey('Client', on_delete=models.CASCADE, related_name='stockmovements', null=False, blank=False,)
+    product_id   = models.UUIDField(null=False, blank=False,)
+    dfn_id       = models.UUIDField(null=False, blank=False,)
+    warehause_id = models.UUIDField(null=False, blank=False,)
+    quantity     = models.FloatField(null=False, blank=False,)
+    created_at   = models.DateTimeField(auto_now_add=True, null=False, blank=False,)
+    applied_at   = models.DateTimeField(null=True, blank=True, default=None,)
+
+    class Meta:
+        verbose_name = 'stockmovement'
+        verbose_name_plural = 'stockmovements'
+        indexes = [
+            models.Index(fields=['applied_at'], name='stockmovement_applied_at'),
+        ]
+
+class StockLevel(models.Model):
+    """
+    Internal use only. Running total of the quantity of product per client, warehause and ProductDef as of the last report run.
+    Maintained incrementally from the StockMovement journal by core.reports.
+
+    Attributes:
+        owner        (Client):   the client that owns the product.
+        warehause_id (uuid):     id of the warehause.
+        dfn_id       (uuid):     id of the ProductDef.
+        quantity     (float):    total quantity of product.
+        updated_at   (datetime): date and time this stock level last changed.
+    """
+    owner        = models.ForeignKey('Client', on_delete=models.CASCADE, related_name='stocklevels', null=False, blank=False,)
+    warehause_id = models.UUIDField(null=False, blank=False,)
+    dfn_id       = models.UUIDField(null=False, blank=False,)
+    quantity     = models.FloatField(null=False, blank=False, default=0.0,)
+    updated_at   = models.DateTimeField(auto_now=True, null=False, blank=False,)
+
+    class Meta:
+        verbose_name = 'stocklevel'
+        verbose_name_plural = 'stocklevels'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'warehause_id', 'dfn_id'],
+                name='unique_owner_warehause_dfn_in_stock_level'
+            )
+        ]
+
+class ReportState(models.Model):
+    """
+    Internal use only. Watermarks of the last report run so the next run only reads the rows changed since.
+
+    Attributes:
+        name             (str):      unique name of the report.
+        last_movement_id (int):      largest StockMovement id when the stock levels were last updated or None before the
+                                     first run.
+        last_run_at      (datetime): date and time of the last run.
+    """
+    name             = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False, unique=True,)
+    last_movement_id = models.BigIntegerField(null=True, blank=True, default=None,)
+    last_run_at      = models.DateTimeField(null=True, blank=True, default=None,)
+
+    class Meta:
+        verbose_name = 'reportstate'
+        verbose_name_plural = 'reportstates'
+
+class EventMetric(models.Model):
+    """
+    Internal use only. Aggregated event processing metrics per client and proc_name as published by the event workers.
+
+    Attributes:
+        owner      (Client):   the client that owns the events measured.
+        proc_name  (str):      process name of the events measured.
+        wait       (json):     histogram of queue wait in seconds (created_at to proc_start). See core.metrics.Histogram.
+        run        (json):     histogram of run time in seconds (proc_start to proc_end). See core.metrics.Histogram.
+        outcomes   (json):     dictionary of outcome name to number of events processed with that outcome.
+        updated_at (datetime): date and time these metrics were last published.
+    """
+    owner      = models.ForeignKey('Client', on_delete=models.CASCADE, related_name='eventmetrics', null=False, blank=False,)
+    proc_name  = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True,)
+    wait       = models.JSONField(null=False, blank=False, default=dict,)
+    run        = models.JSONField(null=False, blank=False, default=dict,)
+    outcomes   = models.JSONField(null=False, blank=False, default=dict,)
+    updated_at = models.DateTimeField(auto_now=True, null=False, blank=False,)
+
+    def merge(self, wait:'Histogram', run:'Histogram', outcomes:dict):
+        """
+        Add newly observed values to these metrics.
+        """
+        histogram = Histogram(self.wait)
+        histogram.merge(wait)
+        self.wait = histogram.as_dict()
+
+        histogram = Histogram(self.run)
+        histogram.merge(run)
+        self.run = histogram.as_dict()
+
+        merged = dict(self.outcomes or {})
+        for outcome, count in outcomes.items():
+            merged[outcome] = merged.get(outcome, 0) + count
+        self.outcomes = merged
+
+    def get_wait(self) -> 'Histogram':
+        return Histogram(self.wait)
+
+    def get_run(self) -> 'Histogram':
+        return Histogram(self.run)
+
+    class Meta:
+        verbose_name = 'eventmetric'
+        verbose_name_plural = 'eventmetrics'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'proc_name'],
+                name='unique_owner_proc_name_in_event_metric'
+            )
+        ]
+
+class EventArchive(models.Model):
+    """
+    Internal use only. Closed events moved out of the Event table by the archiver once they are older than
+    settings.EVENT_ARCHIVE_AFTER_DAYS. Related objects are referenced by id only so archived events never hold back the
+    deletion of the objects they referred to.
+
+    Attributes are those of Event with the foreign keys replaced by their ids, plus:
+        archived_at (datetime): date and time this event was archived.
+    """
+    id          = models.UUIDField(primary_key=True, editable=False)
+    owner       = models.ForeignKey('Client', on_delete=models.CASCADE, related_name='eventarchives', null=False, blank=False,)
+    external_id = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True,)
+    key         = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True, default=None,)
+    value       = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=False, blank=False,)
+    status      = models.IntegerField(choices=EVENT_STATUS_CODES, null=False, blank=False,)
+    schema      = models.JSONField(null=True, blank=True,)
+    options     = models.JSONField(null=True, blank=True,)
+    is_virtual  = models.BooleanField(null=False, blank=False, default=False,)
+    is_batched  = models.BooleanField(null=False, blank=False, default=False,)
+    proc_name   = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True,)
+    timeout     = models.FloatField(null=True, blank=True, default=None,)
+    dedup_key   = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True, default=None,)
+    dedup_rule  = models.CharField(max_length=16, choices=DEDUP_RULES, null=False, blank=False, default=DEDUP_RULE_UPDATE,)
+    join_name   = models.CharField(max_length=CHARFIELD_MAX_LENGTH, null=True, blank=True, default=None,)
+    parent_id   = models.UUIDField(null=True, blank=True,)
+    dfn_id      = models.UUIDField(null=False, blank=False,)
+    warehause_id = models.UUIDField(null=True, blank=True,)
+    user_id     = models.BigIntegerField(null=True, blank=True,)
+    created_at  = models.DateTimeField(null=False, blank=False,)
+    updated_at  = models.DateTimeField(null=True, blank=True,)
+    proc_start  = models.DateTimeField(null=True, blank=True,)
+    proc_end    = models.DateTimeField(null=True, blank=True,)
+    pending_children = models.IntegerField(null=False, blank=False, default=0,)
+    archived_at = models.DateTimeField(auto_now_add=True, null=False, blank=False,)
+
+    # Event fields copied into the archive: every column of the Event table
+    ARCHIVED_FIELDS = [field.attname for field in Event._meta.concrete_fields]
+
+    @classmethod
+    def archive(cls, events) -> int:
+        """
+        Copy events into the archive and delete them from the Event table in a single transaction. Events that still have
+        child events must not be archived as deleting them would cascade to their children.
+
+        Args:
+            events (QuerySet): the Event objects to archive.
+
+        Returns:
+            int: number of events archived.
+        """
+        with transaction.atomic():
+            rows = list(events.values(*cls.ARCHIVED_FIELDS))
+            if not rows:
+                return 0
+
+            cls.objects.bulk_create([cls(**row) for row in rows], ignore_conflicts=True)
+            Event.delete_objects([row['id'] for row in rows])
+
+        return len(rows)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(id={self.id}, key=\'{self.key}\', value=\'{self.value}\')'
+
+    class Meta:
+        verbose_name = 'eventarchive'
+        verbose_name_plural = 'eventarchives'
+        indexes = [
+            models.Index(fields=['owner', 'created_at'], name='event_archive_owner_created'),
+        ]
+
 # Signals
 
 # Utility functions
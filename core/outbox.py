@@ -0,0 +1,127 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# outbox.py
+
+import logging
+
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from .models import EmailOutbox
+from .status import STATUS_CLOSED, STATUS_FAILED, STATUS_OPEN
+
+logger = logging.getLogger(__name__)
+
+def queue_password_change_email(user, otp:str) -> EmailOutbox:
+    """
+    Queue the email that lets a user revoke a password change.
+    """
+    revoke_url = reverse('auth_otp_revoke_view', kwargs={'user': user.id, 'otp': otp,})
+    complete_url = urljoin(settings.EMAIL_WAREHAUSER_HOST or '', revoke_url)
+
+    message = f"""
+Hi {user.get_username()},
+
+Your Warehauser account password has been successfully changed. If this was done in error then click on this link:
+
+    {complete_url}
+
+Otherwise, happy warehausing!
+
+Regards,
+The Warehause Admin Team
+"""
+
+    return EmailOutbox.enqueue(subject='Warehauser password change successful', body=message, to=[user.email], from_email='noreply@warehauser.org')
+
+def queue_password_reset_email(email:str, otp:str) -> EmailOutbox:
+    """
+    Queue the email holding the one time code to reset a forgotten password.
+    """
+    message = f"""
+Hi,
+
+Here is your one time code to change your password:
+
+{otp}
+
+"""
+
+    return EmailOutbox.enqueue(subject='Warehauser Password Reset Request', body=message, to=[email], from_email=settings.EMAIL_FROM_ADDRESS)
+
+def send_outbox(connection=None, batch_size:int=None) -> int:
+    """
+    Send all queued emails over a single mail connection, reading and updating EMAIL_OUTBOX_BATCH_SIZE (default 100) emails
+    at a time. Emails are sent one by one so a single bad email neither holds back nor resends the others. An email that
+    failed EMAIL_OUTBOX_MAX_ATTEMPTS (default 5) times is set to STATUS_FAILED and no longer retried.
+
+    Must not run concurrently with itself (the email thread holds a mutex).
+
+    Args:
+        connection (BaseEmailBackend): mail connection to use. Default is get_connection().
+        batch_size (int):              number of emails per batch.
+
+    Returns:
+        int: number of emails sent.
+    """
+    batch_size = batch_size or getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 100)
+    max_attempts = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+
+    pending = EmailOutbox.objects.filter(status=STATUS_OPEN).order_by('id')
+    if not pending.exists():
+        return 0
+
+    connection = connection or get_connection(fail_silently=False)
+
+    total = 0
+    last_id = 0
+    with connection:
+        while True:
+            emails = list(pending.filter(id__gt=last_id)[:batch_size])
+            if not emails:
+                break
+
+            last_id = emails[-1].id
+
+            # One send_messages() call per email: a backend that fails part way through a list does not report which of its
+            # emails were sent, so retrying the list would send some of them twice
+            sent, failed = [], []
+            for email in emails:
+                try:
+                    connection.send_messages([email.as_message(connection=connection)])
+                    sent.append(email)
+                except Exception as e:
+                    email.error = str(e)
+                    failed.append(email)
+
+            EmailOutbox.objects.filter(id__in=[email.id for email in sent]).update(status=STATUS_CLOSED, sent_at=timezone.now(), error=None)
+            for email in failed:
+                email.attempts = email.attempts + 1
+                if email.attempts >= max_attempts:
+                    email.status = STATUS_FAILED
+                    logger.error(msg=_(f'Giving up sending {repr(email)} after {email.attempts} attempt(s): {email.error}'))
+                email.save(update_fields=['attempts', 'status', 'error'])
+
+            total = total + len(sent)
+
+            if len(emails) < batch_size:
+                break
+
+    return total
@@ -0,0 +1,247 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pagination.py
+
+import json
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import cached_property
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.translation import gettext as _
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+COUNT_APPROXIMATE = 'approximate'
+
+def get_page_size(request, query_param:str='page_size') -> int:
+    """
+    Get the page size requested by the client. Clients choose the page size with the page_size query parameter up to
+    API_MAX_PAGE_SIZE, and get REST_FRAMEWORK['PAGE_SIZE'] when they do not ask for one.
+    """
+    default = api_settings.PAGE_SIZE or 10
+    try:
+        return _positive_int(request.query_params[query_param], strict=True, cutoff=getattr(settings, 'API_MAX_PAGE_SIZE', 1000))
+    except (KeyError, ValueError):
+        return default
+
+def approximate_count(queryset) -> int:
+    """
+    Count the objects of a queryset without scanning all the matching rows. PostgreSQL returns the row estimate of the
+    query planner. Other databases count at most API_APPROXIMATE_COUNT_LIMIT rows.
+
+    Returns:
+        int: the approximate number of objects.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    limit = getattr(settings, 'API_APPROXIMATE_COUNT_LIMIT', 10000)
+    return queryset.order_by()[:limit].count()
+
+class ApproximateCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return approximate_count(self.object_list)
+
+class WarehauserPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination with a client chosen page size. Counting every matching row is the slowest part of paging a
+    large table so clients may ask for an approximate count with ?count=approximate.
+    """
+    page_size_query_param = 'page_size'
+    count_query_param = 'count'
+
+    @property
+    def max_page_size(self):
+        return getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.is_approximate = request.query_params.get(self.count_query_param) == COUNT_APPROXIMATE
+        if self.is_approximate:
+            self.django_paginator_class = ApproximateCountPaginator
+        return super().paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.is_approximate:
+            response.data['count_is_approximate'] = True
+        return response
+
+class WarehauserCursorPagination(BasePagination):
+    """
+    Keyset (cursor) pagination. Objects are ordered by the view's cursor_ordering fields, (created_at, id) unless the view
+    says otherwise, and the cursor holds the ordering values of the last object returned so the next page is found with
+    an index range scan however deep the client pages.
+
+    Attributes:
+        ordering (tuple): names of the fields that order objects. The last field must be unique.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering = ('created_at', 'id',)
+
+    def _encode_cursor(self, position:list, reverse:bool) -> str:
+        cursor = json.dumps({'p': position, 'r': reverse}, default=str, separators=(',', ':'))
+        return urlsafe_b64encode(cursor.encode('ascii')).decode('ascii')
+
+    def _decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('ascii'))
+            position, reverse = cursor['p'], bool(cursor['r'])
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise ValueError(position)
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(_('Invalid cursor.'))
+
+        return position, reverse
+
+    def _get_position(self, instance) -> list:
+        # Pages of QuerySet.values() hold dictionaries
+        if isinstance(instance, dict):
+            return [instance[field] for field in self.ordering]
+        return [getattr(instance, field) for field in self.ordering]
+
+    def _get_filter(self, position:list, reverse:bool) -> Q:
+        # (a, b) > (x, y) is a > x OR (a = x AND b > y)
+        lookup = 'lt' if reverse else 'gt'
+        q = Q()
+        for i, field in enumerate(self.ordering):
+            q = q | Q(**{f: value for f, value in zip(self.ordering[:i], position[:i])}, **{f'{field}__{lookup}': position[i]})
+        return q
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = get_page_size(request, query_param=self.page_size_query_param)
+        self.ordering = tuple(getattr(view, 'cursor_ordering', self.ordering))
+
+        position, reverse = self._decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self._get_filter(position=position, reverse=reverse))
+
+        queryset = queryset.order_by(*[f'-{field}' if reverse else field for field in self.ordering])
+        results = list(queryset[:self.page_size + 1])
+
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = position is not None if reverse else has_more
+        self.has_previous = has_more if reverse else position is not None
+
+        self.next_position = self._get_position(results[-1]) if results else position
+        self.previous_position = self._get_position(results[0]) if results else position
+
+        return results
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self._encode_cursor(self.next_position, reverse=False))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.previous_position is None:
+            return remove_query_param(url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, self._encode_cursor(self.previous_position, reverse=True))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': _('The pagination cursor value.'),
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': _('Number of results to return per page.'),
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+class WarehauserPagination(BasePagination):
+    """
+    Cursor pagination by default. Clients that ask for a ?page= get page number pagination instead, and so do searches
+    because their results are ordered by rank rather than by the cursor ordering.
+    """
+    cursor_pagination_class = WarehauserCursorPagination
+    page_number_pagination_class = WarehauserPageNumberPagination
+
+    def _get_paginator(self, request):
+        if self.page_number_pagination_class.page_query_param in request.query_params or request.query_params.get(api_settings.SEARCH_PARAM):
+            return self.page_number_pagination_class()
+        return self.cursor_pagination_class()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self._get_paginator(request)
+        return self.paginator.paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.cursor_pagination_class().get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        parameters = self.cursor_pagination_class().get_schema_operation_parameters(view)
+        parameters.extend([
+            parameter for parameter in self.page_number_pagination_class().get_schema_operation_parameters(view)
+            if parameter['name'] not in {p['name'] for p in parameters}
+        ])
+        return parameters
@@ -18,6 +18,7 @@ from django.contrib.auth.models import User
 from rest_framework.permissions import BasePermission, IsAuthenticated
 
 from .models import Client
+from .tenancy import get_client_ids
 
 # Permission classes here.
 
@@ -34,8 +35,7 @@ class WarehauserPermission(BasePermission):
             return True
 
         # Check if the user is a member of the group associated with the client's owner
-        client = Client.objects.filter(group__in=user.groups.all()).first()
-        return client and obj.owner == client
+        return obj.owner_id in get_client_ids(request)
 
 class IsSuperuser(IsAuthenticated):
     """
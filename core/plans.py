@@ -0,0 +1,194 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# plans.py
+
+import logging
+import threading
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db.models import F
+from django.utils.translation import gettext as _
+
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, RelatedField
+
+logger = logging.getLogger(__name__)
+
+# Serializer fields whose representation of a database value is the value itself
+IDENTITY_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.ChoiceField,
+    serializers.IntegerField,
+    serializers.ReadOnlyField,
+)
+
+STEP_VALUE   = 0
+STEP_CONVERT = 1
+STEP_RELATED = 2
+STEP_USER    = 3
+STEP_MANY    = 4
+
+PLAN_OWNER = 'plan_owner'
+
+class FieldPlan:
+    """
+    Read plan of a model serializer. The plan is compiled once from the serializer's fields and renders rows fetched with
+    QuerySet.values() into the same representation as the serializer, without building model instances or running the
+    serializer field machinery for every row.
+
+    Serializers declare the related fields they render as {'id', 'key'} in related_fields and the user fields they render as
+    {'id', 'username'} in user_fields. Fields the plan cannot render raise ImproperlyConfigured when the plan is compiled.
+
+    Attributes:
+        model   (Model): the serialized model.
+        columns (list):  names of the columns to fetch with QuerySet.values().
+        steps   (list):  (kind, key, args) rendering steps in the order of the serializer's fields.
+    """
+    _plans = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, serializer):
+        if isinstance(serializer, type):
+            serializer = serializer()
+
+        self.model = serializer.Meta.model
+        self.columns = list()
+        self.steps = list()
+
+        related_fields = getattr(serializer, 'related_fields', ())
+        user_fields = getattr(serializer, 'user_fields', ())
+
+        self.pk = self.model._meta.pk.attname
+        self._add_column(self.pk)
+
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+
+            try:
+                model_field = self.model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                raise ImproperlyConfigured(_(f'{serializer.__class__.__name__}.{name} is not a model field.'))
+
+            if name in user_fields:
+                self.steps.append((STEP_USER, name, (self._add_column(model_field.attname), self._add_column(f'{field.source}__username'),)))
+            elif name in related_fields:
+                self.steps.append((STEP_RELATED, name, (self._add_column(model_field.attname), self._add_column(f'{field.source}__key'),)))
+            elif model_field.many_to_many:
+                if isinstance(field, serializers.ListSerializer):
+                    child = FieldPlan(field.child)
+                elif isinstance(field, ManyRelatedField):
+                    child = None
+                else:
+                    raise ImproperlyConfigured(_(f'{serializer.__class__.__name__}.{name} cannot be planned.'))
+                self.steps.append((STEP_MANY, name, (model_field, child,)))
+            elif model_field.is_relation:
+                if not isinstance(field, RelatedField):
+                    raise ImproperlyConfigured(_(f'{serializer.__class__.__name__}.{name} cannot be planned.'))
+                # Primary key related fields render the related id
+                self.steps.append((STEP_VALUE, name, (self._add_column(model_field.attname),)))
+            elif isinstance(field, IDENTITY_FIELDS) or (isinstance(field, serializers.JSONField) and not field.binary):
+                self.steps.append((STEP_VALUE, name, (self._add_column(model_field.attname),)))
+            else:
+                self.steps.append((STEP_CONVERT, name, (self._add_column(model_field.attname), field.to_representation,)))
+
+    def _add_column(self, column:str) -> str:
+        if column not in self.columns:
+            self.columns.append(column)
+        return column
+
+    @classmethod
+    def get(cls, serializer_class):
+        """
+        Get the plan of a serializer class, compiling it on first use.
+
+        Returns:
+            FieldPlan: the plan or None if the serializer cannot be planned.
+        """
+        try:
+            return cls._plans[serializer_class]
+        except KeyError:
+            pass
+
+        with cls._lock:
+            if serializer_class not in cls._plans:
+                try:
+                    cls._plans[serializer_class] = cls(serializer_class)
+                except ImproperlyConfigured as e:
+                    logger.warning(_(f'[{cls.__name__}]: {serializer_class.__name__} falls back to the serializer: {e}'))
+                    cls._plans[serializer_class] = None
+            return cls._plans[serializer_class]
+
+    def values(self, queryset):
+        """
+        Turn a queryset of the model into a queryset of the rows this plan renders.
+        """
+        return queryset.prefetch_related(None).values(*self.columns)
+
+    def render(self, rows) -> list:
+        """
+        Render rows fetched with values().
+
+        Args:
+            rows (list): rows of the queryset returned by values().
+
+        Returns:
+            list: the representation of every row.
+        """
+        rows = list(rows)
+        many = {key: self._fetch_many(rows, *args) for kind, key, args in self.steps if kind == STEP_MANY}
+
+        results = list()
+        for row in rows:
+            representation = dict()
+            for kind, key, args in self.steps:
+                if kind == STEP_VALUE:
+                    representation[key] = row[args[0]]
+                elif kind == STEP_CONVERT:
+                    value = row[args[0]]
+                    representation[key] = None if value is None else args[1](value)
+                elif kind == STEP_RELATED:
+                    value = row[args[0]]
+                    representation[key] = None if value is None else {'id': value, 'key': row[args[1]]}
+                elif kind == STEP_USER:
+                    value = row[args[0]]
+                    representation[key] = None if value is None else {'id': value, 'username': row[args[1]]}
+                else:
+                    representation[key] = many[key].get(row[self.pk], [])
+            results.append(representation)
+
+        return results
+
+    def _fetch_many(self, rows:list, model_field, child) -> dict:
+        # Fetch the related objects of every row in one query, in the related model's default order
+        owners = [row[self.pk] for row in rows]
+        if not owners:
+            return dict()
+
+        query_name = model_field.related_query_name()
+        queryset = model_field.related_model._default_manager.filter(**{f'{query_name}__in': owners})
+
+        related = dict()
+        if child is None:
+            pk = model_field.related_model._meta.pk.attname
+            for row in queryset.values(pk, **{PLAN_OWNER: F(query_name)}):
+                related.setdefault(row[PLAN_OWNER], []).append(row[pk])
+            return related
+
+        rows = list(child.values(queryset).annotate(**{PLAN_OWNER: F(query_name)}))
+        for row, representation in zip(rows, child.render(rows)):
+            related.setdefault(row[PLAN_OWNER], []).append(representation)
+        return related
@@ -0,0 +1,113 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# renderers.py
+
+import csv
+import io
+
+from django.conf import settings
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class WarehauserJSONRenderer(JSONRenderer):
+    """
+    JSON renderer that encodes with orjson when it is installed and API_ORJSON is on, and with the standard rest framework
+    renderer otherwise. Both produce the same output: datetimes, decimals and lazy strings are still encoded by the rest
+    framework JSONEncoder.
+    """
+    def _default(self, obj):
+        return JSONEncoder().default(obj)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or not getattr(settings, 'API_ORJSON', True) or data is None:
+            return super().render(data, accepted_media_type=accepted_media_type, renderer_context=renderer_context)
+
+        # orjson only indents by two spaces
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type=accepted_media_type, renderer_context=renderer_context)
+
+        ret = orjson.dumps(data, default=self._default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+        # Escape the line and paragraph separators like the standard renderer does
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline delimited JSON, one object per line. Exports stream their lines themselves so this renderer only renders error
+    responses and other single objects.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return WarehauserJSONRenderer().render(data) + b'\n'
+
+class CSVRenderer(BaseRenderer):
+    """
+    Comma separated values with a header row. Exports stream their rows themselves so this renderer only renders error
+    responses and other single objects.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        header = list(rows[0].keys()) if rows and isinstance(rows[0], dict) else list()
+        return render_csv(rows, header=header).encode(self.charset)
+
+def to_csv_value(value):
+    """
+    Convert a representation value to a CSV cell. Nested objects and lists are written as JSON.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return WarehauserJSONRenderer().render(value).decode('utf-8')
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+def render_csv(rows:list, header:list=None) -> str:
+    """
+    Render representations as CSV.
+
+    Args:
+        rows   (list): the representations (dictionaries) to render.
+        header (list): the column names. The header row is only written if this is given.
+
+    Returns:
+        str: the CSV text.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow([to_csv_value(value) for value in row.values()] if isinstance(row, dict) else [to_csv_value(row)])
+    return buffer.getvalue()
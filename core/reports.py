@@ -0,0 +1,239 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# reports.py
+
+import csv
+import gzip
+import json
+import logging
+import os
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.contrib.auth.models import Group
+from django.db.models import Case, Count, F, FloatField, Max, QuerySet, Sum, Value, When
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.text import slugify
+from django.utils.translation import gettext as _
+
+from .metrics import EVENT_STATUS_NAMES
+from .models import Client, Event, Product, ProductDef, ReportState, StockLevel, StockMovement, Warehause, is_bulk_deleted
+from .status import STATUS_DESTROY
+
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = 'daily'
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMATS = [FORMAT_CSV, FORMAT_JSONL,]
+
+class DailyReportEngine:
+    """
+    Daily stock level, stock movement and event statistics reports per client and warehause.
+
+    Every run only reads the rows changed since the previous run: the StockMovement rows not applied yet, and the events
+    created or processed since the last run time. Stock levels are kept as running totals in the StockLevel table, which is
+    built from the Product table once, on the first run.
+
+    Movements are marked applied rather than read after the largest id seen: ids are handed out when a movement is written
+    but become visible when its transaction commits, so a movement committed late can have a lower id than ones already
+    applied.
+
+    Reports are written per client as gzip compressed CSV or JSON lines files:
+
+        <REPORTS_DIR>/<client>/<yyyy-mm-dd>/stock_levels.<csv|jsonl>.gz
+        <REPORTS_DIR>/<client>/<yyyy-mm-dd>/movements.<csv|jsonl>.gz
+        <REPORTS_DIR>/<client>/<yyyy-mm-dd>/events.<csv|jsonl>.gz
+
+    REPORTS_DIR defaults to the reports directory under BASE_DIR and REPORTS_FORMAT to 'csv'.
+    """
+    def __init__(self, directory:str=None, fmt:str=None):
+        self.directory = directory or getattr(settings, 'REPORTS_DIR', None) or os.path.join(settings.BASE_DIR, 'reports')
+        self.fmt = fmt or getattr(settings, 'REPORTS_FORMAT', FORMAT_CSV)
+        if self.fmt not in FORMATS:
+            raise ValueError(_(f'Invalid report format {self.fmt}. Must be one of {FORMATS}.'))
+
+    def run(self, now=None) -> list:
+        """
+        Aggregate the changes since the last run and write the reports of the day.
+
+        Args:
+            now (datetime): end of the reported period. Default is now.
+
+        Returns:
+            list: paths of the files written.
+        """
+        now = now or timezone.now()
+
+        with transaction.atomic():
+            # The movement high-water mark and the products the first run builds the stock levels from must be read from
+            # the same snapshot, else a movement committed in between is counted twice
+            self._start_snapshot()
+
+            state, created = ReportState.objects.select_for_update().get_or_create(name=REPORT_NAME)
+            since = state.last_run_at or (now - timedelta(days=1))
+            last_movement_id = StockMovement.objects.aggregate(last=Max('id'))['last'] or 0
+
+            if state.last_movement_id is None:
+                # First run: the stock levels are built from the products, which already include all journaled movements
+                self._build_stock_levels()
+                StockMovement.objects.filter(applied_at__isnull=True).update(applied_at=timezone.now())
+                movements = []
+            else:
+                movements = self._apply_movements()
+
+            events = self._get_event_stats(since=since, until=now)
+
+            state.last_movement_id = last_movement_id
+            state.last_run_at = now
+            state.save()
+
+        stock_levels = list(StockLevel.objects.exclude(quantity=0.0).values('owner_id', 'warehause_id', 'dfn_id', 'quantity').order_by('owner_id', 'warehause_id', 'dfn_id'))
+
+        return self._write(day=timezone.localdate(now), reports={
+            'stock_levels': stock_levels,
+            'movements':    movements,
+            'events':       events,
+        })
+
+    @staticmethod
+    def _start_snapshot():
+        # Every statement of a PostgreSQL READ COMMITTED transaction sees a new snapshot, REPEATABLE READ keeps the first
+        # one. SQLite transactions always read from a single snapshot. Only possible as the first statement of a transaction.
+        if connection.vendor == 'postgresql' and not connection.savepoint_ids:
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+    def _build_stock_levels(self):
+        StockLevel.objects.all().delete()
+        levels = Product.objects.exclude(status=STATUS_DESTROY).values('owner_id', 'warehause_id', 'dfn_id').annotate(total=Sum('quantity')).order_by()
+        StockLevel.objects.bulk_create([
+            StockLevel(owner_id=level['owner_id'], warehause_id=level['warehause_id'], dfn_id=level['dfn_id'], quantity=level['total'])
+            for level in levels
+        ], batch_size=1000)
+
+    def _apply_movements(self) -> list:
+        # Claim the pending movements first and aggregate exactly the claimed rows, so a movement committed in between is
+        # left for the next run
+        applied_at = timezone.now()
+        StockMovement.objects.filter(applied_at__isnull=True).update(applied_at=applied_at)
+
+        movements = list(StockMovement.objects.filter(applied_at=applied_at).values('owner_id', 'warehause_id', 'dfn_id').annotate(
+            moved_in=Sum(Case(When(quantity__gt=0.0, then=F('quantity')), default=Value(0.0), output_field=FloatField())),
+            moved_out=Sum(Case(When(quantity__lt=0.0, then=-F('quantity')), default=Value(0.0), output_field=FloatField())),
+            movements=Count('id'),
+        ).order_by('owner_id', 'warehause_id', 'dfn_id'))
+
+        for movement in movements:
+            movement['net'] = movement['moved_in'] - movement['moved_out']
+            key = {'owner_id': movement['owner_id'], 'warehause_id': movement['warehause_id'], 'dfn_id': movement['dfn_id']}
+            if not StockLevel.objects.filter(**key).update(quantity=F('quantity') + movement['net'], updated_at=timezone.now()):
+                StockLevel.objects.create(quantity=movement['net'], **key)
+
+        return movements
+
+    def _get_event_stats(self, since, until) -> list:
+        stats = dict()
+
+        def get_row(owner_id, warehause_id):
+            row = stats.get((owner_id, warehause_id))
+            if row is None:
+                row = {'owner_id': owner_id, 'warehause_id': warehause_id, 'created': 0}
+                row.update({name: 0 for name in EVENT_STATUS_NAMES.values()})
+                stats[(owner_id, warehause_id)] = row
+            return row
+
+        created = Event.objects.filter(created_at__gte=since, created_at__lt=until).values('owner_id', 'warehause_id').annotate(count=Count('id')).order_by()
+        for group in created:
+            get_row(group['owner_id'], group['warehause_id'])['created'] = group['count']
+
+        processed = Event.objects.filter(proc_end__gte=since, proc_end__lt=until).values('owner_id', 'warehause_id', 'status').annotate(count=Count('id')).order_by()
+        for group in processed:
+            name = EVENT_STATUS_NAMES.get(group['status'], str(group['status']))
+            row = get_row(group['owner_id'], group['warehause_id'])
+            row[name] = row.get(name, 0) + group['count']
+
+        return [stats[key] for key in sorted(stats.keys(), key=lambda key: (key[0], str(key[1])))]
+
+    def _write(self, day, reports:dict) -> list:
+        owner_ids = set(row['owner_id'] for rows in reports.values() for row in rows)
+        clients = {client.id: client.group.name for client in Client.objects.filter(id__in=owner_ids).select_related('group')}
+
+        warehause_ids = set(row['warehause_id'] for rows in reports.values() for row in rows if row.get('warehause_id'))
+        warehauses = {w['id']: w['value'] for w in Warehause.objects.filter(id__in=warehause_ids).values('id', 'value')}
+
+        dfn_ids = set(row['dfn_id'] for rows in reports.values() for row in rows if row.get('dfn_id'))
+        dfns = {d['id']: d['key'] for d in ProductDef.objects.filter(id__in=dfn_ids).values('id', 'key')}
+
+        # Group the rows by client in a single pass
+        by_owner = defaultdict(lambda: {name: [] for name in reports.keys()})
+        for name, rows in reports.items():
+            for row in rows:
+                by_owner[row['owner_id']][name].append(self._format_row(row, day=day, warehauses=warehauses, dfns=dfns))
+
+        paths = []
+        for owner_id, client in clients.items():
+            directory = os.path.join(self.directory, slugify(client) or str(owner_id), day.isoformat())
+            os.makedirs(directory, exist_ok=True)
+
+            for name, rows in by_owner[owner_id].items():
+                paths.append(self._write_file(path=os.path.join(directory, f'{name}.{self.fmt}.gz'), rows=rows))
+
+        logger.info(msg=_(f'Wrote {len(paths)} report file(s) for {day}.'))
+        return paths
+
+    @staticmethod
+    def _format_row(row:dict, day, warehauses:dict, dfns:dict) -> dict:
+        result = {'day': day.isoformat()}
+        for key, value in row.items():
+            if key == 'owner_id':
+                continue
+            result[key] = str(value) if key in ['warehause_id', 'dfn_id'] and value is not None else value
+            if key == 'warehause_id':
+                result['warehause'] = warehauses.get(value)
+            elif key == 'dfn_id':
+                result['product'] = dfns.get(value)
+        return result
+
+    def _write_file(self, path:str, rows:list) -> str:
+        # Write to a temporary file first so readers never see a partial report
+        tmp = f'{path}.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8', newline='') as f:
+            if self.fmt == FORMAT_JSONL:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+            elif rows:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+        os.replace(tmp, path)
+        return path
+
+@receiver(post_delete, sender=Product)
+def on_product_deleted(sender, instance, origin=None, **kwargs):
+    # Product.delete() and Product.bulk_delete() journal the products they delete. Products deleted by the cascade of another
+    # object (a warehause, a ProductDef or a parent product) are journaled here, except when their client is deleted, which
+    # deletes the client's journal and stock levels too.
+    if origin is instance or is_bulk_deleted(instance):
+        return
+    if isinstance(origin, (Client, Group)) or (isinstance(origin, QuerySet) and issubclass(origin.model, (Client, Group))):
+        return
+    instance._journal_stock(stock=None)
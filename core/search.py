@@ -0,0 +1,221 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# search.py
+
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import BooleanField, FloatField, OuterRef, Subquery, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from rest_framework.filters import SearchFilter
+
+from .models import SEARCHABLE_MODELS, SearchIndex, WarehauserAbstractModel, is_bulk_deleted
+
+logger = logging.getLogger(__name__)
+
+SEARCH_POSTGRESQL = 'postgresql' # tsvector and pg_trgm trigram GIN indexes
+SEARCH_FTS5 = 'fts5'             # SQLite FTS5 table with the trigram tokenizer
+SEARCH_LIKE = 'like'             # case insensitive substring match of the index rows, no ranking
+
+SEARCH_RANK = 'search_rank'
+
+FTS5_TABLE = f'{SearchIndex._meta.db_table}_fts'
+
+# Trigram indexes only match terms of at least this many characters
+TRIGRAM_MIN_LENGTH = 3
+
+_backends = dict()
+
+def _create_postgresql_index(connection):
+    table = SearchIndex._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_document_tsv ON {table} USING gin (to_tsvector(\'simple\'::regconfig, document))')
+        try:
+            with transaction.atomic(using=connection.alias):
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_document_trgm ON {table} USING gin (document gin_trgm_ops)')
+        except DatabaseError as e:
+            logger.warning(f'Could not create the pg_trgm search index, substring searches will not be indexed: {e}')
+
+def _create_fts5_index(connection):
+    table = SearchIndex._meta.db_table
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS5_TABLE} USING fts5(document, content=\'{table}\', content_rowid=\'id\', tokenize=\'trigram\')')
+        except DatabaseError as e:
+            logger.warning(f'Could not create the FTS5 search index, searches will scan the search index table: {e}')
+            return
+
+        # Keep the external content FTS5 table in step with the search index table
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {FTS5_TABLE}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {FTS5_TABLE}(rowid, document) VALUES (new.id, new.document);
+        END''')
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {FTS5_TABLE}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {FTS5_TABLE}({FTS5_TABLE}, rowid, document) VALUES ('delete', old.id, old.document);
+        END''')
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {FTS5_TABLE}_update AFTER UPDATE ON {table} BEGIN
+            INSERT INTO {FTS5_TABLE}({FTS5_TABLE}, rowid, document) VALUES ('delete', old.id, old.document);
+            INSERT INTO {FTS5_TABLE}(rowid, document) VALUES (new.id, new.document);
+        END''')
+        cursor.execute(f'INSERT INTO {FTS5_TABLE}({FTS5_TABLE}) VALUES (\'rebuild\')')
+
+def create_search_index(using:str='default'):
+    """
+    Create the full text index of the search index table for the database: tsvector and trigram GIN indexes on PostgreSQL
+    and an FTS5 table with triggers on SQLite. Run after every migrate, and safe to run again.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        _create_postgresql_index(connection)
+    elif connection.vendor == 'sqlite':
+        _create_fts5_index(connection)
+    _backends.pop(using, None)
+
+def _detect_search_backend(using:str) -> tuple:
+    # (backend, True if pg_trgm is installed), looked up once per database
+    if using not in _backends:
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1 FROM pg_extension WHERE extname = \'pg_trgm\'')
+                _backends[using] = (SEARCH_POSTGRESQL, cursor.fetchone() is not None)
+        elif connection.vendor == 'sqlite' and FTS5_TABLE in connection.introspection.table_names():
+            _backends[using] = (SEARCH_FTS5, False)
+        else:
+            _backends[using] = (SEARCH_LIKE, False)
+    return _backends[using]
+
+def get_search_backend(using:str='default') -> str:
+    """
+    Get the search backend configured by settings.SEARCH_BACKEND: 'postgresql', 'fts5', 'like', or 'auto' (default) for
+    'postgresql' on PostgreSQL, 'fts5' on SQLite when the FTS5 table exists, and 'like' otherwise.
+    """
+    backend = getattr(settings, 'SEARCH_BACKEND', 'auto')
+    if backend == 'auto':
+        backend = _detect_search_backend(using)[0]
+    return backend
+
+def _escape_like(term:str) -> str:
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _search_postgresql(entries, terms:list, trigram:bool):
+    query = ' '.join(terms)
+    patterns = [f'%{_escape_like(term)}%' for term in terms]
+    tsv = 'to_tsvector(\'simple\'::regconfig, document)'
+    tsq = 'plainto_tsquery(\'simple\'::regconfig, %s)'
+
+    # Whole words match the tsvector index and parts of words the trigram index
+    ilike = ' AND '.join(['document ILIKE %s'] * len(patterns))
+    entries = entries.filter(RawSQL(f'({tsv} @@ {tsq} OR ({ilike}))', [query, *patterns], output_field=BooleanField()))
+
+    if trigram:
+        rank = RawSQL(f'ts_rank({tsv}, {tsq}) + similarity(document, %s)', [query, query], output_field=FloatField())
+    else:
+        rank = RawSQL(f'ts_rank({tsv}, {tsq})', [query], output_field=FloatField())
+    return entries, rank
+
+def _search_fts5(entries, terms:list):
+    # Each term is a quoted phrase so the user's input is never read as an FTS5 query, and terms too short for the trigram
+    # tokenizer are matched with LIKE on the rows the other terms found
+    phrases = ['"' + term.replace('"', '""') + '"' for term in terms if len(term) >= TRIGRAM_MIN_LENGTH]
+    for term in terms:
+        if len(term) < TRIGRAM_MIN_LENGTH:
+            entries = entries.filter(document__icontains=term)
+
+    if not phrases:
+        return entries, Value(0.0, output_field=FloatField())
+
+    match = ' '.join(phrases)
+    entries = entries.filter(id__in=RawSQL(f'SELECT rowid FROM {FTS5_TABLE} WHERE {FTS5_TABLE} MATCH %s', [match]))
+
+    # bm25() is lower for better matches
+    rank = RawSQL(f'SELECT -bm25({FTS5_TABLE}) FROM {FTS5_TABLE} WHERE {FTS5_TABLE} MATCH %s AND rowid = id', [match], output_field=FloatField())
+    return entries, rank
+
+def _search_like(entries, terms:list):
+    for term in terms:
+        entries = entries.filter(document__icontains=term)
+    return entries, Value(0.0, output_field=FloatField())
+
+def search(queryset, terms:list):
+    """
+    Filter a queryset of WarehauserAbstractModel objects to those whose id, key, value, external_id or options['values']
+    contain every search term, and annotate each object with its search_rank (higher is a better match).
+
+    Args:
+        queryset (QuerySet): the objects to search.
+        terms    (list):     the search terms.
+
+    Returns:
+        QuerySet: the matching objects, best matches first.
+    """
+    if not terms:
+        return queryset
+
+    index = SearchIndex.objects.using(queryset.db).filter(model=queryset.model._meta.label_lower)
+    entries = index
+    backend = get_search_backend(queryset.db)
+    if backend == SEARCH_POSTGRESQL:
+        entries, rank = _search_postgresql(entries, terms, trigram=_detect_search_backend(queryset.db)[1])
+    elif backend == SEARCH_FTS5:
+        entries, rank = _search_fts5(entries, terms)
+    else:
+        entries, rank = _search_like(entries, terms)
+
+    queryset = queryset.filter(id__in=entries.values('object_id'))
+    queryset = queryset.annotate(**{SEARCH_RANK: Subquery(
+        index.filter(object_id=OuterRef('id')).annotate(rank=rank).values('rank')[:1], output_field=FloatField()
+    )})
+    return queryset.order_by(f'-{SEARCH_RANK}', *queryset.query.order_by)
+
+class WarehauserSearchFilter(SearchFilter):
+    """
+    Search the id, key, value, external_id and options['values'] of objects with ?search=. Searches run against the search
+    index (see SearchIndex) using the full text index of the database, and results are ranked best match first.
+    """
+    def filter_queryset(self, request, queryset, view):
+        if not issubclass(queryset.model, WarehauserAbstractModel):
+            return queryset
+        return search(queryset, self.get_search_terms(request))
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super().get_schema_operation_parameters(view)
+        for parameter in parameters:
+            if parameter['name'] == self.search_param:
+                parameter['description'] = 'Search the id, key, value, external_id and options[\'values\'] of objects.'
+        return parameters
+
+def on_object_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & set(SearchIndex.indexed_fields):
+        return
+    SearchIndex.index_objects([instance])
+
+def on_object_deleted(sender, instance, **kwargs):
+    if not is_bulk_deleted(instance):
+        SearchIndex.unindex_objects(sender, [instance.id])
+
+# Receivers without a sender would stop every model from being deleted without loading its objects
+for _model in SEARCHABLE_MODELS:
+    post_save.connect(on_object_saved, sender=_model)
+    post_delete.connect(on_object_deleted, sender=_model)
+
+@receiver(post_migrate)
+def on_migrated(sender, app_config=None, using='default', **kwargs):
+    if app_config is not None and app_config.name == SearchIndex._meta.app_config.name:
+        create_search_index(using=using)
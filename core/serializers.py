@@ -19,7 +19,9 @@ from django.utils import timezone
 from rest_framework import serializers
 from django.utils.translation import gettext as _
 
+from .metrics import HISTOGRAM_BUCKETS
 from .models import *
+from .tenancy import get_client_ids
 
 def to_related_representation(instance, representation, related_fields):
     for field_name in related_fields:
@@ -32,6 +34,17 @@ def to_related_representation(instance, representation, related_fields):
 
     return representation
 
+def to_user_representation(instance, representation, user_fields):
+    for field_name in user_fields:
+        user = getattr(instance, field_name, None)
+        if user:
+            representation[field_name] = {
+                'id': user.id,
+                'username': user.username
+            }
+
+    return representation
+
 class RelatedFieldSerializer(serializers.PrimaryKeyRelatedField):
     def to_representation(self, value):
         if value is None:
@@ -61,8 +74,7 @@ class WarehauserSerializer(serializers.ModelSerializer):
 
         if not user.is_staff and not user.is_superuser:
             # Ensure the owner is a Client that is referenced by the user's group
-            client_groups = Client.objects.filter(group__in=user.groups.all())
-            if value not in client_groups:
+            if value.id not in get_client_ids(request):
                 raise serializers.ValidationError("You do not have access to this client.")
 
         return value
@@ -78,6 +90,9 @@ class WarehauseSerializer(WarehauserSerializer):
     dfn    = warehausedef_related_field_serializer
     user   = user_related_field_serializer
 
+    related_fields = ['parent', 'dfn',]  # Add other related field names here as needed
+    user_fields    = ['user',]
+
     def create(self, validated_data):
         raise NotImplementedError('WarehauseSerializer.create(self,validated_data)')
 
@@ -86,15 +101,8 @@ class WarehauseSerializer(WarehauserSerializer):
             return None
 
         representation = super().to_representation(instance)
-
-        if instance.user:
-            representation['user'] = {
-                'id': instance.user.id,
-                'username': instance.user.username
-            }
-
-        related_fields = ['parent', 'dfn']  # Add other related field names here as needed
-        return to_related_representation(instance, representation, related_fields)
+        representation = to_user_representation(instance, representation, self.user_fields)
+        return to_related_representation(instance, representation, self.related_fields)
 
     class Meta:
         model = Warehause
@@ -117,6 +125,8 @@ class ProductSerializer(WarehauserSerializer):
     parent    = product_related_field_serializer
     warehause = warehause_related_field_serializer
 
+    related_fields = ['parent', 'dfn', 'warehause',]  # Add other related field names here as needed
+
     def create(self, validated_data):
         raise NotImplementedError('ProductSerializer.create(self,validated_data)')
 
@@ -125,9 +135,7 @@ class ProductSerializer(WarehauserSerializer):
             return None
 
         representation = super().to_representation(instance)
-
-        related_fields = ['parent', 'dfn', 'warehause']  # Add other related field names here as needed
-        return to_related_representation(instance, representation, related_fields)
+        return to_related_representation(instance, representation, self.related_fields)
 
     class Meta:
         model = Product
@@ -151,6 +159,9 @@ class EventSerializer(WarehauserSerializer):
     warehause = warehause_related_field_serializer
     user      = user_related_field_serializer
 
+    related_fields = ['parent', 'dfn', 'warehause',]  # Add other related field names here as needed
+    user_fields    = ['user',]
+
     def create(self, validated_data):
         raise NotImplementedError('EventSerializer.create(self,validated_data)')
 
@@ -160,15 +171,8 @@ class EventSerializer(WarehauserSerializer):
             return None
 
         representation = super().to_representation(instance)
-
-        if instance.user:
-            representation['user'] = {
-                'id': instance.user.id,
-                'username': instance.user.username
-            }
-
-        related_fields = ['parent', 'dfn', 'warehause']  # Add other related field names here as needed
-        return to_related_representation(instance, representation, related_fields)
+        representation = to_user_representation(instance, representation, self.user_fields)
+        return to_related_representation(instance, representation, self.related_fields)
 
     class Meta:
         model = Event
@@ -180,3 +184,22 @@ class ClientSerializer(serializers.ModelSerializer):
     class Meta:
         model = Client
         fields = '__all__'
+
+class EventMetricSerializer(serializers.ModelSerializer):
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+
+        for field_name, histogram in (('wait', instance.get_wait()), ('run', instance.get_run()),):
+            representation[field_name] = {
+                **histogram.as_dict(),
+                'buckets': HISTOGRAM_BUCKETS,
+                'p50': histogram.quantile(0.50),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99),
+            }
+
+        return representation
+
+    class Meta:
+        model = EventMetric
+        fields = '__all__'
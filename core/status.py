@@ -14,6 +14,7 @@
 
 # status.py
 
+STATUS_FAILED     = -2
 STATUS_DESTROY    = -1
 STATUS_CLOSED     = 0
 STATUS_PROCESSING = 1
@@ -54,9 +55,20 @@ EVENTDEF_STATUS_CODES = (
 )
 
 EVENT_STATUS_CODES = (
+    (STATUS_FAILED,     'Failed'),
     (STATUS_DESTROY,    'Destroy'),
     (STATUS_CLOSED,     'Closed'),
     (STATUS_PROCESSING, 'Processing'),
     (STATUS_ON_HOLD,    'On Hold'),
     (STATUS_OPEN,       'Open'),
 )
+
+# Event statuses that count as closed for the purposes of releasing a parent event waiting on its children. A failed child
+# releases its parent too, whose join_name can tell failed children by their status.
+EVENT_CLOSED_STATUSES = (STATUS_CLOSED, STATUS_DESTROY, STATUS_FAILED,)
+
+EMAIL_STATUS_CODES = (
+    (STATUS_FAILED,     'Failed'),
+    (STATUS_CLOSED,     'Sent'),
+    (STATUS_OPEN,       'Open'),
+)
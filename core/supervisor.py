@@ -0,0 +1,155 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# supervisor.py
+
+# Note: this module is imported by freshly spawned worker processes before Django is set up so it must not import
+# any Django models at module level.
+
+import logging
+import multiprocessing
+import os
+import threading
+
+from django.conf import settings
+from django.utils.translation import gettext as _
+
+from .utils import WarehauserError, WarehauserErrorCodes
+
+logger = logging.getLogger(__name__)
+
+def _process_event(event_id:str, settings_module:str):
+    """
+    Entry point of a supervised worker process. Sets up Django and processes a single event.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+
+    import django
+    django.setup()
+
+    from .models import Event
+
+    event = Event.objects.get(id=event_id)
+    event.process()
+
+class EventSupervisor:
+    """
+    Run event process functions in supervised worker processes with a wall clock time limit. Each event is processed in a
+    fresh process so a process that is killed for overrunning its time limit is simply replaced by the next one.
+
+    At most EVENT_WORKER_PROCESSES (default number of CPUs) worker processes run at the same time, and at most
+    EVENT_WORKER_PROCESSES_PER_CLIENT (default half of EVENT_WORKER_PROCESSES) of those process events of the same client,
+    so a single misbehaving client script cannot exhaust the pool.
+    """
+    def __init__(self, processes:int=None, processes_per_client:int=None):
+        self.processes = processes or getattr(settings, 'EVENT_WORKER_PROCESSES', None) or os.cpu_count() or 1
+        self.processes_per_client = processes_per_client or getattr(settings, 'EVENT_WORKER_PROCESSES_PER_CLIENT', None) or max(self.processes // 2, 1)
+
+        self._context = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(self.processes)
+        self._client_slots = dict()
+        self._lock = threading.Lock()
+
+    def _get_client_slots(self, owner_id) -> threading.BoundedSemaphore:
+        with self._lock:
+            slots = self._client_slots.get(owner_id)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.processes_per_client)
+                self._client_slots[owner_id] = slots
+            return slots
+
+    def acquire(self, owner_id) -> bool:
+        """
+        Take a worker process slot for a client without waiting for one. The event queue only dispatches events with a
+        time limit once it holds a slot for them, so no thread is ever parked waiting for a worker process.
+
+        Args:
+            owner_id (UUID): id of the client whose event is to be processed.
+
+        Returns:
+            bool: True if a slot was taken, which must be handed back with release(). False if all worker processes or all
+                  the worker processes of the client are busy.
+        """
+        client_slots = self._get_client_slots(owner_id)
+        if not client_slots.acquire(blocking=False):
+            return False
+        if not self._slots.acquire(blocking=False):
+            client_slots.release()
+            return False
+        return True
+
+    def release(self, owner_id):
+        """
+        Hand back a worker process slot taken with acquire().
+        """
+        self._slots.release()
+        self._get_client_slots(owner_id).release()
+
+    def _create_process(self, event):
+        return self._context.Process(
+            target=_process_event,
+            args=(str(event.id), os.environ.get('DJANGO_SETTINGS_MODULE', 'warehauser.settings'),),
+            name=f'event:{event.id}',
+            daemon=True,
+        )
+
+    def process(self, event, timeout:float):
+        """
+        Process an event in a supervised worker process. Blocks until the process finishes or is killed. The caller must
+        hold a slot for the event's client, see acquire().
+
+        Args:
+            event   (Event): the event to process. It is refreshed from the database when processing has finished.
+            timeout (float): wall clock time limit in seconds.
+
+        Raises:
+            WarehauserError: with code EVENT_TIMEOUT if the process was killed for overrunning the time limit, or
+                             EVENT_PROCESS_ERROR if the process failed. In both cases the event is set to STATUS_FAILED.
+        """
+        process = self._create_process(event)
+        process.start()
+        process.join(timeout)
+
+        timed_out = process.is_alive()
+        if timed_out:
+            process.kill()
+            process.join()
+
+        event.refresh_from_db()
+
+        if timed_out:
+            msg = _(f'Event process exceeded its timeout of {timeout} seconds and was killed.')
+            event.fail(msg=msg, code=WarehauserErrorCodes.EVENT_TIMEOUT)
+            raise WarehauserError(msg, WarehauserErrorCodes.EVENT_TIMEOUT, {'self': event, 'timeout': timeout})
+
+        if process.exitcode != 0:
+            msg = _(f'Event process failed with exit code {process.exitcode}.')
+            event.fail(msg=msg, code=WarehauserErrorCodes.EVENT_PROCESS_ERROR)
+            raise WarehauserError(msg, WarehauserErrorCodes.EVENT_PROCESS_ERROR, {'self': event, 'exitcode': process.exitcode})
+
+        return event
+
+_event_supervisor = None
+_event_supervisor_lock = threading.Lock()
+
+def get_event_supervisor() -> EventSupervisor:
+    """
+    Get the EventSupervisor shared by all event worker threads of this process.
+    """
+    global _event_supervisor
+
+    with _event_supervisor_lock:
+        if _event_supervisor is None:
+            _event_supervisor = EventSupervisor()
+        return _event_supervisor
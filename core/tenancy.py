@@ -0,0 +1,106 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# tenancy.py
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Client
+
+REQUEST_ATTRIBUTE = '_warehauser_client_ids'
+
+class ClientIdCache:
+    """
+    Per process cache of the ids of the clients each user belongs to (through the user's groups). Entries expire after
+    CLIENT_IDS_CACHE_TTL seconds so changes made by other processes are seen within that time, and changes made by this
+    process drop the affected entries straight away. At most CLIENT_IDS_CACHE_SIZE users are kept, least recently used
+    first out.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id) -> frozenset:
+        ttl = getattr(settings, 'CLIENT_IDS_CACHE_TTL', 30)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        client_ids = frozenset(Client.objects.filter(group__user__id=user_id).values_list('id', flat=True))
+        if ttl:
+            with self._lock:
+                self._entries[user_id] = (now + ttl, client_ids)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > getattr(settings, 'CLIENT_IDS_CACHE_SIZE', 10000):
+                    self._entries.popitem(last=False)
+
+        return client_ids
+
+    def invalidate(self, user_ids=None):
+        """
+        Drop the cached client ids of some users, or of all users if user_ids is None.
+        """
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+            else:
+                for user_id in user_ids:
+                    self._entries.pop(user_id, None)
+
+client_id_cache = ClientIdCache()
+
+def get_client_ids(request) -> frozenset:
+    """
+    Get the ids of the clients the user of a request belongs to. The ids are looked up at most once per request and are
+    shared by the permission checks, querysets and serializers of the request.
+
+    Args:
+        request (Request): the request.
+
+    Returns:
+        frozenset: the client ids, empty for anonymous users.
+    """
+    client_ids = getattr(request, REQUEST_ATTRIBUTE, None)
+    if client_ids is None:
+        user = request.user
+        client_ids = client_id_cache.get(user.pk) if user and user.is_authenticated else frozenset()
+        setattr(request, REQUEST_ATTRIBUTE, client_ids)
+    return client_ids
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def on_user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance is a group and pk_set holds user ids (None when cleared)
+        client_id_cache.invalidate(user_ids=pk_set)
+    else:
+        client_id_cache.invalidate(user_ids=[instance.pk])
+
+@receiver(post_save, sender=Client)
+@receiver(post_delete, sender=Client)
+def on_client_changed(sender, **kwargs):
+    client_id_cache.invalidate()
@@ -14,21 +14,74 @@
 
 # tests.py
 
+import asyncio
+import csv
+import gzip
+import importlib
+import json
 import os
 import logging
 import pprint
-
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipIf
+
+try:
+    # Test requirement only, see warehauser/requirements-dev.txt
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+from asgiref.sync import async_to_sync
+
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.core.management import call_command
 from django.forms.models import model_to_dict
 from django.contrib.auth.models import Group, User
-from django.test import TestCase
+from django.db import DatabaseError, OperationalError, connection
+from django.db.models import ProtectedError
+from django.db.models.deletion import Collector
+from django.db.models.signals import pre_delete
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from db_mutex.db_mutex import db_mutex
+
+from rest_framework.authtoken.models import Token
 
+from warehauser import tasks
+
+from .authentication import TOKEN_CACHE_NAME, TokenCache
 from .callbacks import WarehauseDefCallback, WarehauseCallback, ProductDefCallback, ProductCallback, EventDefCallback, EventCallback
-from .models import WarehauseDef, Warehause, ProductDef, Product, EventDef, Event, Client
-from .utils import WarehauserError
+from .fairqueue import WeightedFairQueue
+from .filters import OPTIONS_MATCH_PREFIX, get_options_filters
+from .jobs import JobExecutor
+from .leases import SchedulerMembership, filter_shard
+from .lookup import lookup_cache
+from .metrics import EventMetrics, event_metrics
+from .models import WarehauseDef, Warehause, ProductDef, Product, EventDef, Event, Client, EventMetric, EventArchive, UserAux, EmailOutbox, StockLevel, StockMovement, CacheVersion, SearchIndex, OptionsIndex
+from .outbox import send_outbox
+from .reports import DailyReportEngine
+from .search import SEARCH_FTS5, get_search_backend
+from .status import STATUS_CLOSED, STATUS_DESTROY, STATUS_FAILED, STATUS_ON_HOLD, STATUS_OPEN, STATUS_PROCESSING
+from .supervisor import EventSupervisor
+from .utils import WarehauserError, WarehauserErrorCodes, JSONRemoveKey
+from .views import EventInlineProcessThread
+from .wakeup import EventWakeupListener, notify_event_queue
 
 # Create your tests here.
 
-class WarehauserTestCase(TestCase):
+class WarehauserTestMixin:
     def setUp(self):
         self.group:Group = Group.objects.create(name='demo')
         self.user:User = User.objects.create(username='demo', password='testpassword', email='test@email.com')
@@ -152,6 +205,13 @@ class WarehauserTestCase(TestCase):
             'owner': self.owner,
         })
 
+class WarehauserTestCase(WarehauserTestMixin, TestCase):
+    pass
+
+class WarehauserTransactionTestCase(WarehauserTestMixin, TransactionTestCase):
+    # For tests that use the database from more than one thread
+    pass
+
 class TestCase00001(WarehauserTestCase):
     def setUp(self):
         super().setUp()
@@ -294,6 +354,50 @@ class TestCase00003(WarehauserTestCase):
         for s in stock:
             self.assertEqual(s.dfn, self.virtual_product_dfn)
 
+class TestCase00004(WarehauserTestCase):
+    def setUp(self):
+        """
+        Test: async def process functions are detected and run to completion.
+        """
+        super().setUp()
+
+        self.async_dfn:EventDef = EventDef.objects.create(
+            key = 'Async',
+            is_batched = True,
+            proc_name = 'tasks.my_async_event_process',
+            owner = self.owner,
+        )
+
+    def test_0001(self):
+        event:Event = self.async_dfn.create_instance(data={'value': 'async 001'})
+        self.assertTrue(event.is_async())
+        self.assertFalse(self.outbound_dfn.create_instance(data={'value': 'sync 001'}).is_async())
+
+        event.process()
+        event.refresh_from_db()
+
+        self.assertEqual(event.status, STATUS_CLOSED)
+        self.assertIsNotNone(event.proc_start)
+        self.assertIsNotNone(event.proc_end)
+
+    def test_0002(self):
+        dfn:EventDef = EventDef.objects.create(key = 'AsyncMissing', proc_name = 'missing.my_async_event_process', owner = self.owner)
+        event:Event = dfn.create_instance(data={'value': 'async 002'})
+        on_loop = list()
+
+        def log(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+
+        # The log of an unloadable module is written off the event loop
+        with mock.patch.object(Event, 'log', side_effect=log):
+            async_to_sync(event.aprocess)()
+
+        self.assertEqual(on_loop, [False])
+
 class TestCase00003(WarehauserTestCase):
     def setUp(self):
         """
@@ -545,3 +649,1239 @@ class TestCase00003(WarehauserTestCase):
 
 
 
+
+class TestCase00005(WarehauserTestCase):
+    def setUp(self):
+        """
+        Test: processed events are aggregated into EventMetric histograms per client and proc_name.
+        """
+        super().setUp()
+
+    def test_0001(self):
+        metrics = EventMetrics()
+
+        for i in range(3):
+            event:Event = self.outbound_dfn.create_instance(data={'value': f'outbound {i:03}'})
+            event.proc_start = event.created_at + timedelta(seconds=2)
+            event.proc_end = event.proc_start + timedelta(seconds=0.2)
+            event.status = STATUS_CLOSED
+            metrics.observe(event=event, err=ValueError() if i == 2 else None)
+
+        metrics.flush()
+        metrics.flush()
+
+        metric = EventMetric.objects.get(owner=self.owner, proc_name='outbound')
+        self.assertEqual(metric.outcomes, {'closed': 2, 'error': 1})
+        self.assertEqual(metric.get_wait().count, 3)
+        self.assertEqual(metric.get_wait().quantile(0.5), 2.5)
+        self.assertEqual(metric.get_run().quantile(0.5), 0.25)
+
+        out = StringIO()
+        call_command('eventmetrics', stdout=out)
+        self.assertIn('outbound', out.getvalue())
+
+    def test_0002(self):
+        """
+        Test: observations are kept when writing them fails and written by the next flush.
+        """
+        metrics = EventMetrics()
+
+        event:Event = self.outbound_dfn.create_instance(data={'value': 'outbound'})
+        event.status = STATUS_CLOSED
+        metrics.observe(event=event)
+
+        with mock.patch.object(EventMetric, 'save', side_effect=DatabaseError('unavailable')):
+            with self.assertRaises(DatabaseError):
+                metrics.flush()
+        self.assertFalse(EventMetric.objects.filter(owner=self.owner, proc_name='outbound').exists())
+
+        metrics.flush()
+        self.assertEqual(EventMetric.objects.get(owner=self.owner, proc_name='outbound').outcomes, {'closed': 1})
+
+    def test_0003(self):
+        """
+        Test: events processed inline by do_spawn are measured.
+        """
+        self.client.force_login(self.user)
+        event_metrics.flush()
+
+        url = reverse('eventdef-do-spawn', kwargs={'id': self.outbound_dfn.id})
+        response = self.client.post(url, {'options': {'warehause': str(self.loadingarea.id)}}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        event_metrics.flush()
+        metric = EventMetric.objects.get(owner=self.owner, proc_name='outbound')
+        self.assertEqual(sum(metric.outcomes.values()), 1)
+        self.assertEqual(metric.get_run().count, 1)
+
+class TestCase00006(TestCase):
+    """
+    Test: weighted fair queueing shares event processing capacity between clients.
+    """
+    def _client(self, owner, queued, weight=1.0, running=0, max_events=None):
+        return {'owner': owner, 'weight': weight, 'max_events': max_events, 'queued': queued, 'running': running}
+
+    def test_0001(self):
+        queue = WeightedFairQueue()
+
+        # A bulk importing client does not starve a small client
+        allocation = queue.allocate(clients=[self._client(1, 100000), self._client(2, 5)], capacity=10)
+        self.assertEqual(allocation, {1: 5, 2: 5})
+
+    def test_0002(self):
+        queue = WeightedFairQueue()
+
+        # Capacity is shared by weight, and per client caps are respected
+        allocation = queue.allocate(clients=[self._client(1, 1000, weight=3.0), self._client(2, 1000)], capacity=8)
+        self.assertEqual(allocation, {1: 6, 2: 2})
+
+        allocation = queue.allocate(clients=[self._client(1, 1000, running=4, max_events=5), self._client(2, 1000)], capacity=8)
+        self.assertEqual(allocation, {1: 1, 2: 7})
+
+    def test_0003(self):
+        queue = WeightedFairQueue()
+
+        # A weight of 0 pauses a client and is not read as the default weight
+        allocation = queue.allocate(clients=[self._client(1, 1000, weight=0.0), self._client(2, 1000, weight=None)], capacity=8)
+        self.assertEqual(allocation, {2: 8})
+
+class TestCase00007(WarehauserTestCase):
+    def setUp(self):
+        """
+        Test: batched events with a matching dedup_key are coalesced into the OPEN event.
+        """
+        super().setUp()
+
+        self.recount_dfn:EventDef = EventDef.objects.create(
+            key = 'Recount',
+            is_batched = True,
+            proc_name = 'recount',
+            dedup_key = 'recount:{options.bin}',
+            dedup_rule = 'append',
+            owner = self.owner,
+        )
+
+    def test_0001(self):
+        first = self.recount_dfn.create_instance(data={'value': 'recount 001', 'options': {'bin': 'A01', 'requests': [1]}})
+        second = self.recount_dfn.create_instance(data={'value': 'recount 002', 'options': {'bin': 'A01', 'requests': [2]}})
+        other = self.recount_dfn.create_instance(data={'value': 'recount 003', 'options': {'bin': 'B01', 'requests': [3]}})
+
+        self.assertEqual(first.id, second.id)
+        self.assertNotEqual(first.id, other.id)
+        self.assertEqual(first.dedup_key, 'recount:A01')
+        self.assertEqual(Event.objects.get(id=first.id).options['requests'], [1, 2])
+
+        # Once the event is no longer OPEN a new event is created
+        first.status = STATUS_CLOSED
+        first.save()
+        third = self.recount_dfn.create_instance(data={'value': 'recount 004', 'options': {'bin': 'A01', 'requests': [4]}})
+        self.assertNotEqual(first.id, third.id)
+
+    def test_0002(self):
+        """
+        Test: dedup_key templates only substitute plain values and cannot be replaced by the spawn data.
+        """
+        event = self.recount_dfn.create_instance(data={'value': 'recount 001', 'dedup_key': 'mine', 'options': {'bin': 'A01'}})
+        self.assertEqual(event.dedup_key, 'recount:A01')
+
+        for template in ('recount:{options[bin]}', 'recount:{value.__class__}', 'recount:{options.requests}', 'recount:{owner}'):
+            self.recount_dfn.dedup_key = template
+            with self.assertRaises(WarehauserError):
+                self.recount_dfn.create_instance(data={'value': 'recount 002', 'options': {'bin': 'A01', 'requests': [1]}})
+
+        self.recount_dfn.dedup_key = '{{{value}}}:{options.bin}'
+        event = self.recount_dfn.create_instance(data={'value': 'recount 003', 'options': {'bin': 'B01'}})
+        self.assertEqual(event.dedup_key, '{recount 003}:B01')
+
+class TestCase00008(WarehauserTestCase):
+    def setUp(self):
+        """
+        Test: an event that fans out child events waits for them to close and then runs its join_name.
+        """
+        super().setUp()
+
+        self.pallet_dfn:EventDef = EventDef.objects.create(
+            key = 'Pallet',
+            is_batched = True,
+            proc_name = 'my_event_process',
+            owner = self.owner,
+        )
+
+        self.receipt_dfn:EventDef = EventDef.objects.create(
+            key = 'Receipt',
+            is_batched = True,
+            proc_name = 'receive_pallets',
+            join_name = 'receive_pallets_complete',
+            owner = self.owner,
+        )
+
+    def test_0001(self):
+        receipt:Event = self.receipt_dfn.create_instance(data={
+            'value': 'receipt 001',
+            'options': {'dfn': str(self.pallet_dfn.id), 'pallets': ['pallet 001', 'pallet 002',]},
+        })
+        receipt.process()
+
+        receipt = Event.objects.get(id=receipt.id)
+        self.assertEqual(receipt.status, STATUS_ON_HOLD)
+        self.assertEqual(receipt.pending_children, 2)
+
+        pallets = list(receipt.children.all())
+        pallets[0].process()
+        self.assertEqual(Event.objects.get(id=receipt.id).pending_children, 1)
+        self.assertEqual(Event.objects.get(id=receipt.id).status, STATUS_ON_HOLD)
+
+        pallets[1].process()
+        receipt = Event.objects.get(id=receipt.id)
+        self.assertEqual(receipt.pending_children, 0)
+        self.assertEqual(receipt.status, STATUS_OPEN)
+
+        receipt.process()
+        receipt = Event.objects.get(id=receipt.id)
+        self.assertEqual(receipt.status, STATUS_CLOSED)
+        self.assertEqual(receipt.options['result'], {'pallets': 2})
+
+    def test_0002(self):
+        """
+        Test: a child event that fails releases its parent.
+        """
+        receipt:Event = self.receipt_dfn.create_instance(data={
+            'value': 'receipt 002',
+            'options': {'dfn': str(self.pallet_dfn.id), 'pallets': ['pallet 003', 'pallet 004',]},
+        })
+        receipt.process()
+
+        pallets = list(receipt.children.all())
+        pallets[0].process()
+        pallets[1].fail(msg='Event process exceeded its timeout.', code=WarehauserErrorCodes.EVENT_TIMEOUT)
+        receipt = Event.objects.get(id=receipt.id)
+        self.assertEqual(receipt.pending_children, 0)
+        self.assertEqual(receipt.status, STATUS_OPEN)
+
+        # Failing again does not release the parent twice
+        pallets[1].fail(msg='Event process exceeded its timeout.', code=WarehauserErrorCodes.EVENT_TIMEOUT)
+        self.assertEqual(Event.objects.get(id=receipt.id).pending_children, 0)
+
+        receipt.process()
+        receipt = Event.objects.get(id=receipt.id)
+        self.assertEqual(receipt.status, STATUS_CLOSED)
+        self.assertEqual(receipt.options['result'], {'pallets': 1})
+
+class TestCase00009(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: set based removal of a JSON key.
+        """
+        aux:UserAux = UserAux.objects.create(user=self.user, options={'send_mail': {'dt': 'x'}, 'otp': {'codes': {}}})
+        UserAux.objects.filter(id=aux.id).update(options=JSONRemoveKey('options', 'send_mail'))
+
+        aux.refresh_from_db()
+        self.assertEqual(aux.options, {'otp': {'codes': {}}})
+
+    def test_0002(self):
+        """
+        Test: closed events are moved into the event archive.
+        """
+        event_dfn:EventDef = EventDef.objects.create(key='Archive', owner=self.owner, is_batched=True, timeout=5.0, join_name='archive_complete', dedup_key='archive:{value}')
+        event:Event = event_dfn.create_instance(data={'value': 'archive 001', 'options': {'a': 1}, 'schema': {'type': 'object'}})
+        event.status = STATUS_CLOSED
+        event.save()
+        row = Event.objects.filter(id=event.id).values().get()
+
+        self.assertEqual(EventArchive.archive(Event.objects.filter(id=event.id)), 1)
+        self.assertFalse(Event.objects.filter(id=event.id).exists())
+
+        archived:EventArchive = EventArchive.objects.get(id=event.id)
+        self.assertEqual(archived.owner, self.owner)
+        self.assertEqual(archived.dfn_id, event_dfn.id)
+        self.assertEqual(archived.status, STATUS_CLOSED)
+        self.assertEqual(archived.options, {'a': 1})
+
+        # Every column of the event is archived
+        self.assertEqual({name: value for name, value in EventArchive.objects.filter(id=event.id).values().get().items() if name in row}, row)
+        self.assertEqual(archived.dedup_key, 'archive:archive 001')
+        self.assertEqual(archived.timeout, 5.0)
+
+class RejectingEmailBackend(LocMemEmailBackend):
+    def send_messages(self, messages):
+        if any('reject@email.com' in message.to for message in messages):
+            raise ConnectionError('rejected')
+        return super().send_messages(messages)
+
+class TestCase00010(TestCase):
+    def test_0001(self):
+        """
+        Test: queued emails are sent in batches and failing emails do not hold back the others.
+        """
+        for i in range(5):
+            EmailOutbox.enqueue(subject=f'email {i}', body='body', to=[f'user{i}@email.com'], from_email='noreply@warehauser.org')
+        rejected:EmailOutbox = EmailOutbox.enqueue(subject='rejected', body='body', to=['reject@email.com'], from_email='noreply@warehauser.org')
+
+        with self.settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2):
+            self.assertEqual(send_outbox(connection=RejectingEmailBackend(), batch_size=2), 5)
+            self.assertEqual(len(mail.outbox), 5)
+            self.assertEqual(EmailOutbox.objects.filter(status=STATUS_CLOSED).count(), 5)
+
+            rejected.refresh_from_db()
+            self.assertEqual(rejected.status, STATUS_OPEN)
+            self.assertEqual(rejected.attempts, 1)
+
+            self.assertEqual(send_outbox(connection=RejectingEmailBackend()), 0)
+            rejected.refresh_from_db()
+            self.assertEqual(rejected.status, STATUS_FAILED)
+
+    @skipIf(Controller is None, 'aiosmtpd is not installed')
+    def test_0002(self):
+        """
+        Test: queued emails are sent to an SMTP server over a single connection and a refused recipient does not hold back
+        the others.
+        """
+        handler = RecordingSMTPHandler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        controller = Controller(handler, hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+
+        for i in range(5):
+            EmailOutbox.enqueue(subject=f'email {i}', body='body', to=[f'user{i}@email.com'], from_email='noreply@warehauser.org')
+        rejected:EmailOutbox = EmailOutbox.enqueue(subject='rejected', body='body', to=['reject@email.com'], from_email='noreply@warehauser.org')
+
+        connection = get_connection('django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=port, use_tls=False, use_ssl=False, username='', password='', fail_silently=False)
+        self.assertEqual(send_outbox(connection=connection, batch_size=2), 5)
+
+        self.assertEqual(sorted(to for message in handler.messages for to in message['to']), [f'user{i}@email.com' for i in range(5)])
+        self.assertEqual(len({message['peer'] for message in handler.messages}), 1)
+        self.assertEqual(EmailOutbox.objects.filter(status=STATUS_CLOSED).count(), 5)
+
+        rejected.refresh_from_db()
+        self.assertEqual(rejected.status, STATUS_OPEN)
+        self.assertEqual(rejected.attempts, 1)
+        self.assertIn('reject@email.com', rejected.error)
+
+class RecordingSMTPHandler:
+    # aiosmtpd handler recording the messages it receives and refusing reject@email.com
+    def __init__(self):
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == 'reject@email.com':
+            return '550 rejected'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append({'peer': session.peer, 'to': list(envelope.rcpt_tos)})
+        return '250 OK'
+
+class TestCase00011(TestCase):
+    def test_0001(self):
+        """
+        Test: a job is not run again while its previous run is active and overruns are coalesced into one follow up run.
+        """
+        executor = JobExecutor(workers=2, coalesce=True)
+        release = threading.Event()
+        runs = []
+
+        def job():
+            runs.append(1)
+            release.wait(timeout=5)
+
+        self.assertTrue(executor.submit('job', job))
+        self.assertFalse(executor.submit('job', job))
+        self.assertFalse(executor.submit('job', job))
+
+        release.set()
+        for i in range(50):
+            if len(runs) == 2 and not executor.report()[0]['active']:
+                break
+            time.sleep(0.1)
+        executor.shutdown(wait=True)
+
+        report = executor.report()[0]
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(report['runs'], 2)
+        self.assertEqual(report['overruns'], 2)
+        self.assertEqual(report['coalesced'], 1)
+
+class TestCase00012(TestCase):
+    def test_0001(self):
+        """
+        Test: one scheduler node is elected leader and clients are sharded across the live nodes.
+        """
+        node_a = SchedulerMembership(node='a', ttl=30, sharding=True)
+        node_b = SchedulerMembership(node='b', ttl=30, sharding=True)
+
+        node_a.heartbeat()
+        node_b.heartbeat()
+        node_a.heartbeat()
+
+        self.assertTrue(node_a.is_leader)
+        self.assertFalse(node_b.is_leader)
+        self.assertEqual(node_a.shard, (0, 2))
+        self.assertEqual(node_b.shard, (1, 2))
+
+        clients = [Client.objects.create(group=Group.objects.create(name=f'client_{i}')) for i in range(4)]
+        shard_a = set(filter_shard(Client.objects.all(), shard=node_a.shard, field='id').values_list('id', flat=True))
+        shard_b = set(filter_shard(Client.objects.all(), shard=node_b.shard, field='id').values_list('id', flat=True))
+        self.assertEqual(shard_a | shard_b, set(client.id for client in clients))
+        self.assertFalse(shard_a & shard_b)
+
+        node_a.leave()
+        node_b.heartbeat()
+
+        self.assertTrue(node_b.is_leader)
+        self.assertEqual(node_b.shard, (0, 1))
+
+    def test_0002(self):
+        """
+        Test: a heartbeat that hits a database error gives up leadership instead of raising and is retried until it succeeds.
+        """
+        node = SchedulerMembership(node='a', ttl=30, sharding=True)
+        self.assertTrue(node.heartbeat())
+        self.assertTrue(node.is_leader)
+
+        with mock.patch('core.leases.acquire_lease', side_effect=OperationalError('server closed the connection')), mock.patch('core.leases.close_old_connections') as close:
+            self.assertFalse(node.heartbeat())
+        close.assert_called_once()
+        self.assertFalse(node.healthy)
+        self.assertFalse(node.is_leader)
+        self.assertIsNone(node.shard)
+
+        self.assertTrue(node.heartbeat())
+        self.assertTrue(node.is_leader)
+        self.assertEqual(node.shard, (0, 1))
+
+class TestCase00013(TestCase):
+    def test_0001(self):
+        """
+        Test: notify_event_queue() wakes up the event queue listener through the wakeup socket.
+        """
+        woken = threading.Event()
+        path = os.path.join(tempfile.mkdtemp(), 'eventqueue.sock')
+
+        with self.settings(EVENT_WAKEUP='socket', EVENT_WAKEUP_SOCKET=path):
+            listener = EventWakeupListener(callback=woken.set)
+            listener.start()
+            for i in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+
+            notify_event_queue()
+            self.assertTrue(woken.wait(timeout=5))
+
+            listener.stop()
+            listener.join(timeout=5)
+            self.assertFalse(os.path.exists(path))
+
+class TestCase00014(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: daily reports are built from the stock movements journaled since the previous run.
+        """
+        directory = tempfile.mkdtemp()
+        engine = DailyReportEngine(directory=directory, fmt='csv')
+
+        product:Product = self.chocolatebar_dfn.create_instance(data={
+            'value': 'Chocolate Bar',
+            'quantity': 10.0,
+            'warehause': self.bin_A10_01_01,
+            'owner': self.owner,
+        })
+
+        engine.run()
+        self.assertEqual(StockLevel.objects.get(warehause_id=self.bin_A10_01_01.id).quantity, 10.0)
+
+        bin_A10_01_02:Warehause = self.bin_dfn.create_instance(data={
+            'value': 'A01-01-02',
+            'parent': self.warehouse,
+            'owner': self.owner,
+        })
+
+        # Move 4 to the other bin
+        product = Product.objects.get(id=product.id)
+        product.quantity = 6.0
+        product.save()
+        self.chocolatebar_dfn.create_instance(data={
+            'value': 'Chocolate Bar',
+            'quantity': 4.0,
+            'warehause': bin_A10_01_02,
+            'owner': self.owner,
+        })
+
+        paths = engine.run()
+        self.assertEqual(StockLevel.objects.get(warehause_id=self.bin_A10_01_01.id).quantity, 6.0)
+        self.assertEqual(StockLevel.objects.get(warehause_id=bin_A10_01_02.id).quantity, 4.0)
+
+        path = [path for path in paths if path.endswith('movements.csv.gz')][0]
+        with gzip.open(path, 'rt') as f:
+            movements = {row['warehause']: row for row in csv.DictReader(f)}
+        self.assertEqual(float(movements['A01-01-01']['moved_out']), 4.0)
+        self.assertEqual(float(movements['A01-01-02']['moved_in']), 4.0)
+
+    def test_0002(self):
+        """
+        Test: every client's reports hold its own rows only.
+        """
+        directory = tempfile.mkdtemp()
+        other = Client.objects.create(group=Group.objects.create(name='other'))
+        other_bin:Warehause = self.bin_dfn.create_instance(data={'value': 'B01-01-01', 'owner': other})
+        self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 10.0, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 3.0, 'warehause': other_bin, 'owner': other})
+
+        paths = DailyReportEngine(directory=directory, fmt='jsonl').run()
+        self.assertEqual(len(paths), 6)
+
+        for client, expected in (('demo', {'A01-01-01': 10.0}), ('other', {'B01-01-01': 3.0})):
+            path = [path for path in paths if f'{os.sep}{client}{os.sep}' in path and path.endswith('stock_levels.jsonl.gz')][0]
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual({row['warehause']: row['quantity'] for row in map(json.loads, f)}, expected)
+
+    def test_0003(self):
+        """
+        Test: movements committed after a later movement was applied are still applied, and products deleted by the cascade
+        of a warehause delete are journaled.
+        """
+        engine = DailyReportEngine(directory=tempfile.mkdtemp(), fmt='csv')
+        bin_A10_01_02:Warehause = self.bin_dfn.create_instance(data={'value': 'A01-01-02', 'parent': self.warehouse, 'owner': self.owner})
+        self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 10.0, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 2.0, 'warehause': bin_A10_01_02, 'owner': self.owner})
+        engine.run()
+
+        # A movement whose id was handed out before the last applied one but that committed after the run
+        movement = {'owner': self.owner, 'product_id': uuid.uuid4(), 'dfn_id': self.chocolatebar_dfn.id, 'warehause_id': self.bin_A10_01_01.id}
+        late_id = StockMovement.objects.create(quantity=1.0, **movement).id
+        StockMovement.objects.filter(id=late_id).delete()
+        StockMovement.objects.create(quantity=3.0, **movement)
+        engine.run()
+        self.assertEqual(StockLevel.objects.get(warehause_id=self.bin_A10_01_01.id).quantity, 13.0)
+
+        StockMovement.objects.create(id=late_id, quantity=1.0, **movement)
+        bin_id = bin_A10_01_02.id
+        bin_A10_01_02.delete()
+        engine.run()
+        self.assertEqual(StockLevel.objects.get(warehause_id=self.bin_A10_01_01.id).quantity, 14.0)
+        self.assertEqual(StockLevel.objects.get(warehause_id=bin_id).quantity, 0.0)
+
+        # Deleting a client deletes its journal instead of journaling its products
+        other = Client.objects.create(group=Group.objects.create(name='other'))
+        other_bin:Warehause = self.bin_dfn.create_instance(data={'value': 'B01-01-01', 'owner': other})
+        self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 3.0, 'warehause': other_bin, 'owner': other})
+        other.delete()
+        self.assertFalse(StockMovement.objects.filter(warehause_id=other_bin.id).exists())
+
+class TestCase00015(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: list endpoints page with a cursor over (created_at, id) and with page numbers on request.
+        """
+        for i in range(5):
+            self.chocolatebar_dfn.create_instance(data={
+                'value': f'Chocolate Bar {i}',
+                'quantity': 1.0,
+                'warehause': self.bin_A10_01_01,
+                'owner': self.owner,
+            })
+        expected = [str(id) for id in Product.objects.order_by('created_at', 'id').values_list('id', flat=True)]
+
+        self.client.force_login(self.user)
+        url = reverse('product-list')
+
+        ids = list()
+        response = self.client.get(url, {'page_size': 2}).json()
+        self.assertIsNone(response['previous'])
+        while True:
+            ids.extend(product['id'] for product in response['results'])
+            if response['next'] is None:
+                break
+            previous = response
+            response = self.client.get(response['next']).json()
+        self.assertEqual(ids, expected)
+
+        # Walk back one page
+        response = self.client.get(response['previous']).json()
+        self.assertEqual([product['id'] for product in response['results']], [product['id'] for product in previous['results']])
+
+        response = self.client.get(url, {'page': 2, 'page_size': 2, 'count': 'approximate'}).json()
+        self.assertEqual(response['count'], 5)
+        self.assertTrue(response['count_is_approximate'])
+        self.assertEqual([product['id'] for product in response['results']], expected[2:4])
+
+class TestCase00016(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: a list page takes the same number of queries however many rows it has.
+        """
+        for i in range(5):
+            product:Product = self.chocolatebar_dfn.create_instance(data={
+                'value': f'Chocolate Bar {i}',
+                'quantity': 1.0,
+                'warehause': self.bin_A10_01_01,
+                'owner': self.owner,
+            })
+            self.purchaseorder_dfn.create_instance(data={
+                'external_id': f'PO{i}',
+                'warehause': self.bin_A10_01_01,
+                'user': self.user,
+                'parent': None,
+                'owner': self.owner,
+            })
+        self.chocolatebar_dfn.warehauses.add(self.bin_A10_01_01)
+
+        self.client.force_login(self.user)
+
+        for name in ('warehause-list', 'product-list', 'productdef-list', 'event-list',):
+            url = reverse(name)
+            self.client.get(url)
+
+            with CaptureQueriesContext(connection) as one:
+                response = self.client.get(url, {'page_size': 1})
+            self.assertEqual(len(response.json()['results']), 1)
+
+            with CaptureQueriesContext(connection) as many:
+                response = self.client.get(url, {'page_size': 5})
+            self.assertGreater(len(response.json()['results']), 1)
+
+            self.assertEqual(len(one), len(many), name)
+
+class TestCase00017(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: list pages rendered from field plans and orjson are the same as the ones rendered by the serializers.
+        """
+        for i in range(3):
+            self.chocolatebar_dfn.create_instance(data={
+                'value': f'Chocolate Bar {i}',
+                'quantity': 1.5,
+                'warehause': self.bin_A10_01_01,
+                'options': {'batch': f'B{i}', 'note': 'café  '},
+                'owner': self.owner,
+            })
+            self.purchaseorder_dfn.create_instance(data={
+                'external_id': f'PO{i}',
+                'warehause': self.bin_A10_01_01,
+                'user': self.user if i % 2 else None,
+                'owner': self.owner,
+            })
+        self.chocolatebar_dfn.warehauses.add(self.bin_A10_01_01, self.loadingarea)
+
+        self.client.force_login(self.user)
+
+        for name in ('warehausedef-list', 'warehause-list', 'productdef-list', 'product-list', 'eventdef-list', 'event-list',):
+            url = reverse(name)
+            with self.settings(API_FAST_SERIALIZERS=False, API_ORJSON=False):
+                expected = self.client.get(url, {'page_size': 100}).content
+            with self.settings(API_FAST_SERIALIZERS=True, API_ORJSON=True):
+                actual = self.client.get(url, {'page_size': 100}).content
+            self.assertEqual(actual, expected, name)
+
+class TestCase00018(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: exports stream every filtered object of the user's client as NDJSON or CSV.
+        """
+        for i in range(5):
+            self.chocolatebar_dfn.create_instance(data={
+                'value': f'Chocolate Bar {i}',
+                'quantity': float(i),
+                'warehause': self.bin_A10_01_01,
+                'owner': self.owner,
+            })
+
+        # Another client's products are never exported
+        other:Client = Client.objects.create(group=Group.objects.create(name='other'))
+        other_bin:Warehause = WarehauseDef.objects.create(key='Bin', is_storage=True, owner=other).create_instance(data={'value': 'B01', 'owner': other})
+        ProductDef.objects.create(key='Other', code_count=1, owner=other).create_instance(data={'value': 'Other', 'quantity': 9.0, 'warehause': other_bin, 'owner': other})
+
+        expected = [str(id) for id in Product.objects.filter(owner=self.owner, quantity__gt=0.0).order_by('created_at', 'id').values_list('id', flat=True)]
+
+        self.client.force_login(self.user)
+        url = reverse('product-export')
+
+        with self.settings(API_EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(url, {'format': 'ndjson', 'quantity__gt': 0.0})
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+            self.assertEqual([json.loads(line)['id'] for line in lines], expected)
+
+            response = self.client.get(url, {'format': 'csv', 'quantity__gt': 0.0})
+            self.assertTrue(response['Content-Type'].startswith('text/csv'))
+            rows = list(csv.DictReader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+            self.assertEqual([row['id'] for row in rows], expected)
+            self.assertEqual(json.loads(rows[0]['dfn'])['key'], 'Chocolate Bar')
+
+class TestCase00019(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: bulk spawn, update and delete validate every item and write all of them in one transaction.
+        """
+        self.client.force_login(self.user)
+
+        # Spawn
+        items = [{'dfn': str(self.chocolatebar_dfn.id), 'value': f'Chocolate Bar {i}', 'quantity': 1.0, 'warehause': str(self.bin_A10_01_01.id)} for i in range(3)]
+        response = self.client.post(reverse('productdef-bulk-spawn'), items, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        ids = [result['id'] for result in response.json()['results']]
+        self.assertEqual(Product.objects.filter(id__in=ids).count(), 3)
+
+        # One bad item and nothing is changed
+        items = [{'id': id, 'quantity': 2.0, 'options': {'batch': 'B1'}} for id in ids] + [{'id': ids[0], 'created_at': '2024-01-01T00:00:00Z'}]
+        response = self.client.patch(reverse('product-bulk'), items, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json()['results'][3])
+        self.assertFalse(Product.objects.filter(id__in=ids, quantity=2.0).exists())
+
+        movements = StockMovement.objects.count()
+        response = self.client.patch(reverse('product-bulk'), items[:3], content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Product.objects.filter(id__in=ids, quantity=2.0, options__batch='B1').count(), 3)
+        self.assertEqual(StockMovement.objects.count(), movements + 3)
+
+        # Delete
+        response = self.client.delete(reverse('product-bulk'), ids[:2], content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Product.objects.filter(id__in=ids).values_list('id', flat=True)), [Product.objects.get(id=ids[2]).id])
+
+    def test_0002(self):
+        """
+        Test: bulk update only sets users of the owner's client group and runs the callbacks, and bulk spawn errors only
+        hold the message.
+        """
+        self.client.force_login(self.user)
+
+        product = self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 1.0, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        stranger = User.objects.create(username='stranger', password='testpassword')
+        stranger.groups.add(Group.objects.create(name='other'))
+        Client.objects.create(group=stranger.groups.get())
+
+        response = self.client.patch(reverse('warehause-bulk'), [{'id': str(self.bin_A10_01_01.id), 'user': stranger.id}], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('user', response.json()['results'][0]['error'])
+
+        response = self.client.patch(reverse('warehause-bulk'), [{'id': str(self.bin_A10_01_01.id), 'user': self.user.id}], content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Warehause.objects.get(id=self.bin_A10_01_01.id).user_id, self.user.id)
+
+        # ProductCallback.pre_save() rejects a warehause that is not storage
+        response = self.client.patch(reverse('product-bulk'), [{'id': str(product.id), 'warehause': str(self.warehouse.id)}], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('is_storage is False', response.json()['results'][0]['error'])
+        self.assertEqual(Product.objects.get(id=product.id).warehause_id, self.bin_A10_01_01.id)
+
+        items = [{'dfn': str(self.chocolatebar_dfn.id), 'value': 'Chocolate Bar', 'quantity': 1.0, 'warehause': str(self.warehouse.id)}]
+        response = self.client.post(reverse('productdef-bulk-spawn'), items, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('Extra', response.json()['results'][0]['error'])
+
+class TestCase00020(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: unchanged lists and objects answer 304 Not Modified and If-Match rejects updates of a stale version.
+        """
+        self.client.force_login(self.user)
+
+        list_url = reverse('productdef-list')
+        response = self.client.get(list_url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(list_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(list_url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        detail_url = reverse('productdef-detail', kwargs={'id': self.chocolatebar_dfn.id})
+        response = self.client.get(detail_url)
+        detail_etag = response['ETag']
+        self.assertEqual(self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).status_code, 304)
+
+        response = self.client.patch(detail_url, {'weight': 0.25}, content_type='application/json', HTTP_IF_MATCH=detail_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], detail_etag)
+
+        # Another client still holds the old version
+        response = self.client.patch(detail_url, {'weight': 0.3}, content_type='application/json', HTTP_IF_MATCH=detail_etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(ProductDef.objects.get(id=self.chocolatebar_dfn.id).weight, 0.25)
+
+        self.assertEqual(self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).status_code, 200)
+        self.assertEqual(self.client.get(list_url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_0002(self):
+        """
+        Test: entity tags change when a related row the objects are rendered with changes.
+        """
+        self.client.force_login(self.user)
+
+        product = self.chocolatebar_dfn.create_instance(data={'value': 'Chocolate Bar', 'quantity': 1.0, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        self.bin_A10_01_01.user = self.user
+        self.bin_A10_01_01.save()
+
+        urls = [
+            reverse('product-detail', kwargs={'id': product.id}),
+            reverse('product-list'),
+            reverse('productdef-detail', kwargs={'id': self.chocolatebar_dfn.id}),
+            reverse('productdef-list'),
+            reverse('warehause-detail', kwargs={'id': self.bin_A10_01_01.id}),
+        ]
+
+        def get_etags():
+            return [self.client.get(url)['ETag'] for url in urls]
+
+        etags = get_etags()
+
+        # The product renders the key of its definition
+        self.chocolatebar_dfn.key = 'Chocolate'
+        self.chocolatebar_dfn.save()
+        changed = get_etags()
+        self.assertNotEqual(changed[0], etags[0])
+        self.assertNotEqual(changed[1], etags[1])
+
+        # The definition renders the warehauses it can be stored in
+        etags = changed
+        self.chocolatebar_dfn.warehauses.add(self.bin_A10_01_01)
+        changed = get_etags()
+        self.assertNotEqual(changed[2], etags[2])
+        self.assertNotEqual(changed[3], etags[3])
+
+        # The warehause renders the username of its user
+        etags = changed
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertNotEqual(get_etags()[4], etags[4])
+
+class TestCase00021(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: the clients of a user are looked up once and reused until the user's groups or the clients change.
+        """
+        self.client.force_login(self.user)
+        url = reverse('productdef-detail', kwargs={'id': self.chocolatebar_dfn.id})
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([query for query in queries if 'core_client' in query['sql']])
+
+        # Leaving the client's group takes effect straight away
+        self.user.groups.remove(self.group)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.user.groups.add(self.group)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+class TestCase00022(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: API tokens are authenticated from the cache until they are rotated.
+        """
+        token = Token.objects.create(user=self.user)
+        url = reverse('productdef-list')
+
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=f'Token {token.key}').status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=f'Token {token.key}').status_code, 200)
+        self.assertFalse([query for query in queries if 'authtoken_token' in query['sql']])
+
+        # Rotate the token like python manage.py authtoken --delete
+        call_command('authtoken', self.user.username, '--delete', stdout=StringIO())
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=f'Token {token.key}').status_code, 401)
+
+    def test_0002(self):
+        """
+        Test: other processes drop their cached tokens when the version stamp changes.
+        """
+        cache = TokenCache()
+        cache.get('key')
+        cache.set('key', self.user, None)
+        self.assertIsNotNone(cache.get('key'))
+
+        CacheVersion.bump(TOKEN_CACHE_NAME)
+        with self.settings(AUTH_TOKEN_CACHE_VERSION_INTERVAL=0):
+            self.assertIsNone(cache.get('key'))
+
+class TestCase00023(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: searches find objects by key, value, external_id and options['values'] through the search index, best match first.
+        """
+        self.client.force_login(self.user)
+        url = reverse('product-list')
+
+        if connection.vendor == 'sqlite':
+            self.assertEqual(get_search_backend(), SEARCH_FTS5)
+
+        scanned = self.chocolatebar_dfn.create_instance(data={'value': 'CB-0001', 'external_id': 'ERP-77', 'options': {'values': ['9300000000017']}, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        repeated = self.chocolatebar_dfn.create_instance(data={'value': 'CB-0002 CB-0002 CB-0002', 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+
+        def search(query):
+            response = self.client.get(url, {'search': query})
+            self.assertEqual(response.status_code, 200)
+            return [product['id'] for product in response.json()['results']]
+
+        self.assertEqual(search('cb-0001'), [str(scanned.id)])
+        self.assertEqual(search('erp-77'), [str(scanned.id)])
+        self.assertEqual(search('93000000'), [str(scanned.id)])
+        self.assertEqual(search('CB-000')[:2], [str(repeated.id), str(scanned.id)])
+        self.assertEqual(search('"CB'), [])
+
+        # Saving and deleting objects keeps the index up to date, and so do bulk updates
+        scanned.value = 'CB-0003'
+        scanned.save()
+        self.assertEqual(search('cb-0001'), [])
+        self.assertEqual(search('cb-0003'), [str(scanned.id)])
+
+        repeated.value = 'CB-0004'
+        Product.bulk_save([repeated], fields=['value'])
+        self.assertEqual(search('cb-0004'), [str(repeated.id)])
+
+        repeated.delete()
+        self.assertEqual(search('cb-0004'), [])
+        self.assertFalse(SearchIndex.objects.filter(object_id=repeated.id).exists())
+
+    def test_0002(self):
+        """
+        Test: searches find objects by id, and deleting objects in bulk removes their index rows with a fixed number of
+        queries.
+        """
+        self.client.force_login(self.user)
+        url = reverse('product-list')
+
+        products = [self.chocolatebar_dfn.create_instance(data={'value': f'CB-{i:04}', 'warehause': self.bin_A10_01_01, 'owner': self.owner}) for i in range(50)]
+
+        response = self.client.get(url, {'search': str(products[0].id)})
+        self.assertEqual([product['id'] for product in response.json()['results']], [str(products[0].id)])
+
+        with CaptureQueriesContext(connection) as queries:
+            Product.bulk_delete(products)
+        self.assertLess(len(queries), 20)
+        self.assertFalse(SearchIndex.objects.filter(object_id__in=[product.id for product in products]).exists())
+
+class TestCase00024(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: the options filters of registered options keys match through OptionsIndex instead of the options JSON.
+        """
+        self.client.force_login(self.user)
+        url = reverse('product-list')
+
+        scanned = self.chocolatebar_dfn.create_instance(data={'options': {'values': ['9300000000017', 'CB-0001']}, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        weighed = self.chocolatebar_dfn.create_instance(data={'options': {'values': [250]}, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+
+        def filter(**params):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse([query for query in queries if '"core_product"."options" LIKE' in query['sql'] or 'JSON_EXTRACT' in query['sql']])
+            return {product['id'] for product in response.json()['results']}
+
+        self.assertEqual(filter(options__values='CB-0001'), {str(scanned.id)})
+        self.assertEqual(filter(options__values='CB-000'), set())
+        self.assertEqual(filter(options__values__gte=200), {str(weighed.id)})
+        self.assertNotIn(str(scanned.id), filter(options__values__exclude='9300000000017'))
+        self.assertNotIn(str(scanned.id), filter(options__values__isnull=True))
+        self.assertEqual(filter(options__values__isnotnull=True), {str(scanned.id), str(weighed.id)})
+
+        # Saving, bulk saving and deleting objects keeps the index up to date
+        scanned.options = {'values': ['CB-0002']}
+        scanned.save()
+        self.assertEqual(filter(options__values='CB-0001'), set())
+        self.assertEqual(filter(options__values='CB-0002'), {str(scanned.id)})
+
+        weighed.options = {'values': ['CB-0003']}
+        Product.bulk_save([weighed], fields=['options'])
+        self.assertEqual(filter(options__values='CB-0003'), {str(weighed.id)})
+
+        weighed.delete()
+        self.assertFalse(OptionsIndex.objects.filter(object_id=weighed.id).exists())
+
+    def test_0002(self):
+        """
+        Test: prefix options keys match values that start with the filter value.
+        """
+        product = self.chocolatebar_dfn.create_instance(data={'options': {'values': ['CB-0001']}, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        options_filter = get_options_filters({'values': OPTIONS_MATCH_PREFIX})['options__values']
+
+        self.assertEqual(list(options_filter.filter(Product.objects.all(), 'CB-0')), [product])
+        self.assertEqual(list(options_filter.filter(Product.objects.all(), 'cb-0')), [])
+
+    def test_0003(self):
+        """
+        Test: the index receivers only listen to the searchable models so the other models are deleted without loading
+        their objects.
+        """
+        self.assertTrue(Collector(using='default').can_fast_delete(StockMovement.objects.all()))
+        self.assertTrue(Collector(using='default').can_fast_delete(SearchIndex.objects.all()))
+        self.assertFalse(Collector(using='default').can_fast_delete(Product.objects.all()))
+
+class TestCase00025(WarehauserTestCase):
+    def test_0001(self):
+        """
+        Test: scanned values resolve to products and warehauses by value and options['values'] with one query, then from the cache.
+        """
+        lookup_cache.clear()
+        self.client.force_login(self.user)
+
+        product = self.chocolatebar_dfn.create_instance(data={'value': '9300000000017', 'options': {'values': ['CB-0001']}, 'warehause': self.bin_A10_01_01, 'owner': self.owner})
+        self.bin_A10_01_01.options = {'values': ['9300000000017']}
+        self.bin_A10_01_01.save()
+        url = reverse('lookup-detail', kwargs={'value': '9300000000017'})
+
+        self.client.get(reverse('productdef-list'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([query for query in queries if 'core_product' in query['sql']]), 1)
+        results = response.json()['results']
+        self.assertEqual([(result['type'], result['id'], result['matched']) for result in results], [
+            ('product', str(product.id), 'value'),
+            ('warehause', str(self.bin_A10_01_01.id), 'options'),
+        ])
+
+        # Hot values are answered from the cache
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([query for query in queries if 'core_product' in query['sql']])
+
+        self.assertEqual(self.client.get(reverse('lookup-detail', kwargs={'value': 'CB-0001'})).json()['results'][0]['id'], str(product.id))
+
+        # Changing the value drops the cached lookups of the product
+        product.value = 'CB-0002'
+        product.save()
+        self.assertEqual([result['type'] for result in self.client.get(url).json()['results']], ['warehause'])
+        self.assertEqual(self.client.get(reverse('lookup-detail', kwargs={'value': 'CB-0002'})).status_code, 200)
+
+        # Other clients' objects are not found
+        other = Client.objects.create(group=Group.objects.create(name='other'))
+        self.bin_A10_01_01.owner = other
+        self.bin_A10_01_01.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+class OverrunningEventSupervisor(EventSupervisor):
+    # Worker processes that overrun any time limit, or fail with an exit code
+    exitcode = None
+
+    def _create_process(self, event):
+        if self.exitcode is not None:
+            return self._context.Process(target=os._exit, args=(self.exitcode,), daemon=True)
+        return self._context.Process(target=time.sleep, args=(60,), daemon=True)
+
+class TestCase00026(WarehauserTestCase):
+    def _event(self, timeout:float=None) -> Event:
+        event:Event = self.outbound_dfn.create_instance(data={'value': 'outbound', 'is_batched': True})
+        event.timeout = timeout
+        event.save()
+        return event
+
+    def test_0001(self):
+        """
+        Test: an event process overrunning its wall clock time limit is killed and the event set to STATUS_FAILED.
+        """
+        supervisor = OverrunningEventSupervisor(processes=1)
+        event = self._event(timeout=0.5)
+
+        self.assertTrue(supervisor.acquire(event.owner_id))
+        started = time.monotonic()
+        with self.assertRaises(WarehauserError) as e:
+            supervisor.process(event=event, timeout=0.5)
+        supervisor.release(event.owner_id)
+
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertEqual(e.exception.code, WarehauserErrorCodes.EVENT_TIMEOUT)
+        event.refresh_from_db()
+        self.assertEqual(event.status, STATUS_FAILED)
+        self.assertEqual(event.options['error']['code'], WarehauserErrorCodes.EVENT_TIMEOUT)
+
+    def test_0002(self):
+        """
+        Test: an event process exiting with an error sets the event to STATUS_FAILED.
+        """
+        supervisor = OverrunningEventSupervisor(processes=1)
+        supervisor.exitcode = 3
+        event = self._event(timeout=30)
+
+        with self.assertRaises(WarehauserError) as e:
+            supervisor.process(event=event, timeout=30)
+
+        self.assertEqual(e.exception.code, WarehauserErrorCodes.EVENT_PROCESS_ERROR)
+        event.refresh_from_db()
+        self.assertEqual(event.status, STATUS_FAILED)
+
+    def test_0003(self):
+        """
+        Test: worker process slots are shared between clients and the event queue only dispatches events a slot is free for.
+        """
+        other = Client.objects.create(group=Group.objects.create(name='other'))
+        supervisor = OverrunningEventSupervisor(processes=2, processes_per_client=1)
+
+        self.assertTrue(supervisor.acquire(self.owner.id))
+        self.assertFalse(supervisor.acquire(self.owner.id))
+        self.assertTrue(supervisor.acquire(other.id))
+        self.assertFalse(supervisor.acquire(Client.objects.create(group=Group.objects.create(name='third')).id))
+
+        # Events with a time limit stay queued while their client has no free slot, events without one are dispatched
+        limited = self._event(timeout=30)
+        unlimited = self._event()
+        with mock.patch.object(tasks, 'get_event_supervisor', return_value=supervisor), mock.patch.object(tasks.EventProcessThread, 'start') as start:
+            tasks.EventQueueTask().process()
+        self.assertEqual(start.call_count, 1)
+        limited.refresh_from_db()
+        unlimited.refresh_from_db()
+        self.assertEqual(limited.status, STATUS_OPEN)
+        self.assertNotEqual(unlimited.status, STATUS_OPEN)
+
+        # The slot is handed back when the killed event's thread finishes
+        supervisor.release(self.owner.id)
+        with mock.patch.object(tasks, 'get_event_supervisor', return_value=supervisor):
+            with mock.patch.object(tasks.EventProcessThread, 'start') as start:
+                tasks.EventQueueTask().process()
+            self.assertEqual(start.call_count, 1)
+            self.assertFalse(supervisor.acquire(self.owner.id))
+
+            limited.refresh_from_db()
+            limited.timeout = 0.5
+            limited.save()
+            with self.assertRaises(WarehauserError):
+                tasks.EventProcessThread(limited, supervised=True).run()
+        limited.refresh_from_db()
+        self.assertEqual(limited.status, STATUS_FAILED)
+        self.assertTrue(supervisor.acquire(self.owner.id))
+
+class TestCase00027(WarehauserTransactionTestCase):
+    def _spawn(self):
+        self.client.force_login(self.user)
+        url = reverse('eventdef-do-spawn', kwargs={'id': self.outbound_dfn.id})
+        return self.client.post(url, {'options': {'warehause': str(self.loadingarea.id)}}, content_type='application/json')
+
+    @override_settings(EVENT_INLINE_BUDGET=30)
+    def test_0001(self):
+        """
+        Test: an event processed within the inline budget is returned processed.
+        """
+        response = self._spawn()
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.json()['proc_end'])
+        self.assertFalse(response.json()['is_batched'])
+        self.assertFalse(Warehause.objects.filter(id=self.loadingarea.id).exists())
+
+    @override_settings(EVENT_INLINE_BUDGET=0.2)
+    def test_0002(self):
+        """
+        Test: an event overrunning the inline budget is handed to the batch processor and finished by its own thread.
+        """
+        release = threading.Event()
+        outbound = importlib.import_module('logic.demo.tasks').outbound
+        def slow_outbound(event):
+            release.wait(30)
+            outbound(event)
+
+        with mock.patch('logic.demo.tasks.outbound', slow_outbound), mock.patch('core.views.notify_event_queue') as notify:
+            spawned = timezone.now()
+            response = self._spawn()
+            self.assertEqual(response.status_code, 202)
+            event = Event.objects.get(id=response.json()['id'])
+            self.assertTrue(event.is_batched)
+            self.assertIsNone(event.proc_end)
+
+            # The hand over is a new version of the event and wakes up the event queue
+            self.assertGreaterEqual(event.updated_at, spawned + timedelta(seconds=0.2))
+            notify.assert_called()
+
+            release.set()
+            for thread in threading.enumerate():
+                if isinstance(thread, EventInlineProcessThread):
+                    thread.join(30)
+
+        event.refresh_from_db()
+        self.assertTrue(event.is_batched)
+        self.assertIsNotNone(event.proc_end)
+        self.assertFalse(Warehause.objects.filter(id=self.loadingarea.id).exists())
+
+class TestCase00028(WarehauserTestCase):
+    @override_settings(GARBAGE_COLLECTOR_CHUNK_SIZE=2)
+    def test_0001(self):
+        """
+        Test: the garbage collector deletes in chunks, and falls back to deleting a chunk one object at a time when one of its
+        objects is protected.
+        """
+        products = [self.virtual_product_dfn.create_instance(data={'value': f'virtual {i}', 'warehause': self.bin_A10_01_01, 'owner': self.owner}) for i in range(5)]
+        Product.objects.filter(id__in=[product.id for product in products]).update(status=STATUS_DESTROY)
+        protected = sorted(products, key=lambda product: product.id)[2]
+
+        def protect(sender, instance, **kwargs):
+            if instance.id == protected.id:
+                raise ProtectedError('protected', [instance])
+
+        pre_delete.connect(protect, sender=Product)
+        try:
+            collected = tasks.GarbageCollectorTask()._collect(Product.objects.filter(is_virtual=True, status=STATUS_DESTROY))
+        finally:
+            pre_delete.disconnect(protect, sender=Product)
+
+        self.assertEqual(collected, 4)
+        self.assertEqual(list(Product.objects.filter(id__in=[product.id for product in products]).values_list('id', flat=True)), [protected.id])
+
+class TestCase00029(WarehauserTestCase):
+    def _event(self, value:str, **fields) -> Event:
+        event:Event = self.outbound_dfn.create_instance(data={'value': value, 'is_batched': True})
+        Event.objects.filter(id=event.id).update(**fields)
+        event.refresh_from_db()
+        return event
+
+    def test_0001(self):
+        """
+        Test: the event queue only claims events that are still OPEN, so an event claimed elsewhere is not dispatched twice.
+        """
+        task = tasks.EventQueueTask()
+        first = self._event('outbound 001')
+        second = self._event('outbound 002')
+
+        # Another pass claims the second event between this pass reading and claiming it
+        Event.objects.filter(id=second.id).update(status=STATUS_PROCESSING)
+        self.assertEqual(task._claim([first, second]), {first.id})
+        self.assertEqual(Event.objects.get(id=first.id).status, STATUS_PROCESSING)
+        self.assertEqual(task._claim([first, second]), set())
+
+    def test_0003(self):
+        """
+        Test: the event queue dispatches the claimed events as read after the claim, with the options a duplicate coalesced
+        into them after they were loaded.
+        """
+        event = self._event('outbound 001')
+        claim = tasks.EventQueueTask._claim
+
+        def coalesce_then_claim(task, events):
+            Event.objects.filter(id=event.id).update(options={**(event.options or dict()), 'coalesced': True})
+            return claim(task, events)
+
+        with mock.patch.object(tasks.EventQueueTask, '_claim', coalesce_then_claim), mock.patch.object(tasks, 'EventProcessThread') as thread:
+            tasks.EventQueueTask().process()
+
+        dispatched = thread.call_args.args[0]
+        self.assertEqual(dispatched.id, event.id)
+        self.assertEqual(dispatched.status, STATUS_PROCESSING)
+        self.assertTrue(dispatched.options['coalesced'])
+
+    @override_settings(EVENT_PROCESSING_TIMEOUT=60)
+    def test_0002(self):
+        """
+        Test: events abandoned in STATUS_PROCESSING are reopened if their process never started and failed otherwise.
+        """
+        stale = timezone.now() - timedelta(seconds=120)
+        claimed = self._event('outbound 001', status=STATUS_PROCESSING, updated_at=stale)
+        started = self._event('outbound 002', status=STATUS_PROCESSING, updated_at=stale, proc_start=stale)
+        recent = self._event('outbound 003', status=STATUS_PROCESSING, updated_at=timezone.now(), proc_start=timezone.now())
+        limited = self._event('outbound 004', status=STATUS_PROCESSING, updated_at=stale, proc_start=stale, timeout=600)
+        locked = self._event('outbound 005', status=STATUS_PROCESSING, updated_at=stale, proc_start=stale)
+
+        with db_mutex(f'event:{locked.id}'):
+            tasks.EventReaperTask()()
+
+        statuses = dict(Event.objects.filter(id__in=[claimed.id, started.id, recent.id, limited.id, locked.id]).values_list('id', 'status'))
+        self.assertEqual(statuses, {
+            claimed.id: STATUS_OPEN,
+            started.id: STATUS_FAILED,
+            recent.id:  STATUS_PROCESSING,
+            limited.id: STATUS_PROCESSING,
+            locked.id:  STATUS_PROCESSING,
+        })
+        self.assertEqual(Event.objects.get(id=started.id).options['error']['code'], WarehauserErrorCodes.EVENT_ABANDONED)
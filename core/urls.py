@@ -27,6 +27,9 @@ router.register(prefix=r'productdefs',   viewset=views.ProductDefViewSet,   base
 router.register(prefix=r'products',      viewset=views.ProductViewSet,      basename='product')
 router.register(prefix=r'eventdefs',     viewset=views.EventDefViewSet,     basename='eventdef')
 router.register(prefix=r'events',        viewset=views.EventViewSet,        basename='event')
+router.register(prefix=r'metrics/events', viewset=views.EventMetricViewSet, basename='eventmetric')
+router.register(prefix=r'metrics/queues', viewset=views.QueueDepthViewSet, basename='queuedepth')
+router.register(prefix=r'lookup',        viewset=views.LookupViewSet,       basename='lookup')
 
 urlpatterns = [
     path('api/', include(router.urls)),
@@ -23,6 +23,8 @@ import string
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.hashers import make_password, check_password
 from django.core.exceptions import ValidationError
+from django.db import NotSupportedError
+from django.db.models import Func, JSONField
 
 def validate_password(password:str) -> bool:
     """
@@ -90,6 +92,9 @@ class WarehauserErrorCodes(IntEnum):
     WAREHAUSE_NOT_CONTAINS              = 21
     WAREHAUSE_STOCK_NOT_FOUND           = 22
     STATUS_ERROR                        = 23
+    EVENT_TIMEOUT                       = 24
+    EVENT_PROCESS_ERROR                 = 25
+    EVENT_ABANDONED                     = 26
 
 class WarehauserError(Exception):
     def __init__(self, msg, code, extra=None):
@@ -137,6 +142,40 @@ def debug_func(func):
         return result
     return func_mod
 
+JSON_REMOVE_KEY_VENDORS = ('postgresql', 'sqlite', 'mysql',)
+
+class JSONRemoveKey(Func):
+    """
+    Database expression removing a top level key from a JSONField, for set based updates such as
+    UserAux.objects.filter(...).update(options=JSONRemoveKey('options', 'send_mail')).
+
+    Only supported by the database vendors in JSON_REMOVE_KEY_VENDORS. Use supports_json_remove_key() to check before use and
+    fall back to updating the objects in Python otherwise.
+    """
+    output_field = JSONField()
+
+    def __init__(self, expression, key:str, **extra):
+        super().__init__(expression, **extra)
+        self.key = key
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError(f'JSONRemoveKey is not supported on {connection.vendor}.')
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f'({sql} - %s::text)', (*params, self.key,)
+
+    def _as_json_remove(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        path = '$."{}"'.format(self.key.replace('\\', '\\\\').replace('"', '\\"'))
+        return f'JSON_REMOVE({sql}, %s)', (*params, path,)
+
+    as_sqlite = _as_json_remove
+    as_mysql = _as_json_remove
+
+def supports_json_remove_key(connection) -> bool:
+    return connection.vendor in JSON_REMOVE_KEY_VENDORS
+
 @lambda _: _()
 def server_start_time() -> str:
     """
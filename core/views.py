@@ -15,6 +15,8 @@
 # views.py
 
 import json
+import logging
+import threading
 
 from datetime import datetime, timedelta
 from typing import Any, List
@@ -27,29 +29,47 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse, JsonResponse
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
 # from django.templatetags.static import static
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext as _
 from django.utils import translation
 
+from db_mutex.db_mutex import db_mutex
+
+from jsonschema import ValidationError as JSONSchemaValidationError
+
 from django_filters.rest_framework import DjangoFilterBackend
 
 from rest_framework import generics, viewsets, status
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
-from rest_framework.filters import SearchFilter
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from rest_framework.renderers import JSONRenderer
 
+from .callbacks import EventCallback, ProductCallback, WarehauseCallback
+from .conditional import get_instance_validators, get_queryset_validators, set_validators
+from .fairqueue import get_queue_depths
 from .filters import *
 from .forms import *
+from .lookup import lookup_cache
+from .metrics import event_metrics
 from .models import *
+from .pagination import WarehauserPagination
+from .plans import FieldPlan
 from .permissions import *
+from .renderers import CSVRenderer, NDJSONRenderer, WarehauserJSONRenderer, render_csv
+from .search import WarehauserSearchFilter
 from .serializers import *
+from .tenancy import get_client_ids
+from .wakeup import notify_event_queue
+from .utils import WarehauserError
 
 # Create your views here.
 
@@ -74,16 +94,24 @@ from .serializers import *
 class WarehauserBaseViewSet(viewsets.ModelViewSet):
     lookup_field = 'id'
     permission_classes = [WarehauserPermission,]
-    renderer_classes = [JSONRenderer,]
-    search_fields = ['id', 'external_id', 'options__values__contains', 'value', 'descr', 'owner']
+    renderer_classes = [WarehauserJSONRenderer,]
+    pagination_class = WarehauserPagination
+
+    # Related fields rendered by the serializer. Foreign keys are joined with select_related() and many to many fields are
+    # loaded with prefetch_related().
+    select_related_fields = ()
+    prefetch_related_fields = ()
 
-    # API filtering
-    filter_backends = [DjangoFilterBackend, SearchFilter,]
+    # Callback class run on the objects changed by a bulk update like create_instance() sets one on new objects
+    callback_class = None
+
+    # API filtering. ?search= searches the id, key, value, external_id and options['values'] of objects through the search index.
+    filter_backends = [DjangoFilterBackend, WarehauserSearchFilter,]
 
     def _protect_fields(self, user, data:list, create:bool=False):
         # Prevent altering id, updated_at, or created_at fields
 
-        field_names = ['id', 'updated_at', 'created_at']
+        field_names = ['id', 'updated_at', 'created_at', 'pending_children']
 
         if not user.is_staff and not user.is_superuser:
             field_names.append('owner')
@@ -104,13 +132,316 @@ class WarehauserBaseViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        queryset = self.serializer_class.Meta.model.objects.all()
+
+        # Load the related objects the serializer renders with the rows instead of one query per row
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        if self.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*self.prefetch_related_fields)
 
         # If the user is staff or superuser, they can see all objects
         if user.is_staff or user.is_superuser:
-            return self.serializer_class.Meta.model.objects.all().order_by('created_at', 'updated_at')
+            return queryset.order_by('created_at', 'id')
 
         # Otherwise, only show objects the user has access to
-        return self.serializer_class.Meta.model.objects.filter(owner__group__in=user.groups.all()).order_by('created_at', 'updated_at')
+        return queryset.filter(owner_id__in=get_client_ids(self.request)).order_by('created_at', 'id')
+
+    def get_read_plan(self):
+        """
+        Get the read plan that renders list pages from QuerySet.values() rows instead of through the serializer.
+
+        Returns:
+            FieldPlan: the plan or None to use the serializer.
+        """
+        if not getattr(settings, 'API_FAST_SERIALIZERS', True):
+            return None
+        return FieldPlan.get(self.get_serializer_class())
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+
+        etag, last_modified = get_instance_validators(instance)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = Response(self.get_serializer(instance).data)
+
+        return set_validators(response, etag, last_modified)
+
+    def list(self, request, *args, **kwargs):
+        # Answer 304 Not Modified from the count and latest update of the listed objects before serializing any of them
+        etag, last_modified = get_queryset_validators(
+            self.filter_queryset(self.get_queryset()),
+            request.get_full_path(), request.accepted_media_type, request.user.pk,
+        )
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self._list(request, *args, **kwargs)
+
+        return set_validators(response, etag, last_modified)
+
+    def _list(self, request, *args, **kwargs):
+        plan = self.get_read_plan()
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+
+        rows = plan.values(self.filter_queryset(self.get_queryset()))
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(plan.render(page))
+
+        return Response(plan.render(rows))
+
+    def _iter_export(self, queryset, chunk_size:int):
+        # Yield chunks of representations read through a server side cursor so memory use does not grow with the export
+        plan = self.get_read_plan()
+        rows = plan.values(queryset) if plan is not None else queryset.prefetch_related(None)
+
+        chunk = list()
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield plan.render(chunk) if plan is not None else self.get_serializer(chunk, many=True).data
+                chunk = list()
+        if chunk:
+            yield plan.render(chunk) if plan is not None else self.get_serializer(chunk, many=True).data
+
+    def _stream_ndjson(self, queryset, chunk_size:int):
+        renderer = WarehauserJSONRenderer()
+        for chunk in self._iter_export(queryset, chunk_size=chunk_size):
+            yield b''.join(renderer.render(representation) + b'\n' for representation in chunk)
+
+    def _stream_csv(self, queryset, chunk_size:int):
+        header = True
+        for chunk in self._iter_export(queryset, chunk_size=chunk_size):
+            if chunk:
+                yield render_csv(chunk, header=list(chunk[0].keys()) if header else None).encode('utf-8')
+                header = False
+
+    @action(detail=False, methods=['get'], url_path='export', renderer_classes=[NDJSONRenderer, CSVRenderer,])
+    def export(self, request, *args, **kwargs):
+        """
+        Export every object matching the request filters as newline delimited JSON (?format=ndjson) or CSV (?format=csv).
+        Objects are streamed in API_EXPORT_CHUNK_SIZE chunks instead of being paged.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        chunk_size = getattr(settings, 'API_EXPORT_CHUNK_SIZE', 2000)
+        renderer = request.accepted_renderer
+
+        if renderer.format == CSVRenderer.format:
+            stream = self._stream_csv(queryset, chunk_size=chunk_size)
+        else:
+            stream = self._stream_ndjson(queryset, chunk_size=chunk_size)
+
+        response = StreamingHttpResponse(stream, content_type=renderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.basename}s.{renderer.format}"'
+        return response
+
+    def _get_bulk_items(self, request) -> list:
+        items = request.data
+        limit = getattr(settings, 'API_BULK_MAX_ITEMS', 1000)
+
+        if not isinstance(items, list):
+            raise ValidationError({'error': _('Expected a list of objects.')})
+        if len(items) > limit:
+            raise ValidationError({'error': _(f'At most {limit} objects can be changed per request.')})
+
+        return items
+
+    def _bulk_response(self, results:list, http_status:int):
+        # Nothing is written unless every item is valid
+        if any('error' in result for result in results):
+            return Response({'results': results}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': results}, status=http_status)
+
+    def _get_bulk_instances(self, items:list, results:list) -> dict:
+        # Load all the objects of a bulk request in one query, scoped to the user's objects like get_object()
+        ids = dict()
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            id = item.get('id') if isinstance(item, dict) else item
+            try:
+                ids[i] = self.serializer_class.Meta.model._meta.pk.to_python(id)
+            except DjangoValidationError:
+                ids[i] = None
+            if ids[i] is None:
+                results[i] = {'id': id, 'error': _('Expected an object id.')}
+
+        instances = self.get_queryset().in_bulk([id for id in ids.values() if id is not None])
+        for i, id in ids.items():
+            if id is not None and id not in instances:
+                results[i] = {'id': id, 'error': _('Not found.')}
+
+        return {i: instances[id] for i, id in ids.items() if id in instances}
+
+    def _get_bulk_fields(self) -> dict:
+        protected = {'id', 'updated_at', 'created_at', 'pending_children', 'owner',}
+        return {
+            field.name: field for field in self.serializer_class.Meta.model._meta.concrete_fields
+            if field.editable and field.name not in protected
+        }
+
+    def _apply_bulk_changes(self, instances:dict, items:list, results:list) -> tuple:
+        """
+        Validate the changes of a bulk update and apply them to the loaded objects.
+
+        Returns:
+            tuple: (list of changed objects, set of changed field names).
+        """
+        fields = self._get_bulk_fields()
+
+        # Check every related object exists and belongs to the same client in one query per related field
+        related = dict()
+        for name, field in fields.items():
+            if not field.is_relation:
+                continue
+            values = set()
+            for i, instance in instances.items():
+                if items[i].get(name) is not None:
+                    try:
+                        values.add(field.target_field.to_python(items[i][name]))
+                    except DjangoValidationError:
+                        pass
+            owners = field.related_model.objects.filter(pk__in=values)
+            if hasattr(field.related_model, 'owner_id'):
+                related[name] = {pk: {owner_id} for pk, owner_id in owners.values_list('pk', 'owner_id')}
+            elif field.related_model is User:
+                # A user belongs to the clients whose group they are a member of
+                related[name] = {pk: set() for pk in owners.values_list('pk', flat=True)}
+                for pk, client_id in Client.objects.filter(group__user__in=values).values_list('group__user', 'id'):
+                    related[name][pk].add(client_id)
+            else:
+                related[name] = {pk: None for pk in owners.values_list('pk', flat=True)}
+
+        callback = self.callback_class() if self.callback_class is not None else None
+
+        changed = list()
+        changed_fields = set()
+        for i, instance in instances.items():
+            item = items[i]
+            errors = dict()
+            changes = dict()
+
+            for name, value in item.items():
+                if name == 'id':
+                    continue
+                field = fields.get(name)
+                if field is None:
+                    errors[name] = _(f'Cannot set field \'{name}\'.')
+                elif field.is_relation:
+                    if value is None:
+                        if not field.null:
+                            errors[name] = _('This field may not be null.')
+                        else:
+                            changes[field.attname] = None
+                        continue
+                    try:
+                        value = field.target_field.to_python(value)
+                    except DjangoValidationError as e:
+                        errors[name] = ' '.join(e.messages)
+                        continue
+                    if value not in related[name]:
+                        errors[name] = _('Not found.')
+                    elif related[name][value] is not None and instance.owner_id not in related[name][value]:
+                        errors[name] = _('Not found.')
+                    else:
+                        changes[field.attname] = value
+                else:
+                    current = getattr(instance, field.attname)
+                    if isinstance(current, dict) and isinstance(value, dict):
+                        # Update the JSONField attribute like partial_update()
+                        value = {**current, **value}
+                    try:
+                        changes[field.attname] = field.clean(value, instance)
+                    except DjangoValidationError as e:
+                        errors[name] = ' '.join(e.messages)
+
+            if errors:
+                results[i] = {'id': instance.id, 'error': errors}
+                continue
+
+            changes = {attname: value for attname, value in changes.items() if getattr(instance, attname) != value}
+            if not changes:
+                results[i] = {'id': instance.id, 'message': _(f'[Update]: {instance.__class__.__name__} {instance.id} no change.')}
+                continue
+
+            for attname, value in changes.items():
+                setattr(instance, attname, value)
+            instance.updated_at = timezone.now()
+
+            if callback is not None:
+                instance.callback = callback
+                try:
+                    callback.pre_save(model=instance)
+                except WarehauserError as e:
+                    results[i] = {'id': instance.id, 'error': e.args[0]}
+                    continue
+                except JSONSchemaValidationError as e:
+                    results[i] = {'id': instance.id, 'error': e.message}
+                    continue
+                except ValueError as e:
+                    results[i] = {'id': instance.id, 'error': str(e)}
+                    continue
+
+            changed.append(instance)
+            changed_fields.update(changes.keys())
+            results[i] = {'id': instance.id, 'message': _(f'[Update]: {instance.__class__.__name__} {instance.id} updated.')}
+
+        return changed, changed_fields
+
+    @action(detail=False, methods=['patch', 'delete'], url_path='bulk')
+    def bulk(self, request, *args, **kwargs):
+        """
+        Update (PATCH a list of objects with their id and changed fields) or delete (DELETE a list of ids) up to
+        API_BULK_MAX_ITEMS objects. Every item is validated first and nothing is written unless all of them are valid, then
+        all the changes are written in one transaction. The response lists the result of every item in request order.
+        """
+        if request.method == 'DELETE':
+            return self.bulk_destroy(request, *args, **kwargs)
+        return self.bulk_partial_update(request, *args, **kwargs)
+
+    def bulk_partial_update(self, request, *args, **kwargs):
+        items = self._get_bulk_items(request)
+        results = [None] * len(items)
+
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[i] = {'id': None, 'error': _('Expected an object.')}
+        instances = self._get_bulk_instances(items=items, results=results)
+        changed, fields = self._apply_bulk_changes(instances=instances, items=items, results=results)
+
+        if changed and not any('error' in result for result in results):
+            model = self.serializer_class.Meta.model
+            err:Exception = None
+            try:
+                with transaction.atomic():
+                    model.bulk_save(changed, sorted(fields) + ['updated_at'], batch_size=getattr(settings, 'API_BULK_BATCH_SIZE', 500))
+            except Exception as e:
+                err = e
+                raise e
+            finally:
+                # Like save(), post_save() runs whether or not the write succeeded
+                for instance in changed:
+                    if instance.callback is not None:
+                        instance.callback.post_save(model=instance, err=err)
+
+        return self._bulk_response(results, http_status=status.HTTP_200_OK)
+
+    def bulk_destroy(self, request, *args, **kwargs):
+        items = self._get_bulk_items(request)
+        results = [None] * len(items)
+
+        instances = self._get_bulk_instances(items=items, results=results)
+        for i, instance in instances.items():
+            results[i] = {'id': instance.id, 'message': _(f'[Delete]: {instance.__class__.__name__} {instance.id} deleted.')}
+
+        if instances and not any('error' in result for result in results):
+            with transaction.atomic():
+                self.serializer_class.Meta.model.bulk_delete(list(instances.values()))
+
+        return self._bulk_response(results, http_status=status.HTTP_200_OK)
 
     def create(self, request, *args, **kwargs):
         user = request.user
@@ -119,12 +450,14 @@ class WarehauserBaseViewSet(viewsets.ModelViewSet):
         self._protect_fields(user=user, data=data, create=True)
 
         if not user.is_superuser and not user.is_staff:
-            owner = Client.objects.get(group__in=user.groups.all())
-            if not owner:
+            client_ids = get_client_ids(request)
+            if not client_ids:
                 raise ValidationError({'error': _('User is not a member of any client group.')})
+            if len(client_ids) > 1:
+                raise ValidationError({'error': _('User is a member of more than one client group.')})
 
             # Set the owner field to the retrieved group
-            data['owner'] = owner.id
+            data['owner'] = next(iter(client_ids))
 
         # return super().create(request, *args, **kwargs)
         serializer = self.get_serializer(data=data)
@@ -135,40 +468,61 @@ class WarehauserBaseViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save()
 
-    def partial_update(self, request, *args, **kwargs):
-        instance = self.get_object()
-        data = request.data
-
-        self._protect_fields(user=request.user, data=data)
-
-        # Check for field changes
-        has_changed = False
-        for key, value in data.items():
-            attr = getattr(instance, key, None)
-            if isinstance(attr, dict) and isinstance(value, dict):
-                # Update the JSONField attribute
-                json = getattr(instance, key, {})
-                json.update(value)
-                setattr(instance, key, json)
-                has_changed = True
-            elif attr != value:
-                # Update regular field
-                setattr(instance, key, value)
-                has_changed = True
-
-        if has_changed:
-            instance.updated_at = timezone.now()
-            instance.save()
+    def get_locked_object(self):
+        """
+        Get the object like get_object() with its row locked until the transaction ends, so it cannot change between
+        reading and writing it.
+        """
+        queryset = self.filter_queryset(self.get_queryset()).select_for_update(of=('self',))
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        instance = get_object_or_404(queryset, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        self.check_object_permissions(self.request, instance)
+        return instance
 
-            return Response(
-                {'message': _(f'[Update]: {instance.__class__.__name__} {instance.id} updated.')},
-                status=status.HTTP_200_OK
-            )
+    def partial_update(self, request, *args, **kwargs):
+        with transaction.atomic():
+            instance = self.get_locked_object()
+            data = request.data
+
+            # Optimistic concurrency: If-Match only updates the version of the object the client last read
+            if 'HTTP_IF_MATCH' in request.META or 'HTTP_IF_UNMODIFIED_SINCE' in request.META:
+                etag, last_modified = get_instance_validators(instance)
+                response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+                if response is not None:
+                    return response
+
+            self._protect_fields(user=request.user, data=data)
+
+            # Check for field changes
+            has_changed = False
+            for key, value in data.items():
+                attr = getattr(instance, key, None)
+                if isinstance(attr, dict) and isinstance(value, dict):
+                    # Update the JSONField attribute
+                    json = getattr(instance, key, {})
+                    json.update(value)
+                    setattr(instance, key, json)
+                    has_changed = True
+                elif attr != value:
+                    # Update regular field
+                    setattr(instance, key, value)
+                    has_changed = True
+
+            if has_changed:
+                instance.updated_at = timezone.now()
+                instance.save()
+
+                response = Response(
+                    {'message': _(f'[Update]: {instance.__class__.__name__} {instance.id} updated.')},
+                    status=status.HTTP_200_OK
+                )
+            else:
+                response = Response(
+                    {'message': _(f'[Update]: {instance.__class__.__name__} {instance.id} no change.')},
+                    status=status.HTTP_200_OK
+                )
 
-        return Response(
-            {'message': _(f'[Update]: {instance.__class__.__name__} {instance.id} no change.')},
-            status=status.HTTP_200_OK
-        )
+        return set_validators(response, *get_instance_validators(instance))
 
     def update(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs)
@@ -199,6 +553,56 @@ class WarehauserDefinitionViewSet(WarehauserBaseViewSet):
         serializer = self.instance_serializer_class(instance)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    def _get_bulk_spawn_data(self, dfn, data:dict) -> dict:
+        return data
+
+    @action(detail=False, methods=['post'], url_path='bulk_spawn')
+    def bulk_spawn(self, request, *args, **kwargs):
+        """
+        Spawn up to API_BULK_MAX_ITEMS instances. Every item holds the id of its definition in 'dfn' and the data passed to
+        the definition's create_instance(). All the instances are created in one transaction and none of them are created
+        unless all of them are.
+        """
+        items = self._get_bulk_items(request)
+        results = [None] * len(items)
+
+        dfns = self._get_bulk_instances(items=[{'id': item.get('dfn')} if isinstance(item, dict) else dict() for item in items], results=results)
+        for result in results:
+            if result is not None:
+                result['dfn'] = result['id']
+                result['id'] = None
+
+        with transaction.atomic():
+            for i, dfn in dfns.items():
+                data = {key: value for key, value in items[i].items() if key != 'dfn'}
+                try:
+                    self._protect_fields(user=request.user, data=data, create=True)
+                    with transaction.atomic():
+                        instance = dfn.create_instance(self._get_bulk_spawn_data(dfn=dfn, data=data))
+                    results[i] = {'id': instance.id, 'dfn': dfn.id}
+                except ValidationError as e:
+                    results[i] = {'id': None, 'dfn': dfn.id, 'error': e.detail.get('error') if isinstance(e.detail, dict) else e.detail}
+                except WarehauserError as e:
+                    # The message only, the extra holds internal objects
+                    results[i] = {'id': None, 'dfn': dfn.id, 'error': e.args[0]}
+                except JSONSchemaValidationError as e:
+                    results[i] = {'id': None, 'dfn': dfn.id, 'error': e.message}
+                except DjangoValidationError as e:
+                    results[i] = {'id': None, 'dfn': dfn.id, 'error': ' '.join(e.messages)}
+                except IntegrityError:
+                    results[i] = {'id': None, 'dfn': dfn.id, 'error': _('Conflicts with an existing object.')}
+                except ValueError as e:
+                    # Raised by the callbacks when the new object is not allowed
+                    results[i] = {'id': None, 'dfn': dfn.id, 'error': str(e)}
+
+            if any('error' in result for result in results):
+                transaction.set_rollback(True)
+                for result in results:
+                    if 'error' not in result:
+                        result['id'] = None
+
+        return self._bulk_response(results, http_status=status.HTTP_201_CREATED)
+
 class WarehauserInstanceViewSet(WarehauserBaseViewSet):
     def create(self, request, *args, **kwargs):
         return Response(status=status.HTTP_501_NOT_IMPLEMENTED)
@@ -213,7 +617,9 @@ class WarehauseDefViewSet(WarehauserDefinitionViewSet):
 
 class WarehauseViewSet(WarehauserInstanceViewSet):
     serializer_class = WarehauseSerializer
+    callback_class = WarehauseCallback
     filterset_class = WarehauseFilter
+    select_related_fields = ('parent', 'dfn', 'user',)
 
 
 # PRODUCT viewsets
@@ -222,6 +628,7 @@ class ProductDefViewSet(WarehauserDefinitionViewSet):
     instance_serializer_class = ProductSerializer
     serializer_class = ProductDefSerializer
     filterset_class = ProductDefFilter
+    prefetch_related_fields = ('warehauses',)
 
     @action(detail=True, methods=['get'], url_path='warehauses')
     def get_warehauses(self, request, id=None):
@@ -232,27 +639,205 @@ class ProductDefViewSet(WarehauserDefinitionViewSet):
 
 class ProductViewSet(WarehauserInstanceViewSet):
     serializer_class = ProductSerializer
+    callback_class = ProductCallback
     filterset_class = ProductFilter
+    select_related_fields = ('parent', 'dfn', 'warehause',)
 
 
 # EVENT viewsets
 
+def process_inline(event):
+    """
+    Process an event within the request that spawned it and record its metrics. The web workers have no scheduler flushing
+    their metrics so they are flushed here when due.
+    """
+    if event.get_proc_name() is None:
+        # Nothing to process or measure
+        event.process()
+        return
+
+    err = None
+    try:
+        event.process()
+    except Exception as e:
+        err = e
+        raise e
+    finally:
+        event_metrics.observe(event=event, err=err)
+        event_metrics.flush_due()
+
+class EventInlineProcessThread(threading.Thread):
+    """
+    Process an event on behalf of a request. The request waits for this thread for at most EVENT_INLINE_BUDGET seconds.
+    If the event overruns the budget the request hands it over with hand_over() and the thread finishes processing it in
+    the background. The thread processes its own copy of the event loaded from the database and holds the event's mutex
+    while processing, so the event is never processed twice.
+
+    Args:
+        event_id (UUID): id of the event to process.
+    """
+    def __init__(self, event_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_id = event_id
+        self.event = None
+        self.daemon = True
+        self._handed_over = False
+        self._lock = threading.Lock()
+
+    def hand_over(self):
+        """
+        Hand the event over to the batch processor because it overran the budget. The event is marked batched so that the
+        scheduler owns it if this process dies before the event finishes, and the event queue is woken up.
+        """
+        with self._lock:
+            self._handed_over = True
+            if self.event is not None:
+                self.event.is_batched = True
+        Event.objects.filter(id=self.event_id).update(is_batched=True, updated_at=timezone.now())
+        transaction.on_commit(notify_event_queue)
+
+    def run(self):
+        try:
+            with db_mutex(f'event:{self.event_id}'):
+                event = Event.objects.select_related('owner__group').get(id=self.event_id)
+                with self._lock:
+                    event.is_batched = event.is_batched or self._handed_over
+                    self.event = event
+                process_inline(event)
+        except Exception as e:
+            logging.error(_(f'[{self.__class__.__name__}]: Failed processing event {self.event_id}: {e}'))
+        finally:
+            connection.close()
+
 class EventDefViewSet(WarehauserDefinitionViewSet):
     instance_serializer_class = EventSerializer
     serializer_class = EventDefSerializer
     filterset_class = EventDefFilter
 
+    def _is_slow(self, instance, budget:float) -> bool:
+        # An event is known to be slow if its process function usually takes longer than the budget.
+        metric = EventMetric.objects.filter(owner=instance.owner_id, proc_name=instance.proc_name).first()
+        if metric is None:
+            return False
+        p95 = metric.get_run().quantile(0.95)
+        return p95 is not None and p95 > budget
+
+    def _process(self, instance) -> bool:
+        """
+        Process a non batched event within the EVENT_INLINE_BUDGET (seconds) time budget. Events whose process
+        function is known to overrun the budget are handed to the batch processor straight away.
+
+        Returns:
+            bool: True if the event finished processing and instance was refreshed, False if it continues in the background
+                  in which case instance must not be used any further.
+        """
+        budget = getattr(settings, 'EVENT_INLINE_BUDGET', None)
+        if budget is None or instance.proc_name is None:
+            process_inline(instance)
+            return True
+
+        if self._is_slow(instance=instance, budget=budget):
+            instance.is_batched = True
+            instance.save()
+            transaction.on_commit(notify_event_queue)
+            return False
+
+        thread = EventInlineProcessThread(instance.id)
+        thread.start()
+        thread.join(budget)
+        if thread.is_alive():
+            # The thread owns the event from here on
+            thread.hand_over()
+            return False
+
+        instance.refresh_from_db()
+        return True
+
+    def _get_bulk_spawn_data(self, dfn, data:dict) -> dict:
+        # Events spawned in bulk are handed to the batch processor instead of being processed during the request
+        return {**data, 'is_batched': True}
+
     @action(detail=True, methods=['post'])
     def do_spawn(self, request, *args, **kwargs):
         instance = super()._do_spawn(request=request)
 
         if not instance.is_batched:
             # process immediately
-            instance.process()
+            if not self._process(instance=instance):
+                url = request.build_absolute_uri(reverse('event-detail', kwargs={'id': instance.id}))
+                return Response(
+                    {'id': instance.id, 'status': Event.objects.filter(id=instance.id).values_list('status', flat=True).first(), 'url': url},
+                    status=status.HTTP_202_ACCEPTED,
+                    headers={'Location': url},
+                )
 
         serializer = self.instance_serializer_class(instance)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 class EventViewSet(WarehauserInstanceViewSet):
     serializer_class = EventSerializer
+    callback_class = EventCallback
     filterset_class = EventFilter
+    select_related_fields = ('parent', 'dfn', 'warehause', 'user',)
+
+
+# METRICS viewsets
+
+class EventMetricViewSet(viewsets.ReadOnlyModelViewSet):
+    lookup_field = 'id'
+    permission_classes = [WarehauserPermission,]
+    renderer_classes = [WarehauserJSONRenderer,]
+    serializer_class = EventMetricSerializer
+    filter_backends = [DjangoFilterBackend,]
+    filterset_fields = ['owner', 'proc_name',]
+    pagination_class = WarehauserPagination
+    cursor_ordering = ('owner_id', 'id',)
+
+    def get_queryset(self):
+        user = self.request.user
+
+        if user.is_staff or user.is_superuser:
+            return EventMetric.objects.all().order_by('owner', 'id')
+
+        return EventMetric.objects.filter(owner_id__in=get_client_ids(self.request)).order_by('owner', 'id')
+
+class QueueDepthViewSet(viewsets.ViewSet):
+    permission_classes = [WarehauserPermission,]
+    renderer_classes = [WarehauserJSONRenderer,]
+
+    def list(self, request, *args, **kwargs):
+        user = request.user
+
+        if user.is_staff or user.is_superuser:
+            clients = Client.objects.all()
+        else:
+            clients = Client.objects.filter(id__in=get_client_ids(request))
+
+        return Response(get_queue_depths(clients), status=status.HTTP_200_OK)
+
+class LookupViewSet(viewsets.ViewSet):
+    """
+    Resolve a scanned value (barcode or address) to the products and warehauses whose value, or one of whose
+    options['values'], equals it: /api/lookup/<value>/. Answers come from the per process lookup_cache for hot values and
+    from one indexed query otherwise, without the filtering, ordering and paging of the list endpoints.
+    """
+    permission_classes = [WarehauserPermission,]
+    renderer_classes = [WarehauserJSONRenderer,]
+    lookup_field = 'value'
+    lookup_value_regex = '[^/]+'
+
+    def retrieve(self, request, value=None, *args, **kwargs):
+        user = request.user
+        client_ids = None if user.is_staff or user.is_superuser else get_client_ids(request)
+
+        results = lookup_cache.get(value, client_ids=client_ids)
+        if not results:
+            return Response({'error': _(f'No product or warehause has the value \'{value}\'.')}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            'value': value,
+            'results': [
+                {**result, 'url': request.build_absolute_uri(reverse(f'{result["type"]}-detail', kwargs={'id': result['id']}))}
+                for result in results
+            ],
+        }, status=status.HTTP_200_OK)
@@ -0,0 +1,163 @@
+# Copyright 2024 warehauser @ github.com
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# wakeup.py
+
+# Note: this module is imported by core.models so it must not import any models.
+
+import logging
+import os
+import select
+import socket
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import connection, connections
+from django.utils.translation import gettext as _
+
+logger = logging.getLogger(__name__)
+
+WAKEUP_SOCKET = 'socket'
+WAKEUP_POSTGRESQL = 'postgresql'
+
+WAKEUP_CHANNEL = 'warehauser_eventqueue'
+
+def get_wakeup_method(conn=None):
+    """
+    Get the event queue wakeup method configured by settings.EVENT_WAKEUP: 'socket' for a local Unix datagram socket,
+    'postgresql' for PostgreSQL LISTEN/NOTIFY, 'auto' (default) for 'postgresql' on PostgreSQL and 'socket' otherwise,
+    or None to only poll.
+    """
+    method = getattr(settings, 'EVENT_WAKEUP', 'auto')
+    if method == 'auto':
+        method = WAKEUP_POSTGRESQL if (conn or connection).vendor == 'postgresql' else WAKEUP_SOCKET
+    return method
+
+def get_wakeup_socket_path() -> str:
+    return getattr(settings, 'EVENT_WAKEUP_SOCKET', None) or os.path.join(tempfile.gettempdir(), 'warehauser-eventqueue.sock')
+
+def notify_event_queue():
+    """
+    Wake up the event queue of the scheduler(s) because a batched event is ready to process. Never raises: if no scheduler
+    is listening the event is picked up by the next poll.
+
+    Call this once the transaction creating the event has committed, e.g. with transaction.on_commit(notify_event_queue).
+    """
+    try:
+        method = get_wakeup_method()
+        if method == WAKEUP_SOCKET:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.setblocking(False)
+                sock.sendto(b'1', get_wakeup_socket_path())
+        elif method == WAKEUP_POSTGRESQL:
+            with connection.cursor() as cursor:
+                cursor.execute(f'NOTIFY {WAKEUP_CHANNEL}')
+    except (OSError, AttributeError) as e:
+        # No scheduler listening (or its socket buffer is full, in which case it is awake already)
+        pass
+    except Exception as e:
+        logger.debug(msg=_(f'Unable to wake up the event queue: {e}'))
+
+class EventWakeupListener(threading.Thread):
+    """
+    Daemon thread calling callback whenever notify_event_queue() is called in any process. Notifications arriving while the
+    callback runs are coalesced into a single call. If the wakeup channel cannot be opened (e.g. another scheduler on this
+    host already owns the socket) the listener logs a warning and stops, leaving the event queue to polling.
+    """
+    def __init__(self, callback, *args, **kwargs):
+        super().__init__(*args, daemon=True, name='eventwakeup', **kwargs)
+        self.callback = callback
+        self.method = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        self.method = get_wakeup_method()
+        try:
+            if self.method == WAKEUP_SOCKET:
+                self._listen_socket()
+            elif self.method == WAKEUP_POSTGRESQL:
+                self._listen_postgresql()
+        except Exception as e:
+            logger.warning(msg=_(f'Event queue wakeup ({self.method}) unavailable, falling back to polling: {e}'))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _wake(self):
+        try:
+            self.callback()
+        except Exception as e:
+            logger.exception(msg=_(f'Event queue wakeup failed: {e}'))
+
+    def _listen_socket(self):
+        path = get_wakeup_socket_path()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        bound = False
+        try:
+            if os.path.exists(path):
+                # Remove a stale socket left behind by a scheduler that did not shut down cleanly, but never steal a live one
+                try:
+                    sock.sendto(b'0', path)
+                    raise OSError(_(f'{path} is in use by another scheduler.'))
+                except ConnectionRefusedError:
+                    os.unlink(path)
+
+            sock.bind(path)
+            bound = True
+            sock.setblocking(False)
+            logger.info(msg=_(f'Event queue wakeup listening on {path}.'))
+
+            while not self._stop_event.is_set():
+                readable, _w, _x = select.select([sock], [], [], 1.0)
+                if not readable:
+                    continue
+
+                # Drain all pending notifications so a burst results in a single wakeup
+                try:
+                    while sock.recv(64):
+                        pass
+                except BlockingIOError:
+                    pass
+
+                self._wake()
+        finally:
+            sock.close()
+            if bound and os.path.exists(path):
+                os.unlink(path)
+
+    def _listen_postgresql(self):
+        conn = connections['default']
+        conn.ensure_connection()
+        raw = conn.connection
+        if not hasattr(raw, 'poll'):
+            raise OSError(_('LISTEN requires psycopg2.'))
+
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {WAKEUP_CHANNEL}')
+        logger.info(msg=_(f'Event queue wakeup listening on PostgreSQL channel {WAKEUP_CHANNEL}.'))
+
+        try:
+            while not self._stop_event.is_set():
+                readable, _w, _x = select.select([raw], [], [], 1.0)
+                if not readable:
+                    continue
+
+                raw.poll()
+                if raw.notifies:
+                    raw.notifies.clear()
+                    self._wake()
+        finally:
+            conn.close()
@@ -21,13 +21,18 @@ from core.serializers import *
 #           # Your code here...
 #           pass
 #
+#    Tasks that mostly wait on I/O (such as outbound HTTP calls) can be declared
+#    with async def. The EventQueueTask runs these on an event loop so many
+#    can be in flight at once. Use Django's async ORM (e.g. await model.asave())
+#    or sync_to_async for any database access inside an async task.
+#
 # 4. Create an EventDef with the proc_name = 'logic.<clientnamne>.tasks.<your task name|my_event_process>' using the appropriate warehauser API (default is POST /api/eventdefs/).
 # 5. Create an Event via its <EventDef> using the appropriate warehauser API (default is POST /api/eventdefs/<id>/do_spawn/).
 # 6. If the Event.is_batched is False then the <your task name> function will be
 #    executed immediately. Otherwise it will be executed when Event.process()
 #    is called.
 #
-# NOTE: the warehauser/scheduler.py can schedule an EventQueueThread which will
+# NOTE: the warehauser/scheduler.py can schedule an EventQueueTask which will
 #    process unprocessed Events that are is_batched True
 
 logger = logging.getLogger(__name__)
@@ -58,6 +63,12 @@ def my_event_process(event:Event):
     # Also remember to set the event status (see core/status.py for more info)
     event.status = STATUS_CLOSED
 
+async def my_async_event_process(event:Event):
+    # Await your I/O bound calls here. Database access must go through the async ORM or sync_to_async.
+    logger.info(_('Hello Async World!'))
+
+    event.status = STATUS_CLOSED
+
 def prepare_json(clazz, options):
     data = dict()
 
@@ -127,3 +138,20 @@ def transfer(event:Event):
         from_warehause.save()
 
         event.set_option(key='result', value={'from': str(from_warehause.id), 'to': str(to_warehause.id)})
+
+def receive_pallets(event:Event):
+    # Fan out one child event per pallet. The child events are processed in parallel by the batch processor and this event
+    # is put ON_HOLD until they have all closed, after which its join_name (e.g. 'receive_pallets_complete') is run.
+    dfn = EventDef.objects.get(id=event.options['dfn'])
+
+    for pallet in event.options['pallets']:
+        dfn.create_instance(data={
+            'value': pallet,
+            'parent': event,
+            'is_batched': True,
+            'options': {'pallet': pallet},
+        })
+
+def receive_pallets_complete(event:Event):
+    event.set_option(key='result', value={'pallets': event.children.filter(status=STATUS_CLOSED).count()})
+    event.status = STATUS_CLOSED
@@ -14,12 +14,10 @@
 
 # scheduler.py
 
-# TODO: Convert this to a BaseCommand in core app
+# Kept for existing deployments. The scheduler is the core app 'scheduler' management command: python manage.py scheduler
 
 import sys
 import os
-import schedule
-import time
 
 os.environ['SCRIPT_SCHEDULER'] = 'True'
 
@@ -34,24 +32,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'warehauser.settings')
 # Initialize Django
 django.setup()
 
-import tasks
-
-# Set schedule for tasks
-cron = [
-    schedule.every().day.at("00:00").do(lambda: tasks.ArchiverThread().start()),
-    schedule.every().day.at("17:00").do(lambda: tasks.GenerateReportsThread().start()),
-    schedule.every(1).minutes.do(lambda: tasks.GarbageCollectorThread().start()),
-    schedule.every(10).seconds.do(lambda: tasks.EventQueueThread().start()),
-    schedule.every(10).seconds.do(lambda: tasks.EmailThread().start()),
-]
+from django.core.management import call_command
 
 def main():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    call_command('scheduler')
 
 if __name__ == '__main__':
-    try:
-        main()
-    except KeyboardInterrupt:
-        schedule.clear()
+    main()
@@ -27,6 +27,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -131,15 +132,58 @@ REST_FRAMEWORK = {
     # 'DEFAULT_RENDERER_CLASSES': [
     #     'main.renderers.CustomHTMLRenderer',
     # ],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    # Cursor pagination over (created_at, id) unless the client asks for a ?page=
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.WarehauserPagination',
     'PAGE_SIZE': 10,
 
    'DEFAULT_AUTHENTICATION_CLASSES': (
-       'rest_framework.authentication.TokenAuthentication',
+       'core.authentication.CachingTokenAuthentication',
        'rest_framework.authentication.SessionAuthentication',
    ),
 }
 
+# Largest page size API clients may ask for with ?page_size=, and the most rows counted by page number pagination with
+# ?count=approximate on databases other than PostgreSQL (PostgreSQL uses the query planner estimate instead).
+# API_MAX_PAGE_SIZE = 1000
+# API_APPROXIMATE_COUNT_LIMIT = 10000
+
+# Render API list pages from QuerySet.values() rows with precompiled field plans instead of the rest framework serializers,
+# and encode API responses with orjson when it is installed (pip install orjson). The output is the same either way.
+# API_FAST_SERIALIZERS = True
+# API_ORJSON = True
+
+# Number of rows read from the database cursor and rendered at a time by the export endpoints (/api/<model>/export/).
+# API_EXPORT_CHUNK_SIZE = 2000
+
+# Most objects a bulk request (/api/<model>/bulk/ and /api/<model>/bulk_spawn/) may change, and number of objects written
+# per bulk update query.
+# API_BULK_MAX_ITEMS = 1000
+# API_BULK_BATCH_SIZE = 500
+
+# Seconds the ids of the clients a user belongs to are cached per process (0 to look them up on every request), and most
+# users cached per process.
+# CLIENT_IDS_CACHE_TTL = 30
+# CLIENT_IDS_CACHE_SIZE = 10000
+
+# Seconds an API token stays cached per process, most tokens cached per process, and seconds between checks of the token
+# cache version in the database. Rotating or deleting a token takes effect in other processes after at most the check
+# interval.
+# AUTH_TOKEN_CACHE_TTL = 60
+# AUTH_TOKEN_CACHE_SIZE = 10000
+# AUTH_TOKEN_CACHE_VERSION_INTERVAL = 5
+
+# Full text index used by the API ?search= parameter: 'postgresql' (tsvector and pg_trgm GIN indexes), 'fts5' (SQLite FTS5
+# trigram table), 'like' (substring match of the search index table), or 'auto' to choose by database. The indexes are
+# created by migrate, and manage.py rebuild_search_index indexes objects saved before the search index existed.
+# SEARCH_BACKEND = 'auto'
+
+# Most objects returned by the value lookup endpoint (/api/lookup/<value>/), seconds a looked up value stays cached per
+# process (0 to query on every request), and most values cached per process. Saves and deletes in the same process are
+# seen straight away, changes made by other processes and bulk updates after at most LOOKUP_CACHE_TTL seconds.
+# API_LOOKUP_MAX_RESULTS = 100
+# LOOKUP_CACHE_TTL = 10
+# LOOKUP_CACHE_SIZE = 10000
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
@@ -196,7 +240,7 @@ LOGIN_URL = 'home_view'
 
 # Logging settings
 
-SCRIPT_SCHEDULER = os.environ.get('SCRIPT_SCHEDULER', '') == 'True'
+SCRIPT_SCHEDULER = os.environ.get('SCRIPT_SCHEDULER', '') == 'True' or sys.argv[1:2] == ['scheduler']
 if SCRIPT_SCHEDULER:
     log_file_name = os.path.join(BASE_DIR, 'logs', 'scheduler.jsonl')
 else:
@@ -279,3 +323,68 @@ USE_L10N = True
 USE_TZ = True
 
 # EVENT_LOGIC_APP = 'logic'
+
+# Maximum number of events with async def process functions that are processed at the same time by one worker.
+# EVENT_ASYNC_CONCURRENCY = 100
+
+# Wall clock time limit in seconds for batched event processes whose EventDef does not set a timeout. None means no limit.
+# Events with a time limit are processed in supervised worker processes which are killed if they overrun.
+# EVENT_DEFAULT_TIMEOUT = None
+# Maximum number of supervised worker processes in total (default number of CPUs) and per client (default half of that).
+# EVENT_WORKER_PROCESSES = None
+# EVENT_WORKER_PROCESSES_PER_CLIENT = None
+
+# Time budget in seconds for processing non batched events within the request that spawns them. Events that do not finish
+# within the budget continue in the background and the request returns 202 Accepted with the event's status URL. Events
+# known to overrun the budget (see /api/metrics/events/) are handed to the batch processor. None means no budget.
+# EVENT_INLINE_BUDGET = None
+
+# Seconds between flushes of the event metrics of events processed inline by the web workers into the EventMetric table.
+# EVENT_METRICS_FLUSH_INTERVAL = 60
+
+# Maximum number of batched events processing at the same time. The free capacity is shared between clients by weighted fair
+# queueing using Client.weight and Client.max_events.
+# EVENT_QUEUE_CAPACITY = 100
+
+# Seconds a batched event may stay in STATUS_PROCESSING without being updated (or its timeout if longer) before it is
+# considered abandoned by a worker that died. Abandoned events that never started are reopened, the others are failed. The
+# event's mutex must have expired too (DB_MUTEX_TTL_SECONDS, default 30 minutes). None to never reclaim events.
+# EVENT_PROCESSING_TIMEOUT = 3600
+
+# Number of virtual DESTROY objects deleted per bulk delete by the garbage collector, seconds to sleep between chunks and
+# maximum number of objects of each model deleted per garbage collector run (None for no limit).
+# GARBAGE_COLLECTOR_CHUNK_SIZE = 1000
+# GARBAGE_COLLECTOR_CHUNK_DELAY = 0.0
+# GARBAGE_COLLECTOR_MAX_DELETES = None
+
+# Number of objects archived per transaction by the archiver, and age in days after which closed events are moved into the
+# event archive table (None to never archive events).
+# ARCHIVER_CHUNK_SIZE = 1000
+# EVENT_ARCHIVE_AFTER_DAYS = 30
+
+# Number of queued emails sent per batch over the shared mail connection, and number of failed attempts after which a queued
+# email is given up on.
+# EMAIL_OUTBOX_BATCH_SIZE = 100
+# EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+
+# Number of worker threads of the scheduler (python manage.py scheduler), and whether a job that is due while its previous
+# run is still active is run once more when that run finishes (True) or simply skipped (False).
+# SCHEDULER_WORKERS = 4
+# SCHEDULER_COALESCE = True
+
+# Seconds a scheduler node holds its leases (leadership and membership) without renewing them. Jobs that must run once per
+# cluster only run on the leader. With SCHEDULER_SHARDING the event queue and the garbage collector run on every scheduler
+# node instead, each node handling the clients of its shard. EVENT_QUEUE_CAPACITY then applies per node.
+# SCHEDULER_LEASE_TTL = 30
+# SCHEDULER_SHARDING = False
+
+# How the API wakes up the scheduler's event queue as soon as a batched event is ready: 'auto' (PostgreSQL LISTEN/NOTIFY on
+# PostgreSQL, else a local Unix socket), 'postgresql', 'socket' or None to rely on polling only. EVENT_WAKEUP_SOCKET is the
+# path of the Unix socket (default warehauser-eventqueue.sock in the temp directory).
+# EVENT_WAKEUP = 'auto'
+# EVENT_WAKEUP_SOCKET = None
+
+# Directory the daily reports are written to (default BASE_DIR / 'reports') and their format, 'csv' or 'jsonl'. Reports are
+# gzip compressed.
+# REPORTS_DIR = BASE_DIR / 'reports'
+# REPORTS_FORMAT = 'csv'
@@ -14,40 +14,75 @@
 
 # tasks.py
 
+import asyncio
 import logging
 import threading
+import time
 
+from asgiref.sync import sync_to_async
 from db_mutex import DBMutexError, DBMutexTimeoutError
 from db_mutex.db_mutex import db_mutex
-from urllib.parse import urljoin
 
-from django.core.mail import send_mail
+from django.db import connection, transaction
 from django.db.models import ProtectedError, Q
 from django.utils import timezone
 from django.utils.translation import gettext as _
-from django.urls import reverse
 
 from datetime import timedelta
 
+from core.fairqueue import event_fair_queue, get_queue_depths
+from core.leases import filter_shard
+from core.metrics import event_metrics
 from core.models import *
+from core.outbox import send_outbox
+from core.reports import DailyReportEngine
+from core.supervisor import get_event_supervisor
+from core.wakeup import notify_event_queue
+from core.utils import JSONRemoveKey, supports_json_remove_key
 from core.views  import *
 
-class WarehauserThread(threading.Thread):
-    def run(self):
+class WarehauserTask:
+    """
+    Base class of the scheduler tasks. A task is a plain callable that the scheduler runs on one of its job worker threads.
+
+    Args:
+        shard (tuple): (index, count) of the shard of clients this task handles or None for all clients. Only used by tasks
+                       that support sharding. See core.leases.
+    """
+    def __init__(self, shard:tuple=None):
+        self.shard = shard
+
+    def get_mutex_name(self, name:str) -> str:
+        if self.shard is None:
+            return name
+        return f'{name}:{self.shard[0]}/{self.shard[1]}'
+
+    def __call__(self):
         logging.info(f"[{self}]: {_('Started.')}")
         self.process()
         logging.info(f"[{self}]: {_('Finished.')}")
 
     def __str__(self):
-        return f"{_('Task')} {self.__module__}.{self.__class__.__name__}(id={self.ident})"
+        if self.shard is None:
+            return f"{_('Task')} {self.__module__}.{self.__class__.__name__}"
+        return f"{_('Task')} {self.__module__}.{self.__class__.__name__}(shard={self.shard[0]}/{self.shard[1]})"
 
     def process(self):
         pass
 
-class ArchiverThread(WarehauserThread):
+class ArchiverTask(WarehauserTask):
+    """
+    Archive stale data in batches of ARCHIVER_CHUNK_SIZE (default 1000) objects per transaction.
+
+    * Removes the send_mail option of UserAux objects once the email has been sent for more than 24 hours, with one set based
+      UPDATE per batch where the database supports it.
+    * Moves STATUS_CLOSED events (that have no child events) older than EVENT_ARCHIVE_AFTER_DAYS (default 30, None to never
+      archive) from the Event table into the EventArchive table.
+    """
     def _archive_useraux(self):
         key = 'send_mail'
         delta = timezone.now() - timedelta(hours=24)
+        chunk_size = max(int(getattr(settings, 'ARCHIVER_CHUNK_SIZE', 1000)), 1)
 
         objects = UserAux.objects.filter(
             Q(options__has_key='send_mail') &
@@ -56,27 +91,89 @@ class ArchiverThread(WarehauserThread):
             Q(options__send_mail__has_key='emailthread')
         )
 
-        for useraux in objects:
-            del useraux.options[key]
-            useraux.save()
+        set_based = supports_json_remove_key(connection)
+        last_id = None
+
+        while True:
+            chunk = objects.order_by('id') if last_id is None else objects.filter(id__gt=last_id).order_by('id')
+            ids = list(chunk.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+
+            last_id = ids[-1]
+
+            with transaction.atomic():
+                if set_based:
+                    UserAux.objects.filter(id__in=ids).update(options=JSONRemoveKey('options', key))
+                else:
+                    for useraux in UserAux.objects.select_for_update().filter(id__in=ids):
+                        useraux.options.pop(key, None)
+                        useraux.save(update_fields=['options'])
+
+            if len(ids) < chunk_size:
+                break
+
+    def _archive_events(self):
+        days = getattr(settings, 'EVENT_ARCHIVE_AFTER_DAYS', 30)
+        if days is None:
+            return
+
+        chunk_size = max(int(getattr(settings, 'ARCHIVER_CHUNK_SIZE', 1000)), 1)
+        delta = timezone.now() - timedelta(days=days)
+
+        # Leaf events only. Parents become leaves, and are archived, once their children have been archived.
+        events = Event.objects.filter(
+            Q(status=STATUS_CLOSED) &
+            Q(children__isnull=True) &
+            (Q(updated_at__lt=delta) | Q(updated_at__isnull=True, created_at__lt=delta))
+        ).order_by('created_at')
+
+        total = 0
+        while True:
+            count = EventArchive.archive(Event.objects.filter(id__in=list(events.values_list('id', flat=True)[:chunk_size])))
+            total = total + count
+            if count == 0:
+                break
+
+        if total:
+            logging.info(msg=_(f'Archived {total} event(s).'))
 
     def process(self):
         try:
             with db_mutex(f'archiver'):
                 self._archive_useraux()
+                self._archive_events()
         except DBMutexError as e:
             raise WarehauserError(_('Unable to secure mutex for eventqueue.'), WarehauserErrorCodes.MUTEX_ERROR, {_('error'): e})
         except DBMutexTimeoutError as e:
             raise WarehauserError(_('Unable to secure mutex for eventqueue.'), WarehauserErrorCodes.MUTEX_TIMEOUT_ERROR, {_('error'): e})
 
-class GenerateReportsThread(WarehauserThread):
+class GenerateReportsTask(WarehauserTask):
+    """
+    Write the daily reports. See core.reports.DailyReportEngine.
+    """
     def process(self):
-        pass
+        try:
+            with db_mutex(f'reports'):
+                DailyReportEngine().run()
+        except DBMutexError as e:
+            raise WarehauserError(_('Unable to secure mutex for reports.'), WarehauserErrorCodes.MUTEX_ERROR, {_('error'): e})
+        except DBMutexTimeoutError as e:
+            raise WarehauserError(_('Unable to secure mutex for reports.'), WarehauserErrorCodes.MUTEX_TIMEOUT_ERROR, {_('error'): e})
 
 class EventProcessThread(threading.Thread):
-    def __init__(self, event, *args, **kwargs):
+    """
+    Process a batched event. Events with a time limit are processed in a supervised worker process, for which the caller
+    must have taken a slot with EventSupervisor.acquire(). This thread hands the slot back when it finishes.
+
+    Args:
+        event      (Event): the event to process.
+        supervised (bool):  True if the caller took a worker process slot for the event.
+    """
+    def __init__(self, event, *args, supervised:bool=False, **kwargs):
         super().__init__(*args, **kwargs)
         self.event = event
+        self.supervised = supervised
 
     def __str__(self):
         return f"{self.__module__}.{self.__class__.__name__}(id={self.ident})"
@@ -86,90 +183,266 @@ class EventProcessThread(threading.Thread):
         try:
             with db_mutex(f'event:{self.event.id}'):
                 logging.info(_(f'[{self}]: Processing {self.event}.'))
-                self.event.process()
+                err = None
+                try:
+                    if self.supervised:
+                        # Run the process function in a supervised worker process that is killed if it overruns
+                        get_event_supervisor().process(event=self.event, timeout=self.event.get_timeout())
+                    else:
+                        self.event.process()
+                except Exception as e:
+                    err = e
+                    raise e
+                finally:
+                    event_metrics.observe(event=self.event, err=err)
         except DBMutexError as e:
             raise WarehauserError(_('Unable to secure mutex for eventqueue.'), WarehauserErrorCodes.MUTEX_ERROR, {_('error'): e})
         except DBMutexTimeoutError as e:
             raise WarehauserError(_('Unable to secure mutex for eventqueue.'), WarehauserErrorCodes.MUTEX_TIMEOUT_ERROR, {_('error'): e})
+        finally:
+            if self.supervised:
+                get_event_supervisor().release(self.event.owner_id)
+
+class AsyncEventProcessThread(threading.Thread):
+    """
+    Process events whose process functions are declared with async def on a single event loop. At most
+    EVENT_ASYNC_CONCURRENCY (default 100) events are in flight at the same time.
+    """
+    def __init__(self, events, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = events
+        self.concurrency = getattr(settings, 'EVENT_ASYNC_CONCURRENCY', 100)
+
+    def __str__(self):
+        return f"{self.__module__}.{self.__class__.__name__}(id={self.ident})"
+
+    def run(self):
+        logging.info(f"[{self}]: {_('Started.')}")
+        asyncio.run(self._process_all())
+        logging.info(f"[{self}]: {_('Finished.')}")
+
+    async def _process_all(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self._process(event=event, semaphore=semaphore) for event in self.events])
+
+    async def _process(self, event, semaphore):
+        async with semaphore:
+            mutex = db_mutex(f'event:{event.id}')
+            try:
+                await sync_to_async(mutex.start)()
+            except DBMutexError as e:
+                logging.error(_(f'[{self}]: Unable to secure mutex for {event}.'))
+                return
+
+            err = None
+            try:
+                logging.info(_(f'[{self}]: Processing {event}.'))
+                await asyncio.wait_for(event.aprocess(), timeout=event.get_timeout())
+            except asyncio.TimeoutError as e:
+                err = e
+                await sync_to_async(event.fail)(msg=_(f'Event process exceeded its timeout of {event.get_timeout()} seconds and was cancelled.'), code=WarehauserErrorCodes.EVENT_TIMEOUT)
+            except Exception as e:
+                err = e
+                logging.error(_(f'[{self}]: Failed processing {event}: {e}'))
+            finally:
+                event_metrics.observe(event=event, err=err)
+                try:
+                    await sync_to_async(mutex.stop)()
+                except DBMutexTimeoutError as e:
+                    logging.error(_(f'[{self}]: Mutex for {event} timed out.'))
+
+class EventQueueTask(WarehauserTask):
+    def _claim(self, events:list) -> set:
+        """
+        Set events that are still OPEN to STATUS_PROCESSING, with SELECT ... FOR UPDATE SKIP LOCKED where the database
+        supports it and one conditional UPDATE per event otherwise. proc_start is cleared until the event's process starts.
+
+        Returns:
+            set: ids of the events claimed by this call.
+        """
+        ids = [event.id for event in events]
+        if not ids:
+            return set()
+
+        now = timezone.now()
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                claimed = set(Event.objects.select_for_update(skip_locked=True).filter(id__in=ids, status=STATUS_OPEN).values_list('id', flat=True))
+                Event.objects.filter(id__in=claimed).update(status=STATUS_PROCESSING, proc_start=None, updated_at=now)
+        else:
+            claimed = {id for id in ids if Event.objects.filter(id=id, status=STATUS_OPEN).update(status=STATUS_PROCESSING, proc_start=None, updated_at=now)}
+
+        return claimed
 
-class EventQueueThread(WarehauserThread):
     def process(self):
         try:
-            with db_mutex(f'eventqueue'):
-                batched_events = Event.objects.filter(is_batched=True, status=STATUS_OPEN)
+            with db_mutex(self.get_mutex_name('eventqueue')):
+                # Share the free capacity between the clients of this shard by weighted fair queueing
+                depths = get_queue_depths(filter_shard(Client.objects.all(), shard=self.shard, field='id'))
+                capacity = getattr(settings, 'EVENT_QUEUE_CAPACITY', 100) - sum(depth['running'] for depth in depths)
+                allocation = event_fair_queue.allocate(clients=depths, capacity=capacity)
+
+                batched_events = []
+                for owner_id, count in allocation.items():
+                    logging.debug(_(f'[{self}]: Dispatching {count} event(s) of client {owner_id}.'))
+                    batched_events.extend(Event.objects.filter(is_batched=True, status=STATUS_OPEN, pending_children=0, owner_id=owner_id).select_related('owner__group').order_by('created_at')[:count])
+
+                # Events with a time limit run in supervised worker processes. Only dispatch those a worker process is free
+                # for so no thread waits for one, the others stay queued for a later pass.
+                supervisor = get_event_supervisor()
+                async_events, sync_events, supervised = [], [], set()
                 for event in batched_events:
-                    EventProcessThread(event).start()
+                    if event.is_async():
+                        async_events.append(event)
+                    elif event.get_timeout() is None:
+                        sync_events.append(event)
+                    elif supervisor.acquire(event.owner_id):
+                        sync_events.append(event)
+                        supervised.add(event.id)
+
+                # Claim the events before dispatching them so the next pass (which may follow straight away on a wakeup), or
+                # another node while the shards change, does not dispatch them again. Only the events claimed are dispatched.
+                claimed = self._claim(async_events + sync_events)
+                for event in sync_events:
+                    if event.id in supervised and event.id not in claimed:
+                        supervisor.release(event.owner_id)
+
+                # Dispatch the claimed events as read after the claim. A duplicate coalesced into an event after it was loaded
+                # merged its options into the row, and Event.process() saving the loaded copy would overwrite them.
+                events = Event.objects.filter(id__in=claimed).select_related('owner__group').in_bulk()
+                async_events = [events[event.id] for event in async_events if event.id in events]
+                sync_events = [events[event.id] for event in sync_events if event.id in events]
+
+                for event in sync_events:
+                    EventProcessThread(event, supervised=event.id in supervised).start()
+                if async_events:
+                    AsyncEventProcessThread(async_events).start()
         except DBMutexError as e:
             raise WarehauserError(_('Unable to secure mutex for eventqueue.'), WarehauserErrorCodes.MUTEX_ERROR, {_('error'): e})
         except DBMutexTimeoutError as e:
             raise WarehauserError(_('Unable to secure mutex for eventqueue.'), WarehauserErrorCodes.MUTEX_TIMEOUT_ERROR, {_('error'): e})
 
-class GarbageCollectorThread(WarehauserThread):
-    def _collect(self, models):
+class EventReaperTask(WarehauserTask):
+    """
+    Reclaim batched events left in STATUS_PROCESSING by a scheduler node or web worker that died, so they neither count
+    toward the running events of their client nor hold back their parent forever.
+
+    An event is abandoned once it has not been updated for EVENT_PROCESSING_TIMEOUT (default 3600) seconds, or for its own
+    timeout if that is longer, and no process holds its mutex. Abandoned events whose process never started are set back to
+    STATUS_OPEN to be dispatched again. The others are set to STATUS_FAILED as their process may have had side effects.
+    """
+    def _reap(self, event):
+        if event.proc_start is None:
+            if Event.objects.filter(id=event.id, status=STATUS_PROCESSING, proc_start__isnull=True).update(status=STATUS_OPEN, updated_at=timezone.now()):
+                logging.warning(_(f'[{self}]: Reopened {event} whose process never started.'))
+                notify_event_queue()
+            return
+
+        event.refresh_from_db()
+        if event.status == STATUS_PROCESSING:
+            event.fail(msg=_(f'Event process was abandoned by its worker.'), code=WarehauserErrorCodes.EVENT_ABANDONED)
+
+    def process(self):
+        lease = getattr(settings, 'EVENT_PROCESSING_TIMEOUT', 3600)
+        if lease is None:
+            return
+
+        now = timezone.now()
+        events = filter_shard(Event.objects.filter(is_batched=True, status=STATUS_PROCESSING, updated_at__lt=now - timedelta(seconds=lease)), shard=self.shard)
+        for event in events.select_related('owner__group').order_by('updated_at'):
+            timeout = event.get_timeout()
+            if timeout is not None and event.updated_at >= now - timedelta(seconds=timeout):
+                continue
+
+            try:
+                with db_mutex(f'event:{event.id}'):
+                    self._reap(event)
+            except DBMutexError:
+                # Still being processed
+                continue
+            except DBMutexTimeoutError:
+                logging.error(_(f'[{self}]: Mutex for {event} timed out.'))
+
+class EventMetricsTask(WarehauserTask):
+    def process(self):
+        event_metrics.flush()
+
+class GarbageCollectorTask(WarehauserTask):
+    """
+    Delete virtual model objects with status DESTROY.
+
+    Objects are deleted in chunks of GARBAGE_COLLECTOR_CHUNK_SIZE (default 1000) with one bulk delete per chunk so no single
+    transaction holds its locks for long, sleeping GARBAGE_COLLECTOR_CHUNK_DELAY (default 0.0) seconds between chunks. At most
+    GARBAGE_COLLECTOR_MAX_DELETES (default None for no limit) objects of each model are deleted per run, the rest are left
+    for the next run.
+    """
+    def _collect(self, queryset):
+        chunk_size = max(int(getattr(settings, 'GARBAGE_COLLECTOR_CHUNK_SIZE', 1000)), 1)
+        delay = getattr(settings, 'GARBAGE_COLLECTOR_CHUNK_DELAY', 0.0)
+        max_deletes = getattr(settings, 'GARBAGE_COLLECTOR_MAX_DELETES', None)
+
+        name = queryset.model.__name__
+        queryset = queryset.order_by('id')
+        total = 0
+        last_id = None
+
+        while max_deletes is None or total < max_deletes:
+            limit = chunk_size if max_deletes is None else min(chunk_size, max_deletes - total)
+            chunk = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            ids = list(chunk.values_list('id', flat=True)[:limit])
+            if not ids:
+                break
+
+            last_id = ids[-1]
+
+            try:
+                with transaction.atomic():
+                    queryset.model.delete_objects(ids)
+                total = total + len(ids)
+            except ProtectedError:
+                # Fall back to deleting this chunk one object at a time to report the protected object(s)
+                total = total + self._collect_each(queryset.filter(id__in=ids))
+
+            logging.info(msg=_(f'Garbage collected {total} {name} object(s).'))
+
+            if len(ids) < limit:
+                break
+
+            if delay:
+                time.sleep(delay)
+
+        return total
+
+    def _collect_each(self, models) -> int:
+        count = 0
         for model in models:
             try:
                 model.log(level=logging.INFO, msg=_(f'Garbage collecting {model.__class__.__name__}({model.id})'))
                 model.delete()
+                count = count + 1
             except ProtectedError as e:
                 model.log(level=logging.ERROR, msg=f'Unable to delete {model} as it is referenced by other object(s).\n{e}')
+        return count
 
     def process(self):
         try:
-            with db_mutex(f'garbagecollector'):
-                self._collect(Event.objects.filter(is_virtual=True, status=STATUS_DESTROY))
-                self._collect(Warehause.objects.filter(is_virtual=True, status=STATUS_DESTROY))
-                self._collect(Product.objects.filter(is_virtual=True, status=STATUS_DESTROY))
+            with db_mutex(self.get_mutex_name('garbagecollector')):
+                self._collect(filter_shard(Event.objects.filter(is_virtual=True, status=STATUS_DESTROY), shard=self.shard))
+                self._collect(filter_shard(Warehause.objects.filter(is_virtual=True, status=STATUS_DESTROY), shard=self.shard))
+                self._collect(filter_shard(Product.objects.filter(is_virtual=True, status=STATUS_DESTROY), shard=self.shard))
         except DBMutexError as e:
             raise WarehauserError(_('Unable to secure mutex for garbagecollector.'), WarehauserErrorCodes.MUTEX_ERROR, {_('error'): e})
         except DBMutexTimeoutError as e:
             raise WarehauserError(_('Unable to secure mutex for garbagecollector.'), WarehauserErrorCodes.MUTEX_TIMEOUT_ERROR, {_('error'): e})
 
-class EmailThread(WarehauserThread):
-    def _send_password_change_emails(self):
-        auxs = UserAux.objects.filter(
-            Q(options__contains={'otp': {'codes': {}}}) &  # Check for existence of 'otp' and 'codes' keys
-            ~Q(options__otp__codes={})  # Exclude empty 'codes' dictionary
-        )
-
-        for aux in auxs:
-            # print(json.dumps(aux.options['otp']['codes'], indent=3))
-            for otp, data in aux.options['otp']['codes'].items():
-                if int(data['status']) > 0:
-                    continue
-
-                logging.info(msg=f'Processing {aux.user.username} email sending.')
-
-                data['status'] = 1
-                aux.save()
-
-                to_address = aux.user.email
-                server_address = settings.EMAIL_WAREHAUSER_HOST
-                revoke_url = reverse('auth_otp_revoke_view', kwargs={'user': aux.user.id, 'otp': otp,})
-                complete_url = urljoin(server_address, revoke_url)
-
-                message = f"""
-Hi {aux.user.get_username()},
-
-Your Warehauser account password has been successfully changed. If this was done in error then click on this link:
-
-    {complete_url}
-
-Otherwise, happy warehausing!
-
-Regards,
-The Warehause Admin Team
-"""
-
-                send_mail(subject='Warehauser password change successful',
-                        message=message,
-                        from_email='noreply@warehauser.org',
-                        recipient_list=[to_address],
-                        fail_silently=False)
-
+class EmailTask(WarehauserTask):
+    """
+    Send the emails queued in the EmailOutbox table over a single mail connection.
+    """
     def process(self):
         try:
             with db_mutex(f'emailthread'):
-                self._send_password_change_emails()
+                send_outbox()
         except DBMutexError as e:
             return
         except Exception as e:
@@ -27,7 +27,7 @@ from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.models import User
-from django.core.mail import send_mail
+from django.db import transaction
 from django.http import HttpResponse, JsonResponse
 from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect, get_object_or_404
@@ -38,6 +38,7 @@ from django.utils.translation import gettext as _
 from rest_framework.authtoken.models import Token
 
 from core.models import *
+from core.outbox import queue_password_change_email, queue_password_reset_email
 
 from .decorators import *
 from .forms import *
@@ -403,11 +404,12 @@ class AuthForgotFormHandler(DefaultFormHandler):
     def post(self, request, *args, **kwargs) -> JsonResponse:
         form = WarehauserPasswordChangeForm(request.user, request.POST)
         if form.is_valid():
+            otp = generate_otp_code()
             data = {
                 'otp': {
                     'codes': {
-                        generate_otp_code(): {
-                            'status': 0,
+                        otp: {
+                            'status': 1, # the email is queued in the same transaction below
                             'type': 'passwd',
                             'dt': f'{timezone.localtime(timezone.now())}',
                             'data': {
@@ -419,7 +421,7 @@ class AuthForgotFormHandler(DefaultFormHandler):
             }
 
             try:
-                with db_mutex(f'core_useraux'):
+                with db_mutex(f'core_useraux'), transaction.atomic():
                     try:
                         aux = UserAux.objects.get(user=user)
                         aux.options.update(data)
@@ -429,6 +431,8 @@ class AuthForgotFormHandler(DefaultFormHandler):
                     if 'attempts' not in aux.options['otp']:
                         aux.options['otp']['attempts'] = list()
                     aux.save()
+
+                    queue_password_change_email(user=aux.user, otp=otp)
             except Exception as e:
                 raise e
 
@@ -730,11 +734,12 @@ def auth_change_password_view(request):
     if request.method.lower() == 'post':
         form = WarehauserPasswordChangeForm(request.user, request.POST)
         if form.is_valid():
+            otp = generate_otp_code()
             data = {
                 'otp': {
                     'codes': {
-                        generate_otp_code(): {
-                            'status': 0,
+                        otp: {
+                            'status': 1, # the email is queued in the same transaction below
                             'type': 'passwd',
                             'dt': f'{timezone.localtime(timezone.now())}',
                             'data': {
@@ -746,7 +751,7 @@ def auth_change_password_view(request):
             }
 
             try:
-                with db_mutex(f'core_useraux'):
+                with db_mutex(f'core_useraux'), transaction.atomic():
                     try:
                         aux = UserAux.objects.get(user=user)
                         aux.options.update(data)
@@ -756,6 +761,8 @@ def auth_change_password_view(request):
                     if 'attempts' not in aux.options['otp']:
                         aux.options['otp']['attempts'] = list()
                     aux.save()
+
+                    queue_password_change_email(user=aux.user, otp=otp)
             except Exception as e:
                 raise e
 
@@ -823,7 +830,7 @@ def auth_forgot_password_view(request):
                     'otp': {
                         'codes': {
                             otp: {
-                                'status': 0,
+                                'status': 1, # the email is queued in the same transaction below
                                 'type': 'forgotpwd',
                                 'dt': f'{timezone.localtime(timezone.now())}',
                                 'data': {
@@ -835,7 +842,7 @@ def auth_forgot_password_view(request):
                 }
 
                 try:
-                    with db_mutex(f'core_useraux'):
+                    with db_mutex(f'core_useraux'), transaction.atomic():
                         try:
                             aux = UserAux.objects.get(user=user)
                             aux.options.update(data)
@@ -845,25 +852,12 @@ def auth_forgot_password_view(request):
                         if 'attempts' not in aux.options['otp']:
                             aux.options['otp']['attempts'] = list()
                         aux.save()
+
+                        # Queue the confirmation email...
+                        queue_password_reset_email(email=email, otp=otp)
                 except Exception as e:
                     raise e
 
-                # Store password in session and send confirmation email...
-                content = f"""
-Hi,
-
-Here is your one time code to change your password:
-
-{otp}
-
-"""
-
-                send_mail(subject='Warehauser Password Reset Request',
-                          message=content,
-                          from_email=settings.EMAIL_FROM_ADDRESS,
-                          recipient_list=[email,],
-                          fail_silently=False)
-
             return JsonResponse({}, status=200)
         else:
             return JsonResponse({}, status=200)